@@ -0,0 +1,56 @@
+# bench_data_manager.py
+#
+# data_manager の読み込み (load_all_data と全チャンネルの履歴の読み込み) と保存 (save_all_data)。
+# 履歴の合計サイズを 10KB〜100MB で変える。
+
+from benchmarks.harness import benchmark, temporary_instance, sample_turns, sample_text
+
+KB = 1024
+MB = 1024 * KB
+TURNS_PER_CHANNEL = 200
+TURN_CHARS = 300
+
+def populate_histories(total_bytes: int) -> int:
+    """合計がおよそ total_bytes になるまでチャンネルの履歴を書き込み、チャンネル数を返す"""
+    from utils import data_manager
+    data_manager.load_all_data()
+    backend = data_manager.get_history_backend()
+    turns = sample_turns(TURNS_PER_CHANNEL, TURN_CHARS)
+    # 日本語が多いため1文字あたりおよそ3バイト
+    bytes_per_channel = sum(len(p) * 3 for t in turns for p in t["parts"])
+    channel_count = max(1, total_bytes // bytes_per_channel)
+    last_turn_count = TURNS_PER_CHANNEL if total_bytes >= bytes_per_channel else max(2, TURNS_PER_CHANNEL * total_bytes // bytes_per_channel)
+    for i in range(channel_count):
+        # イベントループ外なので書き込みはその場で行われる
+        backend.reset_channel(str(900000 + i), turns if i < channel_count - 1 else turns[:last_turn_count])
+    return channel_count
+
+@benchmark(params={"size_kb": [10, 1 * KB, 10 * KB, 100 * KB], "backend": ["journal", "sqlite"]},
+           quick={"size_kb": [10, 1 * KB], "backend": ["journal"]}, repeat=3)
+def bench_load_all_data(size_kb, backend):
+    from utils import data_manager
+    with temporary_instance(storage_backend=backend):
+        channel_count = populate_histories(size_kb * KB)
+
+        def run():
+            data_manager.load_all_data()
+            histories = data_manager.get_data('history')
+            turn_count = sum(len(histories[ch]) for ch in histories.known_channels())
+            return {"channels": channel_count, "turns": turn_count}
+
+        yield run
+
+@benchmark(params={"size_kb": [10, 1 * KB, 10 * KB, 100 * KB], "memories": [10, 10000]},
+           quick={"size_kb": [10, 1 * KB], "memories": [10]}, repeat=5)
+def bench_save_all_data(size_kb, memories):
+    from utils import data_manager
+    with temporary_instance(memories=[sample_text(80, i) for i in range(memories)]):
+        channel_count = populate_histories(size_kb * KB)
+        data_manager.load_all_data()
+
+        def run():
+            # force=True で全セクションを保存する (イベントループ外なので同期的に書き込まれる)
+            data_manager.save_all_data(force=True)
+            return {"channels": channel_count}
+
+        yield run
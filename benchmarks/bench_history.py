@@ -0,0 +1,48 @@
+# bench_history.py
+#
+# 履歴への追加 (add_message_to_history) と、トークン予算による古い会話の削除。
+
+from benchmarks.harness import benchmark, temporary_instance, sample_turns, sample_text
+
+CHANNEL_ID = 900000
+
+@benchmark(params={"turns": [20, 100, 200], "turn_chars": [100, 1000]},
+           quick={"turns": [100], "turn_chars": [100, 1000]}, repeat=5, number=50)
+def bench_add_message_to_history(turns, turn_chars):
+    import utils.config_manager as config
+    from utils import data_manager, ai_request_handler
+
+    previous_summary = config.HISTORY_SUMMARY_ENABLED
+    config.HISTORY_SUMMARY_ENABLED = False # 削除した会話の要約 (API呼び出し) は計測しない
+    try:
+        with temporary_instance():
+            data_manager.load_all_data()
+            ai_request_handler.initialize_histories()
+            data_manager.get_history_backend().reset_channel(str(CHANNEL_ID), sample_turns(turns, turn_chars))
+            data_manager.reload_data('history')
+            counter = iter(range(10 ** 9))
+
+            def run():
+                i = next(counter)
+                role = "user" if i % 2 == 0 else "model"
+                ai_request_handler.add_message_to_history(CHANNEL_ID, role, sample_text(turn_chars, i), config.MODEL_PRO)
+                return {"history_length": len(ai_request_handler.get_channel_history(CHANNEL_ID))}
+
+            yield run
+    finally:
+        config.HISTORY_SUMMARY_ENABLED = previous_summary
+
+@benchmark(params={"turns": [200, 2000]}, quick={"turns": [200]}, repeat=5, number=20)
+def bench_trim_to_budget(turns):
+    import utils.config_manager as config
+    from utils import history_trimmer
+
+    source = sample_turns(turns, 1000)
+
+    def run():
+        history = list(source)
+        history_trimmer.invalidate(CHANNEL_ID)
+        evicted = history_trimmer.trim_to_budget(CHANNEL_ID, history, config.MODEL_PRO)
+        return {"evicted": len(evicted)}
+
+    yield run
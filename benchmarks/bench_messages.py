@@ -0,0 +1,49 @@
+# bench_messages.py
+#
+# 長文の応答を Discord の文字数制限で分割して送信する処理 (send_splittable_message)。
+# 分割の間の待機 (asyncio.sleep) と送信は計測から除く。
+
+import asyncio
+from benchmarks.harness import benchmark, sample_text
+
+class _NoSleepAsyncio:
+    """asyncio.sleep だけを待たないようにした asyncio の代わり"""
+
+    def __getattr__(self, name):
+        return getattr(asyncio, name)
+
+    @staticmethod
+    async def sleep(delay, result=None):
+        return result
+
+class _NullChannel:
+    def __init__(self):
+        self.sent = 0
+
+    async def send(self, content=None, file=None):
+        self.sent += 1
+
+def sample_reply(chars: int, line_chars: int) -> str:
+    """line_chars 文字ごとに改行を含む応答 (0 なら改行なし)"""
+    text = sample_text(chars)
+    if not line_chars:
+        return text
+    return "\n".join(text[i:i + line_chars] for i in range(0, len(text), line_chars))
+
+@benchmark(params={"chars": [1500, 20000, 200000], "line_chars": [0, 80]},
+           quick={"chars": [1500, 20000], "line_chars": [80]}, repeat=5, number=20)
+def bench_send_splittable_message(chars, line_chars):
+    from cogs import chat
+    text = sample_reply(chars, line_chars)
+    channel = _NullChannel()
+    original_asyncio = chat.asyncio
+    chat.asyncio = _NoSleepAsyncio()
+    try:
+        async def run():
+            channel.sent = 0
+            await chat.send_splittable_message(channel, text)
+            return {"messages": channel.sent}
+
+        yield run
+    finally:
+        chat.asyncio = original_asyncio
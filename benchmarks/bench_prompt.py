@@ -0,0 +1,71 @@
+# bench_prompt.py
+#
+# prompt_builder の状況説明 (get_bot_status_text) と応答プロンプト (build_response_prompt)。
+
+import random
+from types import SimpleNamespace
+from benchmarks.harness import benchmark, sample_emotion_data, sample_text
+
+_KANA = "あいうえおかきくけこさしすせそたちつてとなにぬねのはひふへほまみむめもやゆよらりるれろわをん"
+_KANJI = "日月火水木金土山川田人口目耳手足車雨花犬猫鳥魚本空海森町村学校先生友家食飲見行来"
+
+def sample_memories(count: int, start: int = 0) -> list[str]:
+    """2000語の語彙から8語ずつ選んだ、互いに異なる語を含む記憶"""
+    vocabulary_rng = random.Random(0)
+    vocabulary = ["".join(vocabulary_rng.choice(_KANJI) for _ in range(2)) + vocabulary_rng.choice(_KANA) for _ in range(2000)]
+    memories = []
+    for i in range(start, start + count):
+        rng = random.Random(i)
+        memories.append("、".join(rng.choice(vocabulary) for _ in range(8)) + "ということを覚えている。")
+    return memories
+
+def fake_bot(memory_count: int):
+    """get_bot_status_text が参照する Cog だけを持つ Bot"""
+    import utils.config_manager as config
+    from utils.memory_index import MemoryIndex
+    emotion_data = sample_emotion_data()
+    index = MemoryIndex(sample_memories(memory_count))
+    cogs = {
+        "EmotionCog": SimpleNamespace(get_current_emotions=lambda: dict(emotion_data["current_emotions"]), emotion_map=emotion_data["emotion_map"]),
+        "MemoryCog": SimpleNamespace(select_memories=lambda query: index.select(
+            query, config.MEMORY_RETRIEVAL_TOP_K, config.MEMORY_RETRIEVAL_TOKEN_BUDGET)),
+        "ChatManagerCog": SimpleNamespace(current_action="ベンチマーク中", current_activity_level="normal"),
+    }
+    return SimpleNamespace(get_cog=cogs.get)
+
+@benchmark(params={"memories": [10, 1000, 10000]}, quick={"memories": [10, 1000]}, repeat=5, number=50)
+def bench_get_bot_status_text(memories):
+    from utils import prompt_builder
+    bot = fake_bot(memories)
+
+    def run():
+        return {"chars": len(prompt_builder.get_bot_status_text(bot))}
+
+    yield run
+
+@benchmark(params={"memories": [10, 10000], "messages": [1, 50]},
+           quick={"memories": [1000], "messages": [1, 50]}, repeat=5, number=50)
+def bench_build_response_prompt(memories, messages):
+    from utils import prompt_builder
+    from utils.unread_queue import UnreadMessage
+    bot = fake_bot(memories)
+    unread = [UnreadMessage(f"user{i % 3}", "、".join(sample_memories(1, i)[0].split("、")[:3]) + sample_text(40, i), "2025年01月01日(水) 12時00分") for i in range(messages)]
+
+    def run():
+        bot_status = prompt_builder.get_bot_status_text(bot, prompt_builder.build_memory_query(unread))
+        return {"chars": len(prompt_builder.build_response_prompt(unread, bot_status))}
+
+    yield run
+
+@benchmark(params={"memories": [100, 10000]}, quick={"memories": [1000]}, repeat=5, number=20)
+def bench_memory_index_update(memories):
+    """記憶の追加と削除 (インデックスの差分更新)"""
+    from utils.memory_index import MemoryIndex
+    index = MemoryIndex(sample_memories(memories))
+    new_memories = iter(sample_memories(100000, memories))
+
+    def run():
+        index.add(next(new_memories))
+        index.remove(0)
+
+    yield run
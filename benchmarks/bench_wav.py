@@ -0,0 +1,38 @@
+# bench_wav.py
+#
+# VOICEVOX の音声セグメントの結合 (wav_assembler.assemble)。
+
+import struct
+from benchmarks.harness import benchmark
+
+def make_wav(seconds: float, sample_rate: int = 24000, channels: int = 1) -> bytes:
+    """のこぎり波の 16bit PCM WAV"""
+    frame_count = int(seconds * sample_rate)
+    samples = bytes(range(256)) * (frame_count * channels * 2 // 256 + 1)
+    data = samples[:frame_count * channels * 2]
+    block_align = channels * 2
+    header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + len(data), b'WAVE', b'fmt ', 16, 1,
+                         channels, sample_rate, sample_rate * block_align, block_align, 16, b'data', len(data))
+    return header + data
+
+@benchmark(params={"segments": [4, 16, 64], "seconds": [1.0, 5.0]},
+           quick={"segments": [4, 16], "seconds": [3.0]}, repeat=5, number=5)
+def bench_assemble(segments, seconds):
+    from utils import wav_assembler
+    wavs = [make_wav(seconds) for _ in range(segments)]
+
+    def run():
+        return {"bytes": len(wav_assembler.assemble(wavs, 500))}
+
+    yield run
+
+@benchmark(params={"segments": [4, 16]}, quick={"segments": [4]}, repeat=3, number=1)
+def bench_assemble_mixed_formats(segments):
+    """先頭と異なるフォーマット (44.1kHz ステレオ) のセグメントを変換しながら結合する"""
+    from utils import wav_assembler
+    wavs = [make_wav(3.0) if i % 2 == 0 else make_wav(3.0, 44100, 2) for i in range(segments)]
+
+    def run():
+        return {"bytes": len(wav_assembler.assemble(wavs, 500))}
+
+    yield run
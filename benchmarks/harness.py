@@ -0,0 +1,213 @@
+# harness.py
+#
+# ベンチマークの登録と実行、結果の JSON 保存と比較。
+# ベンチマークはジェネレーター関数として書く: 準備をしてから計測する関数を yield し、
+# yield の後に後片付けを書く。計測する関数が dict を返した場合は結果に追加情報として残す。
+#
+#   @benchmark(params={"size": [10, 100]}, quick={"size": [10]}, number=20)
+#   def bench_example(size):
+#       data = make_data(size)
+#       yield lambda: process(data)
+#       cleanup()
+
+import os
+import sys
+import json
+import time
+import shutil
+import asyncio
+import platform
+import tempfile
+import itertools
+import statistics
+import contextlib
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+# 比較時に悪化とみなす中央値の比率
+REGRESSION_THRESHOLD = 1.10
+
+_registry = []
+
+class Benchmark:
+    def __init__(self, name: str, func, params: dict, quick: dict | None, repeat: int, number: int):
+        self.name = name
+        self.func = func
+        self.params = params
+        self.quick = quick if quick is not None else params
+        self.repeat = repeat
+        self.number = number
+
+    def cases(self, quick: bool) -> list[dict]:
+        grid = self.quick if quick else self.params
+        if not grid:
+            return [{}]
+        keys = list(grid)
+        return [dict(zip(keys, values)) for values in itertools.product(*(grid[k] for k in keys))]
+
+def benchmark(params: dict | None = None, quick: dict | None = None, repeat: int = 5, number: int = 1, name: str | None = None):
+    """ベンチマークを登録するデコレーター。number は1回の計測で呼ぶ回数 (結果は1回あたりの時間)"""
+    def decorator(func):
+        bench_name = name or f"{func.__module__.rsplit('.', 1)[-1].removeprefix('bench_')}.{func.__name__.removeprefix('bench_')}"
+        _registry.append(Benchmark(bench_name, func, params or {}, quick, repeat, number))
+        return func
+    return decorator
+
+def get_benchmarks() -> list[Benchmark]:
+    return list(_registry)
+
+def _call(fn, loop):
+    result = fn()
+    if asyncio.iscoroutine(result):
+        result = loop.run_until_complete(result)
+    return result
+
+def run_case(bench: Benchmark, case: dict, repeat: int | None = None) -> dict:
+    """1つのパラメーターの組み合わせを計測する"""
+    repeat = repeat or bench.repeat
+    loop = asyncio.new_event_loop()
+    generator = bench.func(**case)
+    try:
+        run = next(generator)
+        extra = _call(run, loop) # ウォームアップ
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(bench.number):
+                extra = _call(run, loop)
+            samples.append((time.perf_counter() - start) / bench.number)
+    finally:
+        generator.close()
+        loop.close()
+    return {
+        "name": bench.name,
+        "params": case,
+        "repeat": repeat,
+        "number": bench.number,
+        "min": min(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+        "extra": extra if isinstance(extra, dict) else None,
+    }
+
+def case_key(result: dict) -> str:
+    params = ",".join(f"{k}={v}" for k, v in sorted(result["params"].items()))
+    return f"{result['name']}[{params}]"
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def build_report(results: list[dict], quick: bool) -> dict:
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "quick": quick,
+        "results": results,
+    }
+
+def compare(current: dict, baseline: dict) -> list[str]:
+    """中央値を基準の結果と比べた行を返す (悪化したものに印を付ける)"""
+    baseline_results = {case_key(r): r for r in baseline.get("results", [])}
+    lines = []
+    for result in current["results"]:
+        key = case_key(result)
+        base = baseline_results.get(key)
+        if base is None or not base["median"]:
+            lines.append(f"  {key}: 基準なし")
+            continue
+        ratio = result["median"] / base["median"]
+        mark = " ← 悪化" if ratio > REGRESSION_THRESHOLD else (" ← 改善" if ratio < 1 / REGRESSION_THRESHOLD else "")
+        lines.append(f"  {key}: {format_seconds(base['median'])} -> {format_seconds(result['median'])} (x{ratio:.2f}){mark}")
+    return lines
+
+def format_seconds(seconds: float) -> str:
+    if seconds >= 1:
+        return f"{seconds:.3f}s"
+    if seconds >= 1e-3:
+        return f"{seconds * 1e3:.3f}ms"
+    return f"{seconds * 1e6:.1f}us"
+
+# --- ベンチマーク用のインスタンス ---
+@contextlib.contextmanager
+def temporary_instance(name: str = "bench", memories: list | None = None, storage_backend: str | None = None):
+    """
+    一時ディレクトリに最小限のインスタンスを作り、config_manager をそこに向ける。
+    終了時に履歴バックエンドを閉じ、作業ディレクトリを元に戻して削除する。
+    """
+    import utils.config_manager as config
+    from utils import data_manager
+
+    workdir = tempfile.mkdtemp(prefix="east_bench_")
+    base_dir = os.path.join(workdir, "instances", name)
+    data_dir = os.path.join(base_dir, "data")
+    os.makedirs(data_dir)
+    files = {
+        os.path.join(base_dir, "persona.txt"): "あなたはベンチマーク用のキャラクターです。" * 20,
+        os.path.join(base_dir, "emotion.txt"): "あなたは対話を分析する心理学者です。",
+        os.path.join(data_dir, "setting.json"): {"config": {"character_name": name}, "channel_settings": {}},
+        os.path.join(data_dir, "emotion.json"): sample_emotion_data(),
+        os.path.join(data_dir, "memory.json"): memories or [],
+        os.path.join(data_dir, "schedule.json"): {"weekday": {}, "weekend": {}, "activity_params": {}},
+        os.path.join(data_dir, "unread_messages.json"): {},
+    }
+    for path, content in files.items():
+        with open(path, "w", encoding="utf-8") as f:
+            if isinstance(content, str):
+                f.write(content)
+            else:
+                json.dump(content, f, ensure_ascii=False)
+
+    previous_cwd = os.getcwd()
+    previous_backend = config.STORAGE_BACKEND
+    os.chdir(workdir)
+    try:
+        if storage_backend:
+            config.STORAGE_BACKEND = storage_backend
+        config.init(name)
+        yield base_dir
+    finally:
+        backend = data_manager.get_history_backend()
+        if backend is not None:
+            backend.close()
+            data_manager._history_backend = None # 次のインスタンスでは作り直させる
+        config.STORAGE_BACKEND = previous_backend
+        os.chdir(previous_cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def sample_emotion_data() -> dict:
+    names = {"joy": "喜び", "anticipation": "期待", "anger": "怒り", "disgust": "嫌悪",
+             "sadness": "悲しみ", "surprise": "驚き", "fear": "恐れ", "trust": "信頼"}
+    emotion_map = {name: ["*", ja_name] for name, ja_name in names.items()}
+    defaults = {name: 250 for name in names}
+    return {"emotion_map": emotion_map, "default_emotions": defaults, "current_emotions": dict(defaults)}
+
+SAMPLE_SENTENCES = [
+    "今日はとてもいい天気だったね。", "さっきの話の続きなんだけど、", "It was a long day at work.",
+    "明日は何時に起きる予定？", "そういえば、新しいゲームを買ったんだ。", "Let's meet again tomorrow!",
+]
+
+def sample_text(chars: int, offset: int = 0) -> str:
+    """日本語と英語が混ざった、おおよそ chars 文字のテキスト"""
+    text = ""
+    i = offset
+    while len(text) < chars:
+        text += SAMPLE_SENTENCES[i % len(SAMPLE_SENTENCES)]
+        i += 1
+    return text[:chars]
+
+def sample_turns(count: int, chars: int) -> list[dict]:
+    """ペルソナで始まり、user と model が交互に続く履歴"""
+    turns = [{"role": "user", "parts": [sample_text(chars * 4)]}]
+    for i in range(count - 1):
+        turns.append({"role": "model" if i % 2 else "user", "parts": [sample_text(chars, i)]})
+    return turns
@@ -0,0 +1,68 @@
+# run.py
+#
+# ベンチマークを実行して結果を JSON で保存する。
+#
+#   python -m benchmarks.run                 # 全て実行 (大きいサイズを含む)
+#   python -m benchmarks.run --quick         # 小さいパラメーターだけ
+#   python -m benchmarks.run -k wav          # 名前に "wav" を含むものだけ
+#   python -m benchmarks.run --compare benchmarks/results/abc1234.json
+#
+# 結果は既定で benchmarks/results/<コミット>.json に保存する。
+
+import os
+import json
+import argparse
+import traceback
+
+from benchmarks import harness
+from benchmarks import bench_data_manager, bench_history, bench_prompt, bench_messages, bench_wav # 登録のため
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+def main():
+    parser = argparse.ArgumentParser(description="データ・プロンプト処理のベンチマーク")
+    parser.add_argument("-k", "--filter", default=None, help="名前にこの文字列を含むベンチマークだけを実行する")
+    parser.add_argument("--quick", action="store_true", help="小さいパラメーターだけで実行する")
+    parser.add_argument("--repeat", type=int, default=None, help="計測回数 (省略時はベンチマークごとの既定値)")
+    parser.add_argument("--output", default=None, help="結果の保存先 (省略時は benchmarks/results/<コミット>.json)")
+    parser.add_argument("--compare", default=None, help="比較する基準の結果ファイル")
+    parser.add_argument("--list", action="store_true", help="ベンチマークの一覧を表示する")
+    args = parser.parse_args()
+
+    benchmarks = [b for b in harness.get_benchmarks() if not args.filter or args.filter in b.name]
+    if args.list:
+        for bench in benchmarks:
+            print(f"{bench.name}: {len(bench.cases(args.quick))}件")
+        return
+
+    results = []
+    for bench in benchmarks:
+        for case in bench.cases(args.quick):
+            label = harness.case_key({"name": bench.name, "params": case})
+            try:
+                result = harness.run_case(bench, case, args.repeat)
+            except Exception:
+                print(f"{label}: 失敗")
+                traceback.print_exc()
+                continue
+            results.append(result)
+            extra = f" {result['extra']}" if result["extra"] else ""
+            print(f"{label}: 中央値 {harness.format_seconds(result['median'])} "
+                  f"(最小 {harness.format_seconds(result['min'])}, ±{harness.format_seconds(result['stdev'])}){extra}")
+
+    report = harness.build_report(results, args.quick)
+    output = args.output or os.path.join(RESULTS_DIR, f"{report['git_commit'] or 'unknown'}{'-quick' if args.quick else ''}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果を保存しました: {output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"--- {args.compare} ({baseline.get('git_commit')}) との比較 ---")
+        for line in harness.compare(report, baseline):
+            print(line)
+
+if __name__ == "__main__":
+    main()
@@ -5,11 +5,15 @@ from discord.ext import commands, tasks
 from datetime import datetime
 import random
 import asyncio
+import time
 
 import utils.config_manager as config
 from utils.console_display import log_info, log_system, log_success, log_error, log_warning # log_warning を追加
-from utils import data_manager, ai_request_handler, prompt_builder
+from utils import data_manager, ai_request_handler, prompt_builder, client_pool
 from utils import voice_synthesizer
+from utils.message_streamer import MessageStreamer, DISCORD_MESSAGE_LIMIT, find_split_point
+from utils.channel_scheduler import ChannelScheduler
+from utils.unread_queue import UnreadMessage
 
 async def send_splittable_message(channel: discord.TextChannel, text: str, file: discord.File = None):
     """
@@ -18,15 +22,13 @@ async def send_splittable_message(channel: discord.TextChannel, text: str, file:
     # (この関数は変更なし)
     if not text:
         return
-    if len(text) <= 2000:
+    if len(text) <= DISCORD_MESSAGE_LIMIT:
         await channel.send(text, file=file)
         return
     log_info("MESSAGE", f"長文メッセージ({len(text)}文字)を分割して送信します。")
     remaining_text = text
-    while len(remaining_text) > 2000:
-        split_point = remaining_text.rfind('\n', 0, 2000)
-        if split_point == -1:
-            split_point = 2000
+    while len(remaining_text) > DISCORD_MESSAGE_LIMIT:
+        split_point = find_split_point(remaining_text)
         await channel.send(remaining_text[:split_point])
         remaining_text = remaining_text[split_point:].lstrip()
         await asyncio.sleep(0.5)
@@ -43,6 +45,7 @@ class ChatManagerCog(commands.Cog, name="ChatManagerCog"):
         self.weekday_schedule = schedule_data.get("weekday", {})
         self.weekend_schedule = schedule_data.get("weekend", {})
         self.activity_params = schedule_data.get("activity_params", {})
+        self.reactive_params = schedule_data.get("reactive_params", config.REACTIVE_PARAMS)
 
         settings_data = data_manager.get_data('setting')
         self.channel_settings = settings_data.get('channel_settings', {})
@@ -50,6 +53,12 @@ class ChatManagerCog(commands.Cog, name="ChatManagerCog"):
         self.current_action = "待機中"
         self.current_activity_level = 'normal'
 
+        # チャンネルごとの次の活動時刻と、実行中の活動タスク
+        self.scheduler = ChannelScheduler()
+        self.running_tasks = {}
+        # リアクティブモードのチャンネルで、未処理の連投が始まった時刻
+        self.burst_started_at = {}
+
         log_system("チャット管理モジュールを初期化し、活動サイクルを開始します。")
         self.activity_loop.start()
 
@@ -57,17 +66,26 @@ class ChatManagerCog(commands.Cog, name="ChatManagerCog"):
     def reset_unread_messages(self):
         """メモリ上の全ての未読メッセージをクリアします。"""
         self.unread_data.clear()
+        data_manager.mark_dirty('unread')
         log_success("UNREAD", "メモリ上の全未読メッセージがリセットされました。")
 
-    def pop_unread_message(self, channel_id: int) -> dict | None:
+    def pop_unread_message(self, channel_id: int) -> UnreadMessage | None:
         """指定されたチャンネルの最も古い未読メッセージを1件削除し、その内容を返します。"""
-        str_channel_id = str(channel_id)
-        if self.unread_data.get(str_channel_id):
-            popped_message = self.unread_data[str_channel_id].pop(0) # 先頭(0番目)を削除
+        popped_message = self.unread_data.pop_oldest(channel_id)
+        if popped_message:
+            data_manager.mark_dirty('unread')
             log_info("UNREAD", f"CH[{channel_id}] の未読メッセージを1件popしました。")
             return popped_message
         return None
 
+    def is_stream_mode_enabled(self, channel_id: int) -> bool:
+        """指定されたチャンネルでストリーミング表示が有効かを確認します。"""
+        return self.channel_settings.get(str(channel_id), {}).get('stream_mode', config.STREAM_MODE_DEFAULT)
+
+    def is_reactive_mode_enabled(self, channel_id) -> bool:
+        """指定されたチャンネルでリアクティブモード (メッセージ受信を契機に応答) が有効かを確認します。"""
+        return self.channel_settings.get(str(channel_id), {}).get('reactive_mode', config.REACTIVE_MODE_DEFAULT)
+
     @commands.Cog.listener()
     async def on_message(self, message):
         """メッセージを受信したら未読リストに追加する"""
@@ -79,56 +97,125 @@ class ChatManagerCog(commands.Cog, name="ChatManagerCog"):
         if not channel_setting.get('chat_mode', False):
             return
 
-        if channel_id_str not in self.unread_data:
-            self.unread_data[channel_id_str] = []
-
         # ★ 送信者のアクティビティを取得
         activity_str = self._get_user_activity_str(message.author)
 
-        self.unread_data[channel_id_str].append({
-            'author': message.author.display_name,
-            'content': message.content,
-            'timestamp': prompt_builder.get_current_time_str(),
-            'activity': activity_str  # ★ ここにアクティビティ情報を追加
-        })
+        # 上限を超えた分は UNREAD_OVERFLOW_POLICY に従って整理される
+        self.unread_data.append(
+            channel_id_str,
+            message.author.display_name,
+            message.content,
+            prompt_builder.get_current_time_str(),
+            activity_str  # ★ ここにアクティビティ情報を追加
+        )
+        data_manager.mark_dirty('unread')
         log_info("UNREAD", f"[{message.channel.name}] に未読メッセージを1件追加。(Activity: {activity_str})")
 
-    @tasks.loop(seconds=1.0)
-    async def activity_loop(self):
-        """一定時間待機し、ランダムなチャンネルのメッセージ処理または自発的発言を行うループ"""
-        # (この関数は変更なし)
+        if channel_id_str in self.running_tasks:
+            return # 処理中のチャンネルは終了後に予定し直される
+        if self.is_reactive_mode_enabled(channel_id_str):
+            # 連投が落ち着くのを待ってから応答する (待つたびに予定を後ろにずらす)
+            self._plan_reactive(channel_id_str)
+        elif channel_id_str not in self.scheduler:
+            # 予定のないチャンネルなら、ここで次の活動を予定する
+            self._plan_channel(channel_id_str)
+
+    def _update_current_schedule(self) -> bool:
+        """現在時刻のスケジュールから行動と活動レベルを更新する。活動レベルが変わった場合は True"""
         now = datetime.now()
         current_hour = str(now.hour)
         weekday = now.weekday()
         active_schedule = self.weekend_schedule if weekday >= 5 else self.weekday_schedule
         current_schedule = active_schedule.get(current_hour, {"level": "normal", "action": "🕒 不明"})
+        level_changed = current_schedule['level'] != self.current_activity_level
         self.current_activity_level = current_schedule['level']
         self.current_action = current_schedule['action']
-        params = self.activity_params.get(self.current_activity_level, {'seconds': 3600, 'sigma': 900})
-        wait_duration = max(60.0, random.normalvariate(params['seconds'], params['sigma']))
+        return level_changed
 
-        # 待機時間を設定（ループ開始時のみ長時間待機）
-        # asyncio.sleep はループの最後に移動
+    def _next_wait_duration(self) -> float:
+        """現在の活動レベルに応じた、次の活動までの待機時間 (秒)"""
+        params = self.activity_params.get(self.current_activity_level, {'seconds': 3600, 'sigma': 900})
+        return max(60.0, random.normalvariate(params['seconds'], params['sigma']))
 
-        # 次の活動までの待機
-        log_info("ACTIVITY", f"現在の行動: {self.current_action} | 次の活動まで {wait_duration/60:.2f} 分待機します。")
-        await asyncio.sleep(wait_duration)
+    def _max_concurrency(self) -> int:
+        """同時に処理するチャンネル数の上限 (指定がなければAPIキーの数)"""
+        return config.ACTIVITY_MAX_CONCURRENCY or max(1, len(client_pool.get_api_keys()))
 
-        # 処理対象チャンネルの選択
+    def _needs_activity(self, str_channel_id: str) -> bool:
+        """未読があるか、自発的に発言するデフォルトチャンネルなら True"""
         default_channel_id = config.get_default_channel_id()
-        channels_with_unread = [int(ch_id) for ch_id, msgs in self.unread_data.items() if msgs]
-        candidate_channel_ids = channels_with_unread or ([default_channel_id] if default_channel_id else [])
-
-        if not candidate_channel_ids:
-            log_info("ACTIVITY", "処理対象のチャンネルが見つかりませんでした。")
-            return # ループの次のイテレーションへ
+        return self.unread_data.has_messages(str_channel_id) or (default_channel_id is not None and str_channel_id == str(default_channel_id))
 
-        target_channel_id = random.choice(candidate_channel_ids)
-        await self.process_channel_activity(target_channel_id)
+    def _plan_reactive(self, str_channel_id: str):
+        """
+        リアクティブモードの予定を立てる。最後のメッセージから debounce 秒後を基本とし、
+        連投の開始から min_delay 秒以上、max_delay 秒以内に収める。
+        """
+        params = self.reactive_params.get(self.current_activity_level) or config.REACTIVE_PARAMS['normal']
+        now = time.monotonic()
+        burst_start = self.burst_started_at.setdefault(str_channel_id, now)
+        due = now + params['debounce']
+        due = max(due, burst_start + params['min_delay'])
+        due = min(due, burst_start + params['max_delay'])
+        self.scheduler.plan(str_channel_id, due)
+        log_info("ACTIVITY", f"CH[{str_channel_id}] のメッセージに {due - now:.0f} 秒後に応答します。(リアクティブモード)")
+
+    def _plan_channel(self, str_channel_id: str, only_if_earlier: bool = False):
+        """チャンネルの次の活動を、現在の活動レベルの待機時間後に予定する"""
+        if self.is_reactive_mode_enabled(str_channel_id) and self.unread_data.has_messages(str_channel_id):
+            if not only_if_earlier:
+                self._plan_reactive(str_channel_id)
+            return
+        wait_duration = self._next_wait_duration()
+        if self.scheduler.plan(str_channel_id, time.monotonic() + wait_duration, only_if_earlier=only_if_earlier):
+            log_info("ACTIVITY", f"現在の行動: {self.current_action} | CH[{str_channel_id}] の次の活動まで {wait_duration/60:.2f} 分待機します。")
 
-        log_info("AUTOSAVE", "自動応答後の定期データ保存を実行します。")
-        data_manager.save_all_data()
+    def _plan_missing_channels(self):
+        """予定のない、活動が必要なチャンネルに予定を入れる"""
+        candidates = self.unread_data.channels_with_messages()
+        default_channel_id = config.get_default_channel_id()
+        if default_channel_id:
+            candidates.append(str(default_channel_id))
+        for str_channel_id in candidates:
+            if str_channel_id not in self.scheduler and str_channel_id not in self.running_tasks:
+                self._plan_channel(str_channel_id)
 
+    @tasks.loop(seconds=1.0)
+    async def activity_loop(self):
+        """
+        チャンネルごとの予定を確認し、予定時刻を過ぎたチャンネルの活動（未読処理 or 自発的発言）を開始するループ。
+        複数のチャンネルを同時に処理する (上限は _max_concurrency)。
+        """
+        if self._update_current_schedule():
+            # 活動レベルが上がった場合は、長すぎる待機を新しいレベルの待機時間まで縮める
+            log_info("ACTIVITY", f"活動レベルが '{self.current_activity_level}' に変わったため、予定を見直します。")
+            for str_channel_id, _ in self.scheduler.items():
+                self._plan_channel(str_channel_id, only_if_earlier=True)
+        self._plan_missing_channels()
+
+        now = time.monotonic()
+        while len(self.running_tasks) < self._max_concurrency():
+            str_channel_id = self.scheduler.pop_due(now)
+            if str_channel_id is None:
+                break
+            if str_channel_id in self.running_tasks or str_channel_id in self.processing_channels:
+                # 処理中のチャンネルは終了後に予定し直される
+                continue
+            self.running_tasks[str_channel_id] = asyncio.create_task(self._run_channel_activity(str_channel_id))
+
+    async def _run_channel_activity(self, str_channel_id: str):
+        # ここまでに届いたメッセージはこの処理でまとめて応答する
+        self.burst_started_at.pop(str_channel_id, None)
+        try:
+            await self.process_channel_activity(int(str_channel_id))
+            log_info("AUTOSAVE", "自動応答後の定期データ保存を実行します。")
+            data_manager.save_all_data()
+        except Exception as e:
+            log_error("ACTIVITY", f"CH[{str_channel_id}] の活動中にエラーが発生しました: {type(e).__name__} - {e}")
+        finally:
+            self.running_tasks.pop(str_channel_id, None)
+            if self._needs_activity(str_channel_id):
+                self._plan_channel(str_channel_id)
 
     async def process_channel_activity(self, channel_id: int):
         """チャンネルの活動（未読処理 or 自発発言）を行う共通関数"""
@@ -146,14 +233,34 @@ class ChatManagerCog(commands.Cog, name="ChatManagerCog"):
 
         # 処理中セットに追加
         self.processing_channels.add(str_channel_id)
+        unread_batch = None
         log_info("PROCESS_START", f"CH[{channel_id}] の処理を開始します。")
 
         try:
-            messages_to_process = self.unread_data.get(str_channel_id, [])
+            # 処理対象の未読メッセージを確定させる (処理中に届いたメッセージは次回に回す)
+            unread_batch = self.unread_data.seal(str_channel_id)
+            messages_to_process = unread_batch.messages
+            overflow_note = unread_batch.overflow_note()
 
             # プロンプト組み立て
-            bot_status = prompt_builder.get_bot_status_text(self.bot)
-            prompt_instruction = prompt_builder.build_response_prompt(messages_to_process, bot_status)
+            bot_status = prompt_builder.get_bot_status_text(self.bot, prompt_builder.build_memory_query(messages_to_process))
+            prompt_instruction = prompt_builder.build_response_prompt(messages_to_process, bot_status, overflow_note)
+
+            # ストリーミング表示が有効なら、受信しながらメッセージを伸ばしていく
+            streamer = None
+            if self.is_stream_mode_enabled(channel_id):
+                streamer = MessageStreamer(target_channel, config.STREAM_EDIT_INTERVAL)
+                streamer.start()
+
+            # 音声モードでは、応答を受信しながら区切りごとに音声合成を始める
+            voice_cog = self.bot.get_cog("VoiceCog")
+            voice_enabled = bool(voice_cog and voice_cog.is_voice_mode_enabled(channel_id))
+            voice_pipeline = voice_synthesizer.VoicePipeline() if voice_enabled and config.VOICE_PIPELINE_ENABLED else None
+
+            stream_consumers = [c.feed for c in (streamer, voice_pipeline) if c]
+            def on_stream_text(text: str):
+                for feed in stream_consumers:
+                    feed(text)
 
             # AIに応答を要求
             async with target_channel.typing():
@@ -161,29 +268,49 @@ class ChatManagerCog(commands.Cog, name="ChatManagerCog"):
                 response_text = await ai_request_handler.send_request(
                     config.MODEL_PRO, # configからモデル名を取得
                     prompt_instruction,
-                    channel_id=channel_id # channel_id を渡す
+                    channel_id=channel_id, # channel_id を渡す
+                    stream_callback=on_stream_text if stream_consumers else None,
+                    user_message=prompt_builder.build_user_message_for_history(messages_to_process, overflow_note)
                 )
+            if streamer:
+                await streamer.finish() # 残りのテキストを表示しきる
 
             if response_text is None: # Noneが返ってきたらエラーと判断
+                if voice_pipeline:
+                    voice_pipeline.cancel()
                 log_error("PROCESS", f"CH[{target_channel.name}] AIからの応答取得に失敗しました。")
                 # 必要であればユーザーにエラーメッセージを送信
                 # await target_channel.send("> SYSTEM: AI応答の取得に失敗しました。")
                 return # エラー時はここで終了
 
+            # 応答と一緒に履歴へ追加済みなので、処理済み未読メッセージをクリア
+            if unread_batch:
+                self.unread_data.commit(unread_batch)
+                unread_batch = None
+                data_manager.mark_dirty('unread')
+                log_info("UNREAD", f"CH[{channel_id}] の処理済み未読メッセージ {len(messages_to_process)}件 をクリアしました。")
+
             # --- 応答送信処理 (音声合成含む) ---
-            voice_cog = self.bot.get_cog("VoiceCog")
             audio_file = None
             text_for_emotion = response_text # デフォルトはそのまま
+            # テキストを先に送り、音声は後から別メッセージで送るか
+            text_sent = streamer is not None
+            if voice_enabled and not text_sent and config.VOICE_SEND_TEXT_FIRST:
+                await send_splittable_message(target_channel, response_text)
+                text_sent = True
 
-            if voice_cog and voice_cog.is_voice_mode_enabled(channel_id):
+            if voice_enabled:
                 log_info("VOICE", f"CH[{target_channel.name}]で音声合成を実行します。")
                 try:
                     # synthesize_speech_with_styles がNoneを返す可能性も考慮
-                    result = await voice_synthesizer.synthesize_speech_with_styles(response_text)
+                    if voice_pipeline:
+                        result = await voice_pipeline.finish()
+                    else:
+                        result = await voice_synthesizer.synthesize_speech_with_styles(response_text)
                     if result:
                         clean_text, audio_data = result
                         if audio_data:
-                            audio_file = discord.File(audio_data, filename="voice.wav")
+                            audio_file = discord.File(audio_data, filename=getattr(audio_data, "name", "voice.wav"))
                         text_for_emotion = clean_text # スタイルタグ除去後のテキスト
                     else:
                          log_error("VOICE", f"CH[{target_channel.name}] 音声合成に失敗しました (synthesize_speech_with_stylesがNoneを返しました)。")
@@ -191,23 +318,21 @@ class ChatManagerCog(commands.Cog, name="ChatManagerCog"):
                     log_error("VOICE", f"CH[{target_channel.name}] 音声合成中にエラーが発生しました: {e}")
                     # 音声合成失敗時はテキストのみ送信
 
-            await send_splittable_message(target_channel, response_text, file=audio_file)
+            if text_sent:
+                # テキストは表示済みなので、音声だけを続けて送る
+                if audio_file:
+                    await target_channel.send(file=audio_file)
+            else:
+                await send_splittable_message(target_channel, response_text, file=audio_file)
             log_success("PROCESS", f"CH[{target_channel.name}] に応答しました。")
             # ---------------------------------
 
             # 感情更新
             emotion_cog = self.bot.get_cog('EmotionCog')
             if emotion_cog:
-                user_input = "\n".join(f"[{m['author']}]: {m['content']}" for m in messages_to_process) if messages_to_process else ""
-                try:
-                    await emotion_cog.update_emotions(text_for_emotion, user_input)
-                except Exception as e:
-                    log_error("EMOTION", f"感情更新中にエラーが発生しました: {e}")
-
-            # 処理済み未読メッセージをクリア
-            if messages_to_process:
-                self.unread_data[str_channel_id] = []
-                log_info("UNREAD", f"CH[{channel_id}] の未読メッセージをクリアしました。")
+                user_input = "\n".join(f"[{m.author}]: {m.content}" for m in messages_to_process) if messages_to_process else ""
+                # 分析は他の対話とまとめてバックグラウンドで行い、チャンネルはすぐに解放する
+                emotion_cog.queue_analysis(text_for_emotion, user_input)
 
 
         except Exception as e: # 包括的なエラーハンドリング
@@ -215,6 +340,9 @@ class ChatManagerCog(commands.Cog, name="ChatManagerCog"):
              # traceback.print_exc() # 詳細なトレースバックが必要な場合
 
         finally:
+            # 応答できなかった未読メッセージは次回の処理に残す
+            if unread_batch:
+                self.unread_data.release(unread_batch)
             # --- 確実に処理中セットから削除 ---
             if str_channel_id in self.processing_channels:
                 self.processing_channels.remove(str_channel_id)
@@ -275,5 +403,10 @@ class ChatManagerCog(commands.Cog, name="ChatManagerCog"):
     async def before_activity_loop(self):
         await self.bot.wait_until_ready()
 
+    def cog_unload(self):
+        self.activity_loop.cancel()
+        for task in self.running_tasks.values():
+            task.cancel()
+
 async def setup(bot):
     await bot.add_cog(ChatManagerCog(bot))
\ No newline at end of file
@@ -4,10 +4,13 @@ import json
 import io
 from datetime import datetime
 
-from utils import ai_request_handler, data_manager
+from utils import ai_request_handler, client_pool, context_cache, data_manager, memory_extractor, voice_cache
 from utils.console_display import log_info, log_success, log_error
 import utils.config_manager as config
 
+# Discord の Embed 1つあたりのフィールド数の上限
+EMBED_MAX_FIELDS = 25
+
 class CommandCog(commands.Cog, name="CommandCog"):
     def __init__(self, bot):
         self.bot = bot
@@ -32,7 +35,9 @@ class CommandCog(commands.Cog, name="CommandCog"):
         embed.add_field(name=f"**{p}memory (mem)**", value=f"`{p}mem <add|list|del|reset>`\n記憶を操作", inline=False)
         embed.add_field(name=f"**{p}unread (ur)**", value=f"`{p}ur <pop|reset|reload>`\n未読メッセージを操作", inline=False)
         embed.add_field(name=f"**{p}chat <on|off>**", value="常時会話モードのON/OFF", inline=False)
-        embed.add_field(name=f"**{p}key <1|2|3>**", value="使用するAPIキーを変更", inline=False)
+        embed.add_field(name=f"**{p}stream <on|off>**", value="応答のストリーミング表示のON/OFF", inline=False)
+        embed.add_field(name=f"**{p}reactive <on|off>**", value="メッセージを受信したらすぐ応答するモードのON/OFF", inline=False)
+        embed.add_field(name=f"**{p}key <1|2|3|reload>**", value="使用するAPIキーを変更 / .env から読み直し", inline=False)
         embed.add_field(name=f"**{p}check (c) <キャラ名>**", value="指定キャラの応答処理を即時実行", inline=False)
         
         await ctx.send(embed=embed)
@@ -52,18 +57,40 @@ class CommandCog(commands.Cog, name="CommandCog"):
         if chat_cog:
             embed.add_field(name="🕒 現在の行動", value=f"{chat_cog.current_action}", inline=True)
 
+        # 2. 感情パラメータ (1つの Embed のフィールドは25個までなので、溢れた分は続きの Embed に入れる)
+        embeds = [embed]
         embed.add_field(name="--- 感情パラメータ ---", value="", inline=False)
+        current_emotions = emotion_cog.get_current_emotions()
         for name, (emoji, ja_name) in emotion_cog.emotion_map.items():
-            value = emotion_cog.current_emotions.get(name, 0)
-            embed.add_field(name=f"{emoji} {ja_name}", value=f"**{value}** / 500", inline=True)
-        
-        await ctx.send(embed=embed)
+            if len(embeds[-1].fields) >= EMBED_MAX_FIELDS:
+                embeds.append(discord.Embed(title="総合状態モニター (続き)", color=0xffa500))
+            value = current_emotions.get(name, 0)
+            embeds[-1].add_field(name=f"{emoji} {ja_name}", value=f"**{value}** / 500", inline=True)
+
+        # 3. 各処理の統計は別の Embed にまとめる
+        system_embed = discord.Embed(title="システム状態", color=0x808080)
+        key_lines = ai_request_handler.key_scheduler.describe()
+        if key_lines:
+            system_embed.add_field(name="🔑 APIキー状態", value="\n".join(key_lines), inline=False)
+        system_embed.add_field(name="🗃️ コンテキストキャッシュ", value=context_cache.describe(), inline=False)
+        system_embed.add_field(name="🔊 音声キャッシュ", value=voice_cache.describe(), inline=False)
+        system_embed.add_field(name="📨 未読メッセージ", value=data_manager.get_data('unread').describe(), inline=False)
+        mem_cog = self.bot.get_cog("MemoryCog")
+        if mem_cog:
+            system_embed.add_field(name="📚 記憶インデックス", value=mem_cog.index.describe(), inline=False)
+        system_embed.add_field(name="📝 記憶の自動抽出", value=memory_extractor.describe(), inline=False)
+        if config.EMOTION_ANALYSIS_MODE in ("local", "hybrid"):
+            system_embed.add_field(name="🧪 ローカル感情分析", value=f"モード: {config.EMOTION_ANALYSIS_MODE} / {emotion_cog.scorer.describe()}", inline=False)
+        embeds.append(system_embed)
+
+        await ctx.send(embeds=embeds)
 
     @commands.command(name="save", aliases=["s"])
     async def save_data(self, ctx):
         """現在の全てのデータをファイルに保存します。"""
         try:
-            data_manager.save_all_data()
+            data_manager.save_all_data(force=True)
+            await data_manager.flush()
             log_success("COMMAND", "全データの保存に成功しました。")
             await ctx.send("> SYSTEM: 全てのデータをファイルに保存しました。")
         except Exception as e:
@@ -78,6 +105,7 @@ class CommandCog(commands.Cog, name="CommandCog"):
 
     @history_group.command(name="reload", aliases=["rl"])
     async def history_reload(self, ctx):
+        await data_manager.flush() # 書き込み待ちのジャーナルを反映してから読み直す
         if data_manager.reload_data('history'):
             await ctx.send("> SYSTEM: 履歴ファイルを再読み込みしました。")
         else:
@@ -117,8 +145,10 @@ class CommandCog(commands.Cog, name="CommandCog"):
 
     @persona_group.command(name="apply", aliases=["ap"])
     async def persona_apply(self, ctx):
-        ai_request_handler.apply_persona_to_channel(ctx.channel.id)
-        await ctx.send(f"> SYSTEM: チャンネル `{ctx.channel.name}` の履歴にペルソナを適用しました。")
+        if ai_request_handler.apply_persona_to_channel(ctx.channel.id):
+            await ctx.send(f"> SYSTEM: チャンネル `{ctx.channel.name}` の履歴にペルソナを適用しました。")
+        else:
+            await ctx.send("> SYSTEM: エラー: ペルソナを適用できませんでした。")
 
     # ■■■ Emotion Commands ■■■
     @commands.group(name="emotion", aliases=["emo"], invoke_without_command=True)
@@ -129,6 +159,7 @@ class CommandCog(commands.Cog, name="CommandCog"):
     async def emotion_reload(self, ctx):
         """emotion.jsonを再読み込みし、Botの感情定義を更新します。"""
         emo_cog = self.bot.get_cog("EmotionCog")
+        await data_manager.flush()
         if emo_cog and emo_cog.reload_data():
             await ctx.send("> SYSTEM: 感情ファイルを再読み込みし、設定を更新しました。")
         else:
@@ -215,7 +246,7 @@ class CommandCog(commands.Cog, name="CommandCog"):
         
         popped = chat_cog.pop_unread_message(ctx.channel.id)
         if popped:
-            await ctx.send(f"> SYSTEM: 以下の未読メッセージを削除しました:\n`{popped['author']}: {popped['content']}`")
+            await ctx.send(f"> SYSTEM: 以下の未読メッセージを削除しました:\n`{popped.author}: {popped.content}`")
         else:
             await ctx.send("> SYSTEM: このチャンネルに未読メッセージはありません。")
 
@@ -230,9 +261,14 @@ class CommandCog(commands.Cog, name="CommandCog"):
     @unread_group.command(name="reload", aliases=["rl"])
     async def unread_reload(self, ctx):
         """unread_messages.jsonを再読み込みします。"""
+        chat_cog = self.bot.get_cog("ChatManagerCog")
+        await data_manager.flush()
+        # 処理中のバッチは古いキューに commit されるため、差し替えると応答済みのメッセージが残ってしまう
+        # (flush の後は再読み込みまで await しないので、この間に新しいバッチは作られない)
+        if data_manager.get_data('unread').has_sealed_batches():
+            return await ctx.send("> SYSTEM: 応答処理中のチャンネルがあるため、未読メッセージを再読み込みできません。しばらくしてから再度実行してください。")
         if data_manager.reload_data('unread'):
             # ChatCog内部のデータ参照を、再読み込みされた新しいデータに更新する
-            chat_cog = self.bot.get_cog("ChatManagerCog")
             if chat_cog:
                 chat_cog.unread_data = data_manager.get_data('unread')
             await ctx.send("> SYSTEM: 未読メッセージファイルを再読み込みしました。")
@@ -248,22 +284,66 @@ class CommandCog(commands.Cog, name="CommandCog"):
     @chat_group.command(name="on")
     async def chat_on(self, ctx):
         self.channel_settings.setdefault(str(ctx.channel.id), {})['chat_mode'] = True
+        data_manager.mark_dirty('setting')
         await ctx.send("> SYSTEM: チャットモードを **ON** にしました。")
 
     @chat_group.command(name="off")
     async def chat_off(self, ctx):
         self.channel_settings.setdefault(str(ctx.channel.id), {})['chat_mode'] = False
+        data_manager.mark_dirty('setting')
         await ctx.send("> SYSTEM: チャットモードを **OFF** にしました。")
 
-    @commands.command(name="key", aliases=["k"])
+    @commands.group(name="stream", invoke_without_command=True)
+    async def stream_group(self, ctx):
+        enabled = self.channel_settings.get(str(ctx.channel.id), {}).get('stream_mode', config.STREAM_MODE_DEFAULT)
+        await ctx.send(f"> SYSTEM: 現在のストリーミング表示は **{'ON' if enabled else 'OFF'}** です。")
+
+    @stream_group.command(name="on")
+    async def stream_on(self, ctx):
+        self.channel_settings.setdefault(str(ctx.channel.id), {})['stream_mode'] = True
+        data_manager.mark_dirty('setting')
+        await ctx.send("> SYSTEM: ストリーミング表示を **ON** にしました。")
+
+    @stream_group.command(name="off")
+    async def stream_off(self, ctx):
+        self.channel_settings.setdefault(str(ctx.channel.id), {})['stream_mode'] = False
+        data_manager.mark_dirty('setting')
+        await ctx.send("> SYSTEM: ストリーミング表示を **OFF** にしました。")
+
+    @commands.group(name="reactive", invoke_without_command=True)
+    async def reactive_group(self, ctx):
+        enabled = self.channel_settings.get(str(ctx.channel.id), {}).get('reactive_mode', config.REACTIVE_MODE_DEFAULT)
+        await ctx.send(f"> SYSTEM: 現在のリアクティブモードは **{'ON' if enabled else 'OFF'}** です。")
+
+    @reactive_group.command(name="on")
+    async def reactive_on(self, ctx):
+        self.channel_settings.setdefault(str(ctx.channel.id), {})['reactive_mode'] = True
+        data_manager.mark_dirty('setting')
+        await ctx.send("> SYSTEM: リアクティブモードを **ON** にしました。")
+
+    @reactive_group.command(name="off")
+    async def reactive_off(self, ctx):
+        self.channel_settings.setdefault(str(ctx.channel.id), {})['reactive_mode'] = False
+        data_manager.mark_dirty('setting')
+        await ctx.send("> SYSTEM: リアクティブモードを **OFF** にしました。")
+
+    @commands.group(name="key", aliases=["k"], invoke_without_command=True)
     async def set_key(self, ctx, key_number: int):
-        num_keys = len(ai_request_handler.API_KEYS)
+        num_keys = len(client_pool.get_api_keys())
         if 1 <= key_number <= num_keys:
             ai_request_handler.set_active_key_number(key_number)
             await ctx.send(f"> SYSTEM: APIキーを **{key_number}番** に切り替えました。")
         else:
             await ctx.send(f"> SYSTEM: キー番号は1から{num_keys}の間で指定してください。")
 
+    @set_key.command(name="reload", aliases=["rl"])
+    async def key_reload(self, ctx):
+        """.env からAPIキーを読み直します (追加・変更・削除されたキーを反映)。"""
+        if ai_request_handler.reload_api_keys():
+            await ctx.send(f"> SYSTEM: APIキーを読み直しました。(キー数: {len(client_pool.get_api_keys())})")
+        else:
+            await ctx.send("> SYSTEM: APIキーに変更はありませんでした。")
+
     @commands.command(name="check", aliases=["c"])
     async def check_messages(self, ctx, character_name: str):
         """
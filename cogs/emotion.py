@@ -1,10 +1,15 @@
 import json
 import random
+import asyncio
+from collections import deque
 from discord.ext import commands
 
 import utils.config_manager as config
-from utils import ai_request_handler, data_manager, prompt_builder
-from utils.console_display import log_error, log_info, log_success
+from utils import ai_request_handler, data_manager, prompt_builder, emotion_scorer, emotion_dynamics
+from utils.console_display import log_error, log_info, log_success, log_warning
+
+# 1回の対話で反映する感情の変化量の上限 (emotion.txt の指示と同じ範囲)
+EMOTION_DELTA_LIMIT = 50
 
 class EmotionCog(commands.Cog, name="EmotionCog"):
     def __init__(self, bot):
@@ -12,96 +17,214 @@ class EmotionCog(commands.Cog, name="EmotionCog"):
         log_info("EMOTION", "感情コアの初期化を開始します...")
         
         # ★ 修正: data_managerから直接データを取得
-        emotion_data = data_manager.get_data('emotion')
-        self.emotion_map = emotion_data.get('emotion_map', {})
-        self.default_emotions = emotion_data.get('default_emotions', {})
-        self.current_emotions = emotion_data.get('current_emotions', self.default_emotions.copy())
+        self._bind_emotion_data(data_manager.get_data('emotion'))
+        self.analyzer_persona = self._load_analyzer_persona()
+        self.generation_config = self._build_generation_config()
+        self.scorer = emotion_scorer.create_scorer(self.emotion_map)
+        self.exchanges_since_calibration = 0
+
+        # 感情分析待ちの (ユーザーの発言, AIの応答) と、それを処理するタスク
+        self.pending_exchanges = deque()
+        self.analysis_task = None
         
         log_success("EMOTION", "感情コアの準備が完了しました。")
 
     def reload_data(self):
         """data_managerによってリロードされた最新の感情データをCogに反映させる"""
         if data_manager.reload_data('emotion'):
-            emotion_data = data_manager.get_data('emotion')
-            self.emotion_map = emotion_data.get('emotion_map', {})
-            self.default_emotions = emotion_data.get('default_emotions', {})
-            self.current_emotions = emotion_data.get('current_emotions', self.default_emotions.copy())
+            self._bind_emotion_data(data_manager.get_data('emotion'))
             current_keys = set(self.current_emotions.keys())
             new_valid_keys = set(self.emotion_map.keys())
             for key in current_keys - new_valid_keys:
                 del self.current_emotions[key]
+            self.analyzer_persona = self._load_analyzer_persona()
+            self.generation_config = self._build_generation_config()
+            self.scorer = emotion_scorer.create_scorer(self.emotion_map)
             log_success("EMOTION", "Cog内の感情データを正常にリロードしました。")
             return True
         return False
 
+    def _bind_emotion_data(self, emotion_data: dict):
+        """
+        感情データを Cog に結び付ける。
+        current_emotions は updated_at の時点の値 (アンカー) で、現在の値は get_current_emotions で求める。
+        """
+        self.emotion_data = emotion_data
+        self.emotion_map = emotion_data.get('emotion_map', {})
+        self.default_emotions = emotion_data.get('default_emotions', {})
+        self.current_emotions = emotion_data.setdefault('current_emotions', self.default_emotions.copy())
+        self.decay_half_lives = emotion_data.get('decay_half_lives', {}) # 感情ごとの半減期 (秒, 任意)
+        # 減衰を導入する前のデータには時刻がないため、読み込んだ時点から減衰させる
+        emotion_data.setdefault('updated_at', emotion_dynamics.now())
+
+    def _values_at(self, now: float) -> dict:
+        elapsed = now - self.emotion_data.get('updated_at', now)
+        return emotion_dynamics.decayed_values(self.current_emotions, self.default_emotions, elapsed, self.decay_half_lives)
+
+    def _settle(self):
+        """減衰させた現在の値をアンカーとして確定させる (値を変更する前に呼ぶ)"""
+        now = emotion_dynamics.now()
+        self.current_emotions.update({name: round(value, 2) for name, value in self._values_at(now).items()})
+        self.emotion_data['updated_at'] = now
+
     def get_current_emotions(self) -> dict:
-        # ★ 修正: コピーではなく、メモリ上のデータへの参照を直接返す
-        return self.current_emotions
+        """既定値への減衰を反映した現在の感情 (整数) を返す。返した辞書を変更しても感情は変わらない"""
+        return {name: round(value) for name, value in self._values_at(emotion_dynamics.now()).items()}
     
     def get_emotion_map(self) -> dict:
         return self.emotion_map
 
-    async def update_emotions(self, bot_response: str, user_input: str = ""):
-        log_info("EMOTION", "対話の感情分析を開始...")
-        
+    def _load_analyzer_persona(self) -> str:
+        """感情分析ペルソナ (emotion.txt) を読み込む。リクエストのたびには読まずにメモリに保持する"""
         try:
             with open(config.EMOTION_ANALYZER_PERSONA_FILE, 'r', encoding='utf-8') as f:
-                emotion_persona = f.read()
+                return f.read()
         except FileNotFoundError:
             log_error("EMOTION", f"感情分析ペルソナ '{config.EMOTION_ANALYZER_PERSONA_FILE}' が見つかりません。")
-            emotion_persona = "あなたは、ユーザーとAIの対話を分析する心理学者です。"
+            return "あなたは、ユーザーとAIの対話を分析する心理学者です。"
+
+    def _build_generation_config(self) -> dict:
+        """対話ごとの感情の変化量を JSON で返させる構造化出力の設定"""
+        deltas_schema = {"type": "OBJECT", "properties": {name: {"type": "INTEGER"} for name in self.emotion_map}}
+        return {
+            "response_mime_type": "application/json",
+            "response_schema": {
+                "type": "ARRAY",
+                "items": {
+                    "type": "OBJECT",
+                    "properties": {"id": {"type": "INTEGER"}, "deltas": deltas_schema},
+                    "required": ["id", "deltas"],
+                },
+            },
+        }
+
+    def _apply_deltas(self, deltas: dict) -> dict:
+        """変化量を上限内に収めて現在の感情に加え、実際に加えた変化量を返す"""
+        applied = {}
+        self._settle()
+        for emotion, delta in deltas.items():
+            if emotion in self.current_emotions and isinstance(delta, (int, float)):
+                delta = max(-EMOTION_DELTA_LIMIT, min(EMOTION_DELTA_LIMIT, int(delta)))
+                self.current_emotions[emotion] = max(0, min(500, self.current_emotions[emotion] + delta))
+                applied[emotion] = delta
+        if applied:
+            data_manager.mark_dirty('emotion')
+        return applied
 
-        # ★ 修正: prompt_builderを使用してプロンプトを生成
-        prompt = prompt_builder.build_emotion_analysis_prompt(
-            self.emotion_map, emotion_persona, user_input, bot_response
+    def queue_analysis(self, bot_response: str, user_input: str = ""):
+        """
+        対話の感情分析を行う (応答処理は分析の完了を待たない)。
+        EMOTION_ANALYSIS_MODE に応じて、ローカルの辞書で即座に反映するか、LLM の待ち行列に追加する。
+          "llm"   : 少し待ってから、他のチャンネルの対話とまとめて1回のリクエストで分析する
+          "local" : ローカルの辞書だけを使う (APIを呼ばない)
+          "hybrid": ローカルの辞書で即座に反映し、手がかり語がなかった対話と、
+                    EMOTION_CALIBRATION_INTERVAL 件ごとの対話 (倍率の補正用) だけを LLM で分析する
+        """
+        mode = config.EMOTION_ANALYSIS_MODE
+        local_deltas, raw = {}, None
+        if mode in ("local", "hybrid"):
+            raw = self.scorer.score_raw(user_input, bot_response)
+            local_deltas = self._apply_deltas(self.scorer.to_deltas(raw, EMOTION_DELTA_LIMIT))
+            if local_deltas:
+                log_success("EMOTION", f"ローカルの分析で感情データを更新しました: {local_deltas}")
+            if mode == "local":
+                return
+            self.exchanges_since_calibration += 1
+            calibrating = self.exchanges_since_calibration >= config.EMOTION_CALIBRATION_INTERVAL
+            if local_deltas and not calibrating:
+                return
+            if calibrating:
+                self.exchanges_since_calibration = 0
+
+        if len(self.pending_exchanges) >= config.EMOTION_MAX_PENDING_EXCHANGES:
+            self.pending_exchanges.popleft()
+            log_warning("EMOTION", "感情分析待ちの対話が上限を超えたため、最も古いものを破棄しました。")
+        self.pending_exchanges.append((user_input, bot_response, local_deltas, raw))
+        if self.analysis_task is None or self.analysis_task.done():
+            self.analysis_task = asyncio.get_running_loop().create_task(self._analysis_worker())
+
+    async def _analysis_worker(self):
+        while self.pending_exchanges:
+            # 続けて届く対話をまとめるために少し待つ
+            await asyncio.sleep(config.EMOTION_BATCH_WINDOW_SECONDS)
+            batch_size = min(len(self.pending_exchanges), config.EMOTION_BATCH_MAX_EXCHANGES)
+            exchanges = [self.pending_exchanges.popleft() for _ in range(batch_size)]
+            try:
+                await self.analyze_exchanges(exchanges)
+            except Exception as e:
+                log_error("EMOTION", f"感情更新中に予期せぬエラーが発生: {type(e).__name__} - {e}")
+
+    async def analyze_exchanges(self, exchanges: list[tuple]):
+        """
+        (ユーザーの発言, AIの応答, ローカルで反映済みの変化量, ローカルの補正前の変化量) のリストを
+        1回のリクエストで分析し、LLM の変化量とローカルで反映済みの分の差を順に反映する。
+        """
+        log_info("EMOTION", f"対話 {len(exchanges)}件 の感情分析を開始...")
+        prompt = prompt_builder.build_emotion_batch_prompt(
+            self.emotion_map, self.analyzer_persona, [(user_input, bot_response) for user_input, bot_response, *_ in exchanges]
         )
-        
-        # 会話履歴に影響しないよう channel_id=None でリクエスト
-        response_text = await ai_request_handler.send_request(config.MODEL_FLASH, prompt, channel_id=None)
-        # response_text = None
 
+        # 会話履歴に影響しないよう channel_id=None でリクエスト
+        response_text = await ai_request_handler.send_request(
+            config.EMOTION_ANALYSIS_MODEL, prompt, channel_id=None, generation_config=self.generation_config
+        )
         if not response_text:
             log_error("EMOTION", "AIからの応答がありませんでした。")
             return
 
         try:
             json_text = response_text.strip().replace('```json', '').replace('```', '')
-            emotion_deltas = json.loads(json_text)
-            
-            for emotion, delta in emotion_deltas.items():
-                if emotion in self.current_emotions and isinstance(delta, (int, float)):
-                    current_value = self.current_emotions[emotion]
-                    new_value = current_value + int(delta)
-                    self.current_emotions[emotion] = max(0, min(500, new_value))
-            
-            # ★ _save_state() の呼び出しを削除
-            log_success("EMOTION", f"メモリ上の感情データを更新しました: {emotion_deltas}")
-
+            results = json.loads(json_text)
+            if isinstance(results, dict):
+                results = [{"id": 1, "deltas": results}] # 構造化出力に従わなかった場合は全体の変化量とみなす
+            results = [r for r in results if isinstance(r, dict) and isinstance(r.get("id"), int) and isinstance(r.get("deltas"), dict)]
+            results.sort(key=lambda r: r["id"]) # 対話の順に反映する
         except (json.JSONDecodeError, TypeError):
             log_error("EMOTION", f"AIからの返答が不正なJSON形式でした: {response_text}")
-        except Exception as e:
-            log_error("EMOTION", f"感情更新中に予期せぬエラーが発生: {e}")
+            return
+
+        total_deltas = {}
+        for result in results:
+            if not 1 <= result["id"] <= len(exchanges):
+                continue
+            _, _, local_deltas, raw = exchanges[result["id"] - 1]
+            llm_deltas = {e: d for e, d in result["deltas"].items() if isinstance(d, (int, float))}
+            if raw is not None:
+                self.scorer.calibrate(raw, llm_deltas)
+            # ローカルの分析で反映済みの分は差し引く
+            correction = {e: llm_deltas.get(e, 0) - local_deltas.get(e, 0) for e in llm_deltas.keys() | local_deltas.keys()}
+            for emotion, delta in self._apply_deltas(correction).items():
+                total_deltas[emotion] = total_deltas.get(emotion, 0) + delta
+
+        log_success("EMOTION", f"メモリ上の感情データを更新しました (対話 {len(exchanges)}件): {total_deltas}")
 
     def reset_emotions(self):
         """メモリ上の感情データをデフォルト値にリセットします。"""
         self.current_emotions.clear()
         self.current_emotions.update(self.default_emotions.copy())
-        # ★ _save_state() の呼び出しを削除
+        self.emotion_data['updated_at'] = emotion_dynamics.now()
+        data_manager.mark_dirty('emotion')
         log_success("EMOTION", "メモリ上の感情データがリセットされました。")
 
     def set_emotion_value(self, name: str, value: int):
         """指定された感情の値をメモリ上で設定します。"""
         if name in self.current_emotions:
+            self._settle()
             self.current_emotions[name] = value
-            # ★ _save_state() の呼び出しを削除
+            data_manager.mark_dirty('emotion')
             log_info("EMOTION", f"メモリ上の感情 '{name}' が {value} に設定されました。")
 
     def randomize_emotions(self):
         """メモリ上の全ての感情をランダムな値に設定します。"""
+        self._settle()
         for emotion_name in self.current_emotions.keys():
             self.current_emotions[emotion_name] = random.randint(0, 500)
-        # ★ _save_state() の呼び出しを削除
+        data_manager.mark_dirty('emotion')
         log_success("EMOTION", "メモリ上の全ての感情がランダムな値に更新されました。")
 
+    def cog_unload(self):
+        if self.analysis_task is not None:
+            self.analysis_task.cancel()
+
 async def setup(bot):
     await bot.add_cog(EmotionCog(bot))
\ No newline at end of file
@@ -1,7 +1,9 @@
-from discord.ext import commands
+from discord.ext import commands, tasks
 
-from utils.console_display import log_success
-from utils import data_manager
+import utils.config_manager as config
+from utils.console_display import log_success, log_error
+from utils import data_manager, memory_extractor
+from utils.memory_index import MemoryIndex
 
 class MemoryCog(commands.Cog, name="MemoryCog"):
     def __init__(self, bot):
@@ -9,26 +11,58 @@ class MemoryCog(commands.Cog, name="MemoryCog"):
         
         # ★ 修正: 'memory'キーから直接メモリデータを取得
         self.memories = data_manager.get_data('memory')
+        self.index = MemoryIndex(self.memories)
         
         log_success("MEMORY", f"{len(self.memories)}件の記憶を読み込みました。")
+        if config.MEMORY_EXTRACTION_ENABLED:
+            self.extraction_loop.start()
 
     def add_memory(self, memory_text: str):
         self.memories.append(memory_text)
+        self.index.add(memory_text)
+        data_manager.mark_dirty('memory')
         log_success("MEMORY", f"新しい記憶をメモリに追加: {memory_text}")
 
     def get_memories(self) -> list:
         return self.memories
-    
+
+    def select_memories(self, query: str | None) -> list:
+        """プロンプトに含める、query (応答するメッセージ) に関係の深い記憶を選ぶ"""
+        return self.index.select(query, config.MEMORY_RETRIEVAL_TOP_K, config.MEMORY_RETRIEVAL_TOKEN_BUDGET)
+
+    def find_duplicate(self, memory_text: str) -> str | None:
+        """既存の記憶のうち、memory_text とほぼ同じ内容のものを返す"""
+        return self.index.find_similar(memory_text, config.MEMORY_DUPLICATE_THRESHOLD)
+
     def delete_memory(self, index: int): 
         if 0 <= index < len(self.memories):
             removed_memory = self.memories.pop(index)
+            self.index.remove(index)
+            data_manager.mark_dirty('memory')
             log_success("MEMORY", f"記憶 No.{index+1} をメモリから削除しました。")
             return removed_memory
         return None
 
     def reset_memories(self):
         self.memories.clear()
+        self.index.clear()
+        data_manager.mark_dirty('memory')
         log_success("MEMORY", "メモリ上の記憶データがリセットされました。")
 
+    @tasks.loop(seconds=config.MEMORY_EXTRACTION_INTERVAL_SECONDS)
+    async def extraction_loop(self):
+        """溜まった会話から記憶を抽出する (応答処理とは独立して低優先度で行う)"""
+        try:
+            await memory_extractor.run_pending(self)
+        except Exception as e:
+            log_error("MEMORY_EXTRACT", f"記憶抽出ループでエラーが発生: {type(e).__name__} - {e}")
+
+    @extraction_loop.before_loop
+    async def before_extraction_loop(self):
+        await self.bot.wait_until_ready()
+
+    def cog_unload(self):
+        self.extraction_loop.cancel()
+
 async def setup(bot):
     await bot.add_cog(MemoryCog(bot))
\ No newline at end of file
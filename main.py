@@ -55,6 +55,11 @@ async def main():
     from utils import ai_request_handler
     ai_request_handler.initialize_histories()
 
+    # Geminiクライアントプールを起動時に構築 (チャンネル・感情分析で共有)
+    from utils import client_pool
+    client_pool.initialize([config_manager.MODEL_PRO, config_manager.MODEL_FLASH])
+    ai_request_handler.initialize_key_scheduler()
+
     await load_cogs()
     log_success("SYSTEM", "全モジュールのロード完了")
     
@@ -63,6 +68,12 @@ async def main():
     finally:
         log_system("シャットダウン処理を実行します...")
         data_manager.save_all_data()
+        await data_manager.flush()
+        from utils import persistence_writer
+        persistence_writer.shutdown()
+        data_manager.get_history_backend().close()
+        from utils import voice_synthesizer
+        await voice_synthesizer.close_session()
 
 if __name__ == '__main__':
     try:
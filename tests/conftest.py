@@ -0,0 +1,10 @@
+# conftest.py
+#
+# テストはリポジトリのルートから utils をインポートする (benchmarks/harness.py と同じ)。
+
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
@@ -0,0 +1,59 @@
+# test_channel_scheduler.py
+#
+# チャンネルごとの予定を管理するヒープ。
+
+from utils.channel_scheduler import ChannelScheduler
+
+def test_pop_due_returns_earliest_due_channel():
+    scheduler = ChannelScheduler()
+    scheduler.plan("a", 30.0)
+    scheduler.plan("b", 10.0)
+    scheduler.plan("c", 20.0)
+    assert scheduler.pop_due(5.0) is None
+    assert scheduler.pop_due(25.0) == "b"
+    assert scheduler.pop_due(25.0) == "c"
+    assert scheduler.pop_due(25.0) is None
+    assert len(scheduler) == 1 and "a" in scheduler
+
+def test_replan_ignores_stale_entry():
+    scheduler = ChannelScheduler()
+    scheduler.plan("a", 10.0)
+    scheduler.plan("a", 50.0)
+    assert scheduler.get_due("a") == 50.0
+    assert scheduler.pop_due(20.0) is None
+    assert scheduler.seconds_until_next(20.0) == 30.0
+    assert scheduler.pop_due(50.0) == "a"
+    assert len(scheduler) == 0
+
+def test_only_if_earlier():
+    scheduler = ChannelScheduler()
+    scheduler.plan("a", 10.0)
+    assert not scheduler.plan("a", 20.0, only_if_earlier=True)
+    assert scheduler.get_due("a") == 10.0
+    assert scheduler.plan("a", 5.0, only_if_earlier=True)
+    assert scheduler.get_due("a") == 5.0
+
+def test_cancel():
+    scheduler = ChannelScheduler()
+    scheduler.plan("a", 10.0)
+    scheduler.plan("b", 20.0)
+    scheduler.cancel("a")
+    assert "a" not in scheduler
+    assert scheduler.seconds_until_next(0.0) == 20.0
+    assert scheduler.pop_due(100.0) == "b"
+    assert scheduler.seconds_until_next(0.0) is None
+
+def test_heap_is_rebuilt_when_stale_entries_pile_up():
+    scheduler = ChannelScheduler()
+    for i in range(1000):
+        scheduler.plan("a", float(i))
+    assert len(scheduler._heap) <= 4 * len(scheduler) + 64
+    assert scheduler.items() == [("a", 999.0)]
+    assert scheduler.pop_due(999.0) == "a"
+
+def test_items_sorted_by_due():
+    scheduler = ChannelScheduler()
+    scheduler.plan("a", 3.0)
+    scheduler.plan("b", 1.0)
+    scheduler.plan("c", 2.0)
+    assert [ch for ch, _ in scheduler.items()] == ["b", "c", "a"]
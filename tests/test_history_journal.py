@@ -0,0 +1,56 @@
+# test_history_journal.py
+#
+# ジャーナルの再生と、再生できないジャーナルの扱い。
+
+import os
+import json
+import pytest
+import utils.config_manager as config
+from utils import history_journal
+from utils.history_journal import HistoryLoadError
+
+CH = "100"
+
+@pytest.fixture(autouse=True)
+def journal_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "HISTORY_JOURNAL_DIR", str(tmp_path))
+    monkeypatch.setattr(history_journal, "_op_counts", {})
+    return tmp_path
+
+def write_journal(journal_dir, lines: list[str]):
+    with open(os.path.join(journal_dir, f"{CH}.jsonl"), 'wb') as f:
+        f.write("".join(line + "\n" for line in lines).encode('utf-8'))
+
+def turn(text: str) -> dict:
+    return {"role": "user", "parts": [text]}
+
+def test_missing_journal_returns_none():
+    assert history_journal.load_channel(CH) is None
+
+def test_replay_applies_operations_in_order(journal_dir):
+    write_journal(journal_dir, [
+        json.dumps({"op": "reset", "turns": [turn("persona")]}),
+        json.dumps({"op": "append", "turn": turn("a")}),
+        json.dumps({"op": "append", "turn": turn("b")}),
+        json.dumps({"op": "delete", "start": 1, "stop": 2}),
+        json.dumps({"op": "set", "index": 0, "turn": turn("new persona")}),
+    ])
+    assert history_journal.load_channel(CH) == [turn("new persona"), turn("b")]
+    assert history_journal.get_op_count(CH) == 5
+
+def test_invalid_last_line_is_skipped_and_compacted(journal_dir):
+    write_journal(journal_dir, [json.dumps({"op": "append", "turn": turn("a")}), '{"op": "app'])
+    assert history_journal.load_channel(CH) == [turn("a")]
+    # 書き直されているので、次は不正な行なしで読める
+    assert history_journal.load_channel(CH) == [turn("a")]
+    assert history_journal.get_op_count(CH) == 1
+
+def test_unreadable_journal_is_moved_aside_and_raises(journal_dir):
+    write_journal(journal_dir, [json.dumps({"op": "append"})]) # turn がない
+    with pytest.raises(HistoryLoadError):
+        history_journal.load_channel(CH)
+    names = os.listdir(journal_dir)
+    assert not os.path.exists(os.path.join(journal_dir, f"{CH}.jsonl"))
+    assert any(name.startswith(f"{CH}.jsonl.corrupt-") for name in names)
+    # 退避後は「履歴がない」として新しく始められる
+    assert history_journal.load_channel(CH) is None
@@ -0,0 +1,64 @@
+# test_history_trimmer.py
+#
+# トークン予算による履歴の削除 (ローウォーターマークまでまとめて削除する)。
+
+import pytest
+import utils.config_manager as config
+from utils import history_trimmer
+
+MODEL = "test-model"
+
+@pytest.fixture(autouse=True)
+def trimmer_config(monkeypatch):
+    monkeypatch.setattr(config, "get_history_token_budget", lambda model_name: 1000)
+    monkeypatch.setattr(config, "get_max_history_length", lambda: 100)
+    monkeypatch.setattr(config, "HISTORY_TRIM_LOW_WATERMARK", 0.5)
+    monkeypatch.setattr(history_trimmer, "_calibration", {})
+    monkeypatch.setattr(history_trimmer, "_channel_totals", {})
+
+def make_history(turn_count: int, chars: int = 96) -> list:
+    # ASCII 96文字 = 24 トークン + オーバーヘッド 4 = 1ターン 28 トークン
+    history = [{"role": "user", "parts": ["persona"]}]
+    for i in range(turn_count):
+        history.append({"role": "user" if i % 2 == 0 else "model", "parts": ["x" * chars]})
+    return history
+
+def test_estimate_text_tokens():
+    assert history_trimmer.estimate_text_tokens("abcd" * 10) == 10
+    assert history_trimmer.estimate_text_tokens("あいう") == 3
+    assert history_trimmer.estimate_text_tokens("") == 0
+
+def test_no_trim_within_budget():
+    history = make_history(10)
+    assert history_trimmer.trim_to_budget("1", history, MODEL) == []
+    assert len(history) == 11
+
+def test_trim_down_to_low_watermark_in_pairs():
+    history = make_history(40) # 40 * 28 + 5 = 1125 トークン > 1000
+    original = list(history)
+    evicted = history_trimmer.trim_to_budget("1", history, MODEL)
+
+    assert history[0] is original[0] # ペルソナは残す
+    assert len(evicted) % 2 == 0
+    assert evicted == original[1:1 + len(evicted)]
+    remaining = history_trimmer.history_raw_tokens("1", history)
+    assert remaining <= 1000 * 0.5
+    # 予算の半分を下回るまで削除し、それ以上は削除しない
+    assert remaining + 2 * 28 > 1000 * 0.5
+
+def test_trim_by_message_count():
+    history = make_history(120, chars=4)
+    history_trimmer.trim_to_budget("1", history, MODEL)
+    assert len(history) <= 50
+
+def test_short_history_is_not_trimmed():
+    history = [{"role": "user", "parts": ["x" * 10000]}, {"role": "model", "parts": ["ok"]}]
+    assert history_trimmer.trim_to_budget("1", history, MODEL) == []
+    assert len(history) == 2
+
+def test_calibration_scales_estimate():
+    history = make_history(20) # 565 トークン
+    assert history_trimmer.trim_to_budget("1", history, MODEL) == []
+    history_trimmer.calibrate(MODEL, 100, 200)
+    assert history_trimmer.get_calibration(MODEL) == 2.0
+    assert history_trimmer.trim_to_budget("1", history, MODEL) != []
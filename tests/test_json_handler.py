@@ -0,0 +1,62 @@
+# test_json_handler.py
+#
+# JSON のアトミックな保存と、.bak/.meta を使った破損からの復旧。
+
+import os
+import json
+from utils.json_handler import load_json, save_json, BACKUP_SUFFIX, META_SUFFIX
+
+def read_meta(path) -> dict:
+    with open(str(path) + META_SUFFIX, encoding='utf-8') as f:
+        return json.load(f)
+
+def test_save_writes_meta_and_keeps_previous_generation(tmp_path):
+    path = str(tmp_path / "data.json")
+    save_json({"v": 1}, path)
+    assert read_meta(path)["generation"] == 1
+    assert not os.path.exists(path + BACKUP_SUFFIX)
+
+    save_json({"v": 2}, path)
+    assert read_meta(path)["generation"] == 2
+    with open(path + BACKUP_SUFFIX, encoding='utf-8') as f:
+        assert json.load(f) == {"v": 1}
+    assert load_json(path) == {"v": 2}
+    assert not os.path.exists(path + ".tmp")
+
+def test_corrupt_file_is_moved_aside_and_recovered_from_backup(tmp_path):
+    path = str(tmp_path / "data.json")
+    save_json({"v": 1}, path)
+    save_json({"v": 2}, path)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('{"v": ')
+
+    assert load_json(path) == {"v": 1}
+    assert any(name.startswith("data.json.corrupt-") for name in os.listdir(tmp_path))
+    # 復旧したファイルは次回そのまま読める
+    assert load_json(path) == {"v": 1}
+
+def test_missing_file_is_recovered_from_backup(tmp_path):
+    path = str(tmp_path / "data.json")
+    save_json({"v": 1}, path)
+    save_json({"v": 2}, path)
+    os.remove(path)
+    assert load_json(path) == {"v": 1}
+
+def test_corrupt_file_without_backup_falls_back_to_default(tmp_path):
+    path = str(tmp_path / "data.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("not json")
+    assert load_json(path, {"default": True}) == {"default": True}
+    assert load_json(path) == {"default": True}
+
+def test_missing_file_without_backup_is_initialized(tmp_path):
+    path = str(tmp_path / "data.json")
+    assert load_json(path, []) == []
+    assert os.path.exists(path)
+
+def test_manually_edited_file_is_still_loaded(tmp_path):
+    path = str(tmp_path / "data.json")
+    save_json({"v": 1}, path)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({"v": "edited"}, f)
+    assert load_json(path) == {"v": "edited"}
@@ -0,0 +1,66 @@
+# test_memory_index.py
+#
+# 記憶の BM25 インデックスによる選択と重複判定。
+
+from utils import history_trimmer
+from utils.memory_index import MemoryIndex, tokenize
+
+MEMORIES = [
+    "ユーザーの好きな食べ物はカレーライス",
+    "ユーザーは猫を二匹飼っている",
+    "ユーザーの誕生日は三月三日",
+    "ユーザーは毎朝ジョギングをしている",
+    "ユーザーはPythonでbotを作っている",
+]
+
+def test_tokenize_uses_bigrams_and_words():
+    assert tokenize("カレー") == ["カレ", "レー"]
+    assert tokenize("Hello, World") == ["hello", "world"]
+    assert tokenize("ＡＢＣ") == ["abc"] # NFKC で全角英字も同じ語になる
+
+def test_select_returns_all_when_within_limits():
+    index = MemoryIndex(MEMORIES)
+    assert index.select("カレー", top_k=10, token_budget=10000) == MEMORIES
+
+def test_single_character_query_does_not_match_bigrams():
+    # 日本語は bigram で索引するため、1文字だけのクエリはどの記憶にも一致しない
+    index = MemoryIndex(MEMORIES)
+    assert index._score("猫") == {}
+
+def test_select_ranks_relevant_memories_in_list_order():
+    index = MemoryIndex(MEMORIES)
+    assert index.select("今日のカレーは美味しかった", top_k=1, token_budget=10000) == [MEMORIES[0]]
+    selected = index.select("猫を飼いたいしカレーも食べたい", top_k=2, token_budget=10000)
+    assert selected == [MEMORIES[0], MEMORIES[1]]
+
+def test_select_fills_with_recent_memories():
+    index = MemoryIndex(MEMORIES)
+    assert index.select("猫を飼いたい", top_k=2, token_budget=10000) == [MEMORIES[1], MEMORIES[4]]
+    assert index.select(None, top_k=2, token_budget=10000) == MEMORIES[3:]
+
+def test_select_respects_token_budget():
+    index = MemoryIndex(MEMORIES)
+    budget = history_trimmer.estimate_text_tokens(MEMORIES[1]) + 1
+    selected = index.select("猫を飼いたい", top_k=3, token_budget=budget)
+    assert selected == [MEMORIES[1]]
+
+def test_remove_keeps_positions_in_sync():
+    index = MemoryIndex(MEMORIES)
+    index.remove(0)
+    assert len(index) == 4
+    assert "カレ" not in index._postings
+    assert index.select("カレー", top_k=1, token_budget=10000) == [MEMORIES[4]]
+    index.add("ユーザーはカレーが苦手になった")
+    assert index.select("カレー", top_k=1, token_budget=10000) == ["ユーザーはカレーが苦手になった"]
+
+def test_find_similar():
+    index = MemoryIndex(MEMORIES)
+    assert index.find_similar("ユーザーは猫を2匹飼っている", threshold=0.7) == MEMORIES[1]
+    assert index.find_similar("ユーザーは犬が嫌い", threshold=0.7) is None
+    assert index.find_similar(MEMORIES[2], threshold=0.99) == MEMORIES[2]
+
+def test_clear():
+    index = MemoryIndex(MEMORIES)
+    index.clear()
+    assert len(index) == 0
+    assert index.select("猫", top_k=3, token_budget=100) == []
@@ -0,0 +1,139 @@
+# test_unread_queue.py
+#
+# 未読キューの seal/commit/release と、上限を超えた場合の各処理。
+
+from utils.unread_queue import UnreadQueue, OVERFLOW_KEY
+
+CH = "100"
+
+def make_queue(max_per_channel=5, policy="drop_oldest") -> UnreadQueue:
+    return UnreadQueue(max_per_channel, policy)
+
+def contents(queue: UnreadQueue, channel_id=CH) -> list[str]:
+    return [m.content for m in queue.get_messages(channel_id)]
+
+def test_commit_removes_only_sealed_messages():
+    queue = make_queue()
+    queue.append(CH, "a", "1", "t1")
+    queue.append(CH, "b", "2", "t2")
+    batch = queue.seal(CH)
+    queue.append(CH, "a", "3", "t3") # 処理中に届いたメッセージ
+    assert queue.has_sealed_batches()
+    queue.commit(batch)
+    assert contents(queue) == ["3"]
+    assert not queue.has_sealed_batches()
+
+def test_commit_removes_empty_channel():
+    queue = make_queue()
+    queue.append(CH, "a", "1", "t1")
+    queue.commit(queue.seal(CH))
+    assert not queue.has_messages(CH)
+    assert queue.channels_with_messages() == []
+
+def test_release_keeps_messages_for_next_batch():
+    queue = make_queue()
+    queue.append(CH, "a", "1", "t1")
+    batch = queue.seal(CH)
+    queue.release(batch)
+    assert not queue.has_sealed_batches()
+    assert contents(queue) == ["1"]
+    assert [m.content for m in queue.seal(CH).messages] == ["1"]
+
+def test_pop_during_batch_shrinks_sealed_range():
+    queue = make_queue()
+    for i in range(3):
+        queue.append(CH, "a", str(i), "t")
+    batch = queue.seal(CH)
+    queue.pop_oldest(CH)
+    queue.append(CH, "b", "new", "t")
+    queue.commit(batch)
+    assert contents(queue) == ["new"]
+
+def test_drop_oldest_policy():
+    queue = make_queue(max_per_channel=3)
+    for i in range(5):
+        queue.append(CH, "a", str(i), "t")
+    assert contents(queue) == ["2", "3", "4"]
+    assert queue.stats["dropped"] == 2
+    assert queue.overflow_note(CH) is None
+
+def test_overflow_during_batch_does_not_drop_unanswered_messages():
+    queue = make_queue(max_per_channel=3)
+    for i in range(3):
+        queue.append(CH, "a", str(i), "t")
+    batch = queue.seal(CH)
+    queue.append(CH, "b", "3", "t") # 処理中のバッチの先頭が押し出される
+    queue.commit(batch)
+    assert contents(queue) == ["3"]
+    assert queue.stats["dropped"] == 0
+
+def test_overflow_during_batch_evicts_only_unsealed_messages():
+    queue = make_queue(max_per_channel=2)
+    queue.append(CH, "a", "0", "t")
+    queue.append(CH, "a", "1", "t")
+    batch = queue.seal(CH)
+    for i in range(2, 5):
+        queue.append(CH, "b", str(i), "t")
+    assert contents(queue) == ["0", "1", "3", "4"]
+    assert queue.stats["dropped"] == 1
+    queue.commit(batch)
+    assert contents(queue) == ["3", "4"]
+
+def test_release_after_overflow_keeps_failed_batch_and_enforces_limit():
+    queue = make_queue(max_per_channel=2, policy="summarize")
+    queue.append(CH, "a", "0", "t")
+    queue.append(CH, "a", "1", "t")
+    batch = queue.seal(CH)
+    queue.append(CH, "b", "2", "t")
+    queue.append(CH, "b", "3", "t")
+    assert queue.overflow_note(CH) is None # 処理中のバッチは上限の対象外
+    queue.release(batch)
+    # 応答できなかったメッセージは黙って消えず、省略として記録される
+    assert contents(queue) == ["2", "3"]
+    assert "a(2件)" in queue.overflow_note(CH)
+    assert queue.stats["summarized"] == 2
+
+def test_summarize_policy_records_overflow():
+    queue = make_queue(max_per_channel=2, policy="summarize")
+    for author in ["a", "a", "b", "c"]:
+        queue.append(CH, author, author, "t")
+    assert contents(queue) == ["b", "c"]
+    note = queue.overflow_note(CH)
+    assert "2件" in note and "a(2件)" in note
+
+    batch = queue.seal(CH)
+    assert batch.overflow_count == 2
+    queue.commit(batch)
+    assert queue.overflow_note(CH) is None
+    assert not queue.has_messages(CH)
+
+def test_collapse_policy_merges_consecutive_authors():
+    queue = make_queue(max_per_channel=2, policy="collapse")
+    queue.append(CH, "a", "1", "t1")
+    queue.append(CH, "a", "2", "t2")
+    queue.append(CH, "b", "3", "t3")
+    messages = queue.get_messages(CH)
+    assert [(m.author, m.content, m.count) for m in messages] == [("a", "1\n2", 2), ("b", "3", 1)]
+    assert messages[0].timestamp == "t2"
+
+def test_collapse_does_not_merge_into_sealed_message():
+    queue = make_queue(max_per_channel=2, policy="collapse")
+    queue.append(CH, "a", "1", "t")
+    batch = queue.seal(CH)
+    queue.append(CH, "a", "2", "t")
+    queue.append(CH, "a", "3", "t")
+    queue.commit(batch)
+    assert contents(queue) == ["2\n3"]
+
+def test_json_round_trip_keeps_overflow():
+    queue = make_queue(max_per_channel=1, policy="summarize")
+    queue.append(CH, "a", "1", "t")
+    queue.append(CH, "b", "2", "t")
+    data = queue.to_json()
+    assert OVERFLOW_KEY in data
+    restored = UnreadQueue.from_json(data, 1, "summarize")
+    assert contents(restored) == ["2"]
+    assert restored.overflow_note(CH) == queue.overflow_note(CH)
+
+def test_unknown_policy_falls_back_to_drop_oldest():
+    assert make_queue(policy="unknown").overflow_policy == "drop_oldest"
@@ -0,0 +1,81 @@
+# test_wav_assembler.py
+#
+# WAV の RIFF チャンクの読み取り、フォーマット変換、結合。
+
+import struct
+from array import array
+import pytest
+from utils.wav_assembler import parse_wav, convert_pcm16, assemble, WAV_HEADER_SIZE
+
+def make_wav(samples: list[int], sample_rate=24000, channels=1, extra_chunks=b"", data_size=None) -> bytes:
+    pcm = array('h', samples).tobytes()
+    block_align = channels * 2
+    fmt = struct.pack('<4sIHHIIHH', b'fmt ', 16, 1, channels, sample_rate, sample_rate * block_align, block_align, 16)
+    data = struct.pack('<4sI', b'data', len(pcm) if data_size is None else data_size) + pcm
+    body = b'WAVE' + fmt + extra_chunks + data
+    return struct.pack('<4sI', b'RIFF', len(body)) + body
+
+def pcm_samples(wav: bytes) -> list[int]:
+    return list(array('h', bytes(parse_wav(bytes(wav)).pcm())))
+
+def test_parse_wav_skips_unknown_chunks():
+    # 奇数サイズのチャンクは1バイトの詰め物が入る
+    list_chunk = struct.pack('<4sI', b'LIST', 3) + b'abc' + b'\x00'
+    segment = parse_wav(make_wav([1, 2, 3], extra_chunks=list_chunk))
+    assert (segment.sample_rate, segment.channels, segment.bits_per_sample) == (24000, 1, 16)
+    assert list(array('h', bytes(segment.pcm()))) == [1, 2, 3]
+
+def test_parse_wav_clamps_oversized_data_chunk():
+    segment = parse_wav(make_wav([1, 2, 3], data_size=0xFFFFFFFF))
+    assert segment.data_length == 6
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"RIFX\x00\x00\x00\x00WAVE",
+    struct.pack('<4sI4s', b'RIFF', 4, b'WAVE'),
+])
+def test_parse_wav_rejects_invalid_data(data):
+    with pytest.raises(ValueError):
+        parse_wav(data)
+
+def test_parse_wav_rejects_data_before_fmt():
+    body = b'WAVE' + struct.pack('<4sI', b'data', 2) + b'\x00\x00'
+    with pytest.raises(ValueError):
+        parse_wav(struct.pack('<4sI', b'RIFF', len(body)) + body)
+
+def test_convert_pcm16_stereo_to_mono():
+    segment = parse_wav(make_wav([100, 300, -100, -300], channels=2))
+    assert list(array('h', bytes(convert_pcm16(segment, 24000, 1)))) == [200, -200]
+
+def test_convert_pcm16_mono_to_stereo():
+    segment = parse_wav(make_wav([1, 2]))
+    assert list(array('h', bytes(convert_pcm16(segment, 24000, 2)))) == [1, 1, 2, 2]
+
+def test_convert_pcm16_resamples_with_linear_interpolation():
+    segment = parse_wav(make_wav([0, 100, 200, 300], sample_rate=12000))
+    assert list(array('h', bytes(convert_pcm16(segment, 24000, 1)))) == [0, 50, 100, 150, 200, 250, 300, 300]
+
+def test_assemble_inserts_gaps_between_segments():
+    first, second = make_wav([1, 2]), make_wav([3])
+    # 1ms の無音 = 24 サンプル
+    result = assemble([first, second], gap_ms=1)
+    segment = parse_wav(bytes(result))
+    assert segment.data_offset == WAV_HEADER_SIZE
+    assert pcm_samples(result) == [1, 2] + [0] * 24 + [3]
+
+def test_assemble_gap_before_only_where_requested():
+    result = assemble([make_wav([1]), make_wav([2]), make_wav([3])], gap_ms=1, gap_before=[False, False, True])
+    assert pcm_samples(result) == [1, 2] + [0] * 24 + [3]
+
+def test_assemble_converts_to_first_format_and_skips_broken_segments():
+    result = assemble([make_wav([10, 20]), b"broken", make_wav([30, 30], channels=2)], gap_ms=0)
+    segment = parse_wav(bytes(result))
+    assert (segment.sample_rate, segment.channels) == (24000, 1)
+    assert pcm_samples(result) == [10, 20, 30]
+
+def test_assemble_returns_none_without_valid_segments():
+    assert assemble([b"broken"], gap_ms=10) is None
+
+def test_first_valid_segment_gets_no_gap():
+    result = assemble([b"broken", make_wav([1]), make_wav([2])], gap_ms=1, gap_before=[True, True, True])
+    assert pcm_samples(result) == [1] + [0] * 24 + [2]
@@ -0,0 +1,105 @@
+# fake_discord.py
+#
+# 負荷試験用の Discord の代わり。Cog (ChatManagerCog など) が使う範囲の Bot・チャンネル・
+# メッセージだけを実装し、Bot が送信・編集したメッセージを時刻付きで記録する。
+
+import time
+import asyncio
+import itertools
+import contextlib
+
+_ids = itertools.count(100000)
+
+class FakeUser:
+    def __init__(self, name: str, bot: bool = False):
+        self.id = next(_ids)
+        self.name = name
+        self.display_name = name
+        self.bot = bot
+        self.activities = []
+
+    def __str__(self) -> str:
+        return self.name
+
+class FakeMessage:
+    def __init__(self, channel: "FakeChannel", author: FakeUser, content: str | None, file=None):
+        self.id = next(_ids)
+        self.channel = channel
+        self.author = author
+        self.content = content or ""
+        self.file = file
+        self.created_at = time.monotonic()
+        self.edits = 0
+
+    async def edit(self, content: str = None):
+        self.content = content
+        self.edits += 1
+        self.channel.edit_count += 1
+
+class FakeChannel:
+    """
+    テキストチャンネルの代わり。Bot の送信を sent に記録し、on_bot_send に登録した関数を呼ぶ。
+    send_delay で Discord API の往復時間を模擬できる。
+    """
+
+    def __init__(self, bot: "FakeBot", name: str, send_delay: float = 0.0):
+        self.id = next(_ids)
+        self.name = name
+        self.bot = bot
+        self.send_delay = send_delay
+        self.sent = []        # Bot が送信したメッセージ
+        self.edit_count = 0
+        self.on_bot_send = [] # 送信時に呼ぶ関数 (引数は FakeMessage)
+
+    async def send(self, content: str = None, file=None) -> FakeMessage:
+        if self.send_delay:
+            await asyncio.sleep(self.send_delay)
+        message = FakeMessage(self, self.bot.user, content, file)
+        self.sent.append(message)
+        for callback in self.on_bot_send:
+            callback(message)
+        return message
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+    def receive(self, author: FakeUser, content: str) -> FakeMessage:
+        """ユーザーからのメッセージを作成する (配信は FakeBot.dispatch_message で行う)"""
+        return FakeMessage(self, author, content)
+
+class FakeBot:
+    def __init__(self, command_prefix: str = "!"):
+        self.user = FakeUser("bot", bot=True)
+        self.command_prefix = command_prefix
+        self.guilds = []
+        self.voice_clients = []
+        self._cogs = {}
+        self._channels = {}
+
+    def add_cog(self, cog):
+        self._cogs[cog.__cog_name__] = cog
+
+    def get_cog(self, name: str):
+        return self._cogs.get(name)
+
+    def create_channel(self, name: str, send_delay: float = 0.0) -> FakeChannel:
+        channel = FakeChannel(self, name, send_delay)
+        self._channels[channel.id] = channel
+        return channel
+
+    def get_channel(self, channel_id: int):
+        return self._channels.get(channel_id)
+
+    async def wait_until_ready(self):
+        return
+
+    def is_closed(self) -> bool:
+        return False
+
+    async def dispatch_message(self, message: FakeMessage):
+        """全ての Cog の on_message にメッセージを渡す"""
+        for cog in list(self._cogs.values()):
+            listener = getattr(cog, "on_message", None)
+            if listener is not None:
+                await listener(message)
@@ -0,0 +1,165 @@
+# fake_gemini_client.py
+#
+# google.generativeai の GenerativeModel の代わりに、モック Gemini サーバー
+# (tools/mock_gemini_server.py) へ REST でリクエストするクライアント。
+# 環境変数 GEMINI_FAKE_ENDPOINT を設定すると client_pool がこちらを使う。
+# ai_request_handler が使う範囲 (start_chat / send_message_async / ストリーミング) だけを実装し、
+# サーバーのエラーは本物の SDK と同じ例外 (ResourceExhausted, StopCandidateException など) に変換する。
+
+import json
+from types import SimpleNamespace
+import aiohttp
+import google.api_core.exceptions
+import google.generativeai as genai
+
+# 送信が済んだ候補として扱う終了理由
+NORMAL_FINISH_REASONS = ("", "STOP", "MAX_TOKENS", "FINISH_REASON_UNSPECIFIED")
+
+_session = None
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession()
+    return _session
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+def _to_contents(history: list, prompt: str) -> list[dict]:
+    """履歴 ({"role", "parts": [str]}) とプロンプトを REST の contents に変換する"""
+    contents = []
+    for turn in history:
+        parts = [{"text": p} if isinstance(p, str) else p for p in turn.get("parts", [])]
+        contents.append({"role": turn.get("role", "user"), "parts": parts})
+    contents.append({"role": "user", "parts": [{"text": prompt}]})
+    return contents
+
+def _camel_case(name: str) -> str:
+    """SDK の生成設定のキー (response_mime_type) を REST の形式 (responseMimeType) にする"""
+    head, *rest = name.split("_")
+    return head + "".join(word.capitalize() for word in rest)
+
+def _raise_for_error(status: int, payload: dict):
+    message = payload.get("error", {}).get("message", f"HTTP {status}")
+    if status == 429:
+        # gRPC 版の SDK と同じく ResourceExhausted として扱う
+        raise google.api_core.exceptions.ResourceExhausted(message)
+    raise google.api_core.exceptions.from_http_status(status, message)
+
+def _candidate_text(candidate: dict) -> str:
+    return "".join(part.get("text", "") for part in candidate.get("content", {}).get("parts", []))
+
+def _usage(payload: dict):
+    usage = payload.get("usageMetadata")
+    if not usage:
+        return None
+    return SimpleNamespace(
+        prompt_token_count=usage.get("promptTokenCount", 0),
+        candidates_token_count=usage.get("candidatesTokenCount", 0),
+        total_token_count=usage.get("totalTokenCount", 0),
+    )
+
+def _check_finish(candidate: dict):
+    if candidate.get("finishReason", "") not in NORMAL_FINISH_REASONS:
+        # ChatSession と同じく、安全性などで止まった候補は例外にする
+        raise genai.types.StopCandidateException(candidate)
+
+class FakeChunk:
+    __slots__ = ("_text",)
+
+    def __init__(self, text: str):
+        self._text = text
+
+    @property
+    def text(self) -> str:
+        if not self._text:
+            raise ValueError("このチャンクにはテキストがありません。")
+        return self._text
+
+class FakeResponse:
+    """GenerateContentResponse の代わり (ストリーミングの場合は受信しながら組み立てる)"""
+
+    def __init__(self, http_response: aiohttp.ClientResponse | None = None, payload: dict | None = None):
+        self._http_response = http_response
+        self._texts = []
+        self.candidates = []
+        self.prompt_feedback = None
+        self.usage_metadata = None
+        if payload is not None:
+            self._apply(payload)
+
+    def _apply(self, payload: dict) -> str:
+        self.prompt_feedback = payload.get("promptFeedback", self.prompt_feedback)
+        self.usage_metadata = _usage(payload) or self.usage_metadata
+        text = ""
+        for candidate in payload.get("candidates", []):
+            self.candidates = [candidate]
+            text = _candidate_text(candidate)
+            self._texts.append(text)
+            _check_finish(candidate)
+        return text
+
+    @property
+    def text(self) -> str:
+        text = "".join(self._texts)
+        if not text:
+            raise ValueError("応答にテキストが含まれていません。")
+        return text
+
+    async def __aiter__(self):
+        """SSE のイベントを1つずつチャンクとして返す"""
+        try:
+            async for raw_line in self._http_response.content:
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                yield FakeChunk(self._apply(json.loads(line[len("data:"):])))
+        finally:
+            self._http_response.release()
+
+class FakeChatSession:
+    def __init__(self, model: "FakeGenerativeModel", history: list):
+        self.model = model
+        self.history = list(history or [])
+
+    async def send_message_async(self, content: str, stream: bool = False, generation_config: dict | None = None):
+        model = self.model
+        method = "streamGenerateContent" if stream else "generateContent"
+        url = f"{model.endpoint}/v1beta/models/{model.model_name}:{method}"
+        params = {"key": model.api_key}
+        if stream:
+            params["alt"] = "sse"
+        body = {"contents": _to_contents(self.history, content)}
+        if model._cached_content:
+            body["cachedContent"] = model._cached_content
+        if generation_config:
+            body["generationConfig"] = {_camel_case(k): v for k, v in generation_config.items()}
+        http_response = await _get_session().post(url, params=params, json=body)
+        if http_response.status != 200:
+            try:
+                payload = await http_response.json(content_type=None)
+            except (aiohttp.ContentTypeError, json.JSONDecodeError):
+                payload = {}
+            http_response.release()
+            _raise_for_error(http_response.status, payload)
+        if stream:
+            return FakeResponse(http_response=http_response)
+        payload = await http_response.json()
+        http_response.release()
+        return FakeResponse(payload=payload)
+
+class FakeGenerativeModel:
+    """genai.GenerativeModel の代わり (APIキーごとに作成される)"""
+
+    def __init__(self, model_name: str, api_key: str, endpoint: str):
+        self.model_name = model_name
+        self.api_key = api_key
+        self.endpoint = endpoint.rstrip("/")
+        self._cached_content = None
+
+    def start_chat(self, history: list = None) -> FakeChatSession:
+        return FakeChatSession(self, history)
@@ -0,0 +1,297 @@
+# load_test.py
+#
+# モック Gemini サーバーと偽の Discord を使って、Bot 全体 (ChatManagerCog の活動ループ、
+# send_request のキー切り替え、感情分析) に負荷をかける。
+# N チャンネルに1分あたり M 件のメッセージを送り、応答までの時間の p50/p95/p99、
+# スループット、メモリ使用量を表示する。
+#
+#   python -m tools.load_test LUNA2 --channels 8 --rate 6 --duration 120 --keys 3 --key-rpm 10
+#
+# インスタンスのディレクトリは一時ディレクトリにコピーして使うため、元のデータは変更されない。
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+from tools.mock_gemini_server import MockGeminiServer, add_behavior_arguments, behavior_from_args
+from tools.fake_discord import FakeBot, FakeUser
+from tools import fake_gemini_client
+
+SAMPLE_MESSAGES = [
+    "おはよう！", "今日は何してた？", "ちょっと聞いてほしいことがあるんだけど",
+    "さっきのゲーム、すごく惜しかった", "お腹すいたな", "明日の予定どうしよう",
+    "この曲いいよね", "眠くなってきた…", "それってどういうこと？", "また後で話そう",
+]
+# コピーしないファイル (履歴と未読は空の状態から始める)
+EXCLUDED_DATA = ("history.json", "history", "history.db", "history.db-wal", "history.db-shm",
+                 "unread_messages.json", "voice_cache")
+
+def percentile(sorted_values: list[float], p: float) -> float | None:
+    """最近傍順位法のパーセンタイル"""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+def peak_rss_mb() -> float | None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+def prepare_instance(character: str, workdir: str) -> str:
+    """インスタンスを一時ディレクトリにコピーし、そこを作業ディレクトリにする"""
+    source = os.path.join(REPO_ROOT, "instances", character)
+    if not os.path.isdir(source):
+        raise SystemExit(f"インスタンス '{source}' が見つかりません。")
+    target = os.path.join(workdir, "instances", character)
+    shutil.copytree(source, target, ignore=shutil.ignore_patterns(*EXCLUDED_DATA))
+    with open(os.path.join(target, "data", "unread_messages.json"), "w", encoding="utf-8") as f:
+        json.dump({}, f)
+    os.chdir(workdir)
+    return target
+
+def configure_api_keys(key_count: int, endpoint: str):
+    from utils import client_pool
+    for i, env_var in enumerate(client_pool.API_KEY_ENV_VARS):
+        if i < key_count:
+            os.environ[env_var] = f"mock-key-{i + 1}"
+        else:
+            os.environ.pop(env_var, None)
+    os.environ[client_pool.FAKE_ENDPOINT_ENV_VAR] = endpoint
+
+class LatencyRecorder:
+    """
+    ユーザーのメッセージから、そのメッセージを含む応答の最初の送信までの時間を記録する。
+    応答処理が始まった (typing に入った) 時点までに届いていたメッセージを、その応答の対象とみなす。
+    """
+
+    def __init__(self):
+        self.pending = {}          # チャンネルID -> 未応答のメッセージの到着時刻
+        self.started_at = {}       # チャンネルID -> 処理中の応答の開始時刻
+        self.latencies = []
+        self.responses = 0
+        self.messages_sent = 0
+
+    def attach(self, channel):
+        self.pending[channel.id] = []
+        original_typing = channel.typing
+
+        @contextlib.asynccontextmanager
+        async def typing():
+            self.started_at[channel.id] = time.monotonic()
+            async with original_typing():
+                yield
+
+        channel.typing = typing
+        channel.on_bot_send.append(lambda message: self.on_bot_send(channel.id, message))
+
+    def on_user_message(self, channel_id: int):
+        self.pending[channel_id].append(time.monotonic())
+        self.messages_sent += 1
+
+    def on_bot_send(self, channel_id: int, message):
+        started_at = self.started_at.pop(channel_id, None)
+        if started_at is None:
+            return # 同じ応答の2通目以降 (分割・音声)
+        pending = self.pending[channel_id]
+        answered = [t for t in pending if t <= started_at]
+        if not answered:
+            return
+        now = message.created_at
+        self.latencies.extend(now - t for t in answered)
+        self.pending[channel_id] = [t for t in pending if t > started_at]
+        self.responses += 1
+
+    def unanswered(self) -> int:
+        return sum(len(p) for p in self.pending.values())
+
+async def generate_messages(bot, channel, users: list, rate_per_minute: float, stop_at: float, recorder: LatencyRecorder, rng: random.Random):
+    """ポアソン過程でチャンネルにメッセージを送る"""
+    while True:
+        await asyncio.sleep(rng.expovariate(rate_per_minute / 60))
+        if time.monotonic() >= stop_at:
+            return
+        message = channel.receive(rng.choice(users), rng.choice(SAMPLE_MESSAGES))
+        recorder.on_user_message(channel.id)
+        await bot.dispatch_message(message)
+
+async def run(args) -> dict:
+    import utils.config_manager as config
+    from utils import data_manager, ai_request_handler, client_pool, persistence_writer
+
+    workdir = tempfile.mkdtemp(prefix="east_loadtest_")
+    prepare_instance(args.character, workdir)
+
+    server = None
+    endpoint = args.endpoint
+    if endpoint is None:
+        server = MockGeminiServer(behavior_from_args(args))
+        endpoint = await server.start()
+    configure_api_keys(args.keys, endpoint)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    log_path = os.path.join(workdir, "bot.log")
+    log_file = open(log_path, "w", encoding="utf-8")
+    redirect = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(log_file)
+    recorder = LatencyRecorder()
+    rng = random.Random(args.seed)
+
+    with redirect:
+        if not config.init(args.character):
+            raise SystemExit("config_manager の初期化に失敗しました。")
+        data_manager.load_all_data()
+        settings = data_manager.get_data('setting')
+        settings.setdefault('config', {})['default_channel'] = None # 自発的な発言はさせない
+
+        bot = FakeBot()
+        config.set_bot_instance(bot)
+        ai_request_handler.initialize_histories()
+        client_pool.initialize([config.MODEL_PRO, config.MODEL_FLASH])
+        ai_request_handler.initialize_key_scheduler()
+
+        channels = [bot.create_channel(f"load-{i + 1}", args.send_delay_ms / 1000) for i in range(args.channels)]
+        channel_settings = settings.setdefault('channel_settings', {})
+        for channel in channels:
+            channel_settings[str(channel.id)] = {"chat_mode": True, "reactive_mode": True, "stream_mode": args.stream}
+            recorder.attach(channel)
+
+        from cogs.chat import ChatManagerCog
+        from cogs.emotion import EmotionCog
+        from cogs.memory import MemoryCog
+        emotion_cog = EmotionCog(bot)
+        if args.no_emotion:
+            emotion_cog.queue_analysis = lambda *_args, **_kwargs: None
+        bot.add_cog(emotion_cog)
+        memory_cog = MemoryCog(bot)
+        bot.add_cog(memory_cog)
+        chat_cog = ChatManagerCog(bot)
+        chat_cog.reactive_params = {
+            level: {"debounce": args.debounce, "min_delay": args.min_delay, "max_delay": args.max_delay}
+            for level in ("active", "normal", "inactive")
+        }
+        bot.add_cog(chat_cog)
+
+        users = [FakeUser(f"user{i + 1}") for i in range(args.users)]
+        started = time.monotonic()
+        stop_at = started + args.duration
+        generators = [
+            asyncio.create_task(generate_messages(bot, channel, users, args.rate, stop_at, recorder, rng))
+            for channel in channels
+        ]
+        await asyncio.gather(*generators)
+        # 送信を止めた後、残りの応答を待つ
+        drain_deadline = time.monotonic() + args.drain
+        while recorder.unanswered() and time.monotonic() < drain_deadline:
+            await asyncio.sleep(0.5)
+        elapsed = time.monotonic() - started
+
+        chat_cog.cog_unload()
+        memory_cog.cog_unload()
+        emotion_cog.cog_unload()
+        await asyncio.sleep(0)
+        data_manager.save_all_data()
+        await data_manager.flush()
+        persistence_writer.shutdown()
+        data_manager.get_history_backend().close()
+
+    log_file.close()
+    await fake_gemini_client.close_session()
+    if server:
+        await server.stop()
+
+    latencies = sorted(recorder.latencies)
+    traced_peak = tracemalloc.get_traced_memory()[1] / 1024 / 1024 if args.tracemalloc else None
+    if args.tracemalloc:
+        tracemalloc.stop()
+    result = {
+        "params": {k: v for k, v in vars(args).items() if k != "output"},
+        "elapsed_seconds": round(elapsed, 2),
+        "messages_sent": recorder.messages_sent,
+        "messages_answered": len(latencies),
+        "messages_unanswered": recorder.unanswered(),
+        "responses": recorder.responses,
+        "responses_per_minute": round(recorder.responses / elapsed * 60, 2),
+        "latency_seconds": {
+            "p50": percentile(latencies, 50), "p95": percentile(latencies, 95), "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+        },
+        "keys": [
+            {"key": state.number, "success": state.success_count, "errors": state.error_count, "rate_limited": state.rate_limited_count}
+            for state in ai_request_handler.key_scheduler.get_states()
+        ],
+        "server": server.describe() if server else None,
+        "memory_mb": {"peak_rss": peak_rss_mb(), "traced_peak": traced_peak},
+        "log_file": log_path,
+    }
+    return result
+
+def print_report(result: dict):
+    latency = result["latency_seconds"]
+    fmt = lambda v: "-" if v is None else f"{v:.2f}s"
+    print("=== 負荷試験の結果 ===")
+    print(f"経過時間: {result['elapsed_seconds']}秒")
+    print(f"メッセージ: 送信 {result['messages_sent']} / 応答済み {result['messages_answered']} / 未応答 {result['messages_unanswered']}")
+    print(f"応答数: {result['responses']} ({result['responses_per_minute']}件/分)")
+    print(f"応答時間: p50 {fmt(latency['p50'])} / p95 {fmt(latency['p95'])} / p99 {fmt(latency['p99'])} / 最大 {fmt(latency['max'])}")
+    for key in result["keys"]:
+        print(f"  APIキー {key['key']}: 成功 {key['success']} / エラー {key['errors']} / レート制限 {key['rate_limited']}")
+    if result["server"]:
+        print(f"サーバー: {result['server']['total']}")
+    memory = result["memory_mb"]
+    if memory["peak_rss"] is not None:
+        print(f"メモリ: 最大RSS {memory['peak_rss']:.1f}MB" + (f" / tracemalloc 最大 {memory['traced_peak']:.1f}MB" if memory["traced_peak"] is not None else ""))
+    print(f"ログ: {result['log_file']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="モック Gemini サーバーと偽の Discord による負荷試験")
+    parser.add_argument("character", help="使用するインスタンス名 (instances/ 以下、コピーして使う)")
+    parser.add_argument("--channels", type=int, default=4, help="チャンネル数")
+    parser.add_argument("--rate", type=float, default=6.0, help="チャンネルごとの1分あたりのメッセージ数")
+    parser.add_argument("--users", type=int, default=3, help="発言するユーザー数")
+    parser.add_argument("--duration", type=float, default=60.0, help="メッセージを送り続ける時間 (秒)")
+    parser.add_argument("--drain", type=float, default=60.0, help="送信停止後に残りの応答を待つ最大時間 (秒)")
+    parser.add_argument("--keys", type=int, default=2, help="APIキーの数 (最大4)")
+    parser.add_argument("--debounce", type=float, default=2.0, help="リアクティブモードの debounce (秒)")
+    parser.add_argument("--min-delay", type=float, default=1.0, help="リアクティブモードの min_delay (秒)")
+    parser.add_argument("--max-delay", type=float, default=10.0, help="リアクティブモードの max_delay (秒)")
+    parser.add_argument("--send-delay-ms", type=float, default=50.0, help="Discord への送信にかかる時間 (ミリ秒)")
+    parser.add_argument("--stream", action="store_true", help="ストリーミング表示を有効にする")
+    parser.add_argument("--no-emotion", action="store_true", help="感情分析を行わない")
+    parser.add_argument("--endpoint", default=None, help="起動済みのモックサーバーの URL (省略時は内部で起動)")
+    parser.add_argument("--tracemalloc", action="store_true", help="tracemalloc で Python のメモリ確保量も測る (遅くなる)")
+    parser.add_argument("--verbose", action="store_true", help="Bot のログを表示する (省略時はログファイルに出力)")
+    parser.add_argument("--output", default=None, help="結果を JSON で保存するファイル")
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+    if not 1 <= args.keys <= 4:
+        parser.error("--keys は 1〜4 で指定してください。")
+    if args.output:
+        args.output = os.path.abspath(args.output) # 実行中は作業ディレクトリが変わるため
+
+    result = asyncio.run(run(args))
+    print_report(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,275 @@
+# mock_gemini_server.py
+#
+# Gemini API の generateContent / streamGenerateContent を真似るローカルサーバー。
+# 実際の API を使わずに、遅延・レート制限 (429 "Please retry in Ns")・タイムアウト・
+# 安全性によるブロックを再現して、キーの切り替えやスケジューリングを検証するために使う。
+#
+# 単体で起動する場合:
+#   python -m tools.mock_gemini_server --port 8089 --latency-ms 800 --key-rpm 10
+# Bot 側は環境変数 GEMINI_FAKE_ENDPOINT=http://127.0.0.1:8089 で tools.fake_gemini_client を使う。
+
+import re
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import deque, Counter
+from aiohttp import web
+
+# 感情分析のプロンプトから感情名を取り出す ('joy(喜び)' の形式)
+EMOTION_NAME_PATTERN = re.compile(r"'(\w+)\(")
+# 感情分析のプロンプトに含まれる対話の番号 ([対話1] の形式)
+DIALOGUE_ID_PATTERN = re.compile(r"\[対話(\d+)\]")
+# 記憶抽出のプロンプトの目印
+MEMORY_EXTRACTION_MARKER = "# 抽出対象の会話"
+REPLY_SENTENCES = [
+    "うん、ちゃんと読んでるよ。",
+    "それ、もう少し詳しく聞かせてほしいな。",
+    "なるほどね、そういうことだったんだ。",
+    "今日はなんだか落ち着いた気分かも。",
+    "ふふ、ちょっと面白いね。",
+    "わかった、覚えておくね！",
+]
+
+class MockBehavior:
+    """サーバーの振る舞いの設定"""
+
+    def __init__(self, latency_ms: float = 500, jitter_ms: float = 200, chunk_interval_ms: float = 80,
+                 reply_chars: int = 120, key_rpm: float = 0, rate_limit_rate: float = 0.0,
+                 retry_seconds: float = 20.0, timeout_rate: float = 0.0, hang_seconds: float = 600.0,
+                 block_rate: float = 0.0, error_rate: float = 0.0, seed: int | None = None):
+        self.latency_ms = latency_ms            # 応答までの平均遅延
+        self.jitter_ms = jitter_ms              # 遅延のばらつき (標準偏差)
+        self.chunk_interval_ms = chunk_interval_ms # ストリーミングのチャンク間隔
+        self.reply_chars = reply_chars          # 応答のおおよその文字数
+        self.key_rpm = key_rpm                  # キーごとの1分あたりの上限 (0 なら無制限)
+        self.rate_limit_rate = rate_limit_rate  # 上限に関係なく 429 を返す確率
+        self.retry_seconds = retry_seconds      # 429 で指示する待機時間
+        self.timeout_rate = timeout_rate        # 応答せずに hang_seconds 待つ確率
+        self.hang_seconds = hang_seconds
+        self.block_rate = block_rate            # 安全性でブロックされた候補を返す確率
+        self.error_rate = error_rate            # 500 を返す確率
+        self.random = random.Random(seed)
+
+class MockGeminiServer:
+    def __init__(self, behavior: MockBehavior):
+        self.behavior = behavior
+        self.stats = Counter()
+        self.key_stats = {}       # APIキー -> Counter
+        self._key_requests = {}   # APIキー -> 直近1分のリクエスト時刻
+        self._runner = None
+        self.url = None
+
+    # --- 起動・停止 ---
+    def build_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(r"/{version}/models/{model}:generateContent", self.handle_generate)
+        app.router.add_post(r"/{version}/models/{model}:streamGenerateContent", self.handle_stream)
+        app.router.add_get("/stats", self.handle_stats)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        self._runner = web.AppRunner(self.build_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{bound_port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    # --- 振る舞い ---
+    def _count(self, api_key: str, outcome: str):
+        self.stats[outcome] += 1
+        self.key_stats.setdefault(api_key, Counter())[outcome] += 1
+
+    def _check_rate_limit(self, api_key: str) -> float | None:
+        """429 を返す場合は指示する待機秒数を返す"""
+        behavior = self.behavior
+        if behavior.rate_limit_rate and behavior.random.random() < behavior.rate_limit_rate:
+            return behavior.retry_seconds
+        if not behavior.key_rpm:
+            return None
+        now = time.monotonic()
+        recent = self._key_requests.setdefault(api_key, deque())
+        while recent and now - recent[0] >= 60:
+            recent.popleft()
+        if len(recent) >= behavior.key_rpm:
+            return max(1.0, 60 - (now - recent[0]))
+        recent.append(now)
+        return None
+
+    async def _delay(self):
+        behavior = self.behavior
+        delay = max(0.0, behavior.random.gauss(behavior.latency_ms, behavior.jitter_ms)) / 1000
+        await asyncio.sleep(delay)
+
+    def _reply_text(self, prompt_text: str) -> str:
+        names = EMOTION_NAME_PATTERN.findall(prompt_text) if "感情" in prompt_text else []
+        if names:
+            # 感情分析のリクエストには対話ごとの感情の変化量を JSON で返す
+            dialogue_count = max(1, len(DIALOGUE_ID_PATTERN.findall(prompt_text)))
+            results = []
+            for dialogue_id in range(1, dialogue_count + 1):
+                picked = self.behavior.random.sample(names, k=min(3, len(names)))
+                results.append({"id": dialogue_id, "deltas": {name: self.behavior.random.randint(-10, 10) for name in picked}})
+            return json.dumps(results)
+        if MEMORY_EXTRACTION_MARKER in prompt_text:
+            # 記憶抽出のリクエストには文字列の JSON 配列を返す
+            count = self.behavior.random.randint(0, 2)
+            return json.dumps([f"ユーザーは{self.behavior.random.choice(REPLY_SENTENCES)}と話していた。" for _ in range(count)], ensure_ascii=False)
+        text = ""
+        while len(text) < self.behavior.reply_chars:
+            text += self.behavior.random.choice(REPLY_SENTENCES)
+        return text
+
+    @staticmethod
+    def _prompt_text(body: dict) -> str:
+        contents = body.get("contents") or []
+        last = contents[-1] if contents else {}
+        return "".join(part.get("text", "") for part in last.get("parts", []))
+
+    @staticmethod
+    def _prompt_chars(body: dict) -> int:
+        return sum(len(part.get("text", "")) for content in body.get("contents") or [] for part in content.get("parts", []))
+
+    def _error_response(self, status: int, message: str, status_name: str) -> web.Response:
+        return web.json_response({"error": {"code": status, "message": message, "status": status_name}}, status=status)
+
+    async def _prepare(self, request: web.Request):
+        """共通の前処理。エラーを返す場合は Response、そうでなければ (APIキー, リクエスト本文)"""
+        api_key = request.query.get("key") or request.headers.get("x-goog-api-key", "")
+        body = await request.json()
+        self._count(api_key, "requests")
+        retry_after = self._check_rate_limit(api_key)
+        if retry_after is not None:
+            self._count(api_key, "rate_limited")
+            return self._error_response(
+                429, f"You exceeded your current quota. Please retry in {retry_after:.1f}s.", "RESOURCE_EXHAUSTED")
+        behavior = self.behavior
+        if behavior.timeout_rate and behavior.random.random() < behavior.timeout_rate:
+            self._count(api_key, "timeouts")
+            await asyncio.sleep(behavior.hang_seconds)
+            return self._error_response(504, "Deadline exceeded.", "DEADLINE_EXCEEDED")
+        await self._delay()
+        if behavior.error_rate and behavior.random.random() < behavior.error_rate:
+            self._count(api_key, "errors")
+            return self._error_response(500, "An internal error has occurred.", "INTERNAL")
+        return api_key, body
+
+    def _usage(self, body: dict, reply: str) -> dict:
+        prompt_tokens = self._prompt_chars(body)
+        return {"promptTokenCount": prompt_tokens, "candidatesTokenCount": len(reply), "totalTokenCount": prompt_tokens + len(reply)}
+
+    def _blocked(self, api_key: str) -> bool:
+        if self.behavior.block_rate and self.behavior.random.random() < self.behavior.block_rate:
+            self._count(api_key, "blocked")
+            return True
+        return False
+
+    @staticmethod
+    def _candidate(text: str | None, finish_reason: str) -> dict:
+        candidate = {"index": 0, "finishReason": finish_reason, "safetyRatings": []}
+        if text is not None:
+            candidate["content"] = {"role": "model", "parts": [{"text": text}]}
+        return candidate
+
+    # --- ハンドラー ---
+    async def handle_generate(self, request: web.Request) -> web.Response:
+        prepared = await self._prepare(request)
+        if isinstance(prepared, web.Response):
+            return prepared
+        api_key, body = prepared
+        if self._blocked(api_key):
+            return web.json_response({"candidates": [self._candidate(None, "SAFETY")], "usageMetadata": self._usage(body, "")})
+        reply = self._reply_text(self._prompt_text(body))
+        self._count(api_key, "succeeded")
+        return web.json_response({
+            "candidates": [self._candidate(reply, "STOP")],
+            "usageMetadata": self._usage(body, reply),
+            "modelVersion": request.match_info["model"],
+        })
+
+    async def handle_stream(self, request: web.Request) -> web.StreamResponse:
+        prepared = await self._prepare(request)
+        if isinstance(prepared, web.Response):
+            return prepared
+        api_key, body = prepared
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send_event(payload: dict):
+            await response.write(f"data: {json.dumps(payload, ensure_ascii=False)}\r\n\r\n".encode("utf-8"))
+
+        reply = self._reply_text(self._prompt_text(body))
+        blocked = self._blocked(api_key)
+        # ブロックする場合は途中まで送ってから止める
+        cut = len(reply) // 2 if blocked else len(reply)
+        chunk_size = 16
+        for start in range(0, cut, chunk_size):
+            await send_event({"candidates": [self._candidate(reply[start:min(start + chunk_size, cut)], "")]})
+            await asyncio.sleep(self.behavior.chunk_interval_ms / 1000)
+        final_reason = "SAFETY" if blocked else "STOP"
+        await send_event({"candidates": [self._candidate(None, final_reason)], "usageMetadata": self._usage(body, reply[:cut])})
+        if not blocked:
+            self._count(api_key, "succeeded")
+        await response.write_eof()
+        return response
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.describe())
+
+    def describe(self) -> dict:
+        return {"total": dict(self.stats), "keys": {f"key{i + 1}": dict(c) for i, c in enumerate(self.key_stats.values())}}
+
+def add_behavior_arguments(parser: argparse.ArgumentParser):
+    """MockBehavior の設定をコマンドライン引数に追加する (load_test と共用)"""
+    parser.add_argument("--latency-ms", type=float, default=500, help="応答までの平均遅延 (ミリ秒)")
+    parser.add_argument("--jitter-ms", type=float, default=200, help="遅延のばらつき (ミリ秒)")
+    parser.add_argument("--chunk-interval-ms", type=float, default=80, help="ストリーミングのチャンク間隔 (ミリ秒)")
+    parser.add_argument("--reply-chars", type=int, default=120, help="応答のおおよその文字数")
+    parser.add_argument("--key-rpm", type=float, default=0, help="キーごとの1分あたりの上限 (0 なら無制限)")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="上限に関係なく 429 を返す確率")
+    parser.add_argument("--retry-seconds", type=float, default=20.0, help="429 で指示する待機時間 (秒)")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="応答しない確率")
+    parser.add_argument("--hang-seconds", type=float, default=600.0, help="応答しない場合に待つ時間 (秒)")
+    parser.add_argument("--block-rate", type=float, default=0.0, help="安全性でブロックする確率")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="500 を返す確率")
+    parser.add_argument("--seed", type=int, default=None, help="乱数のシード")
+
+def behavior_from_args(args: argparse.Namespace) -> MockBehavior:
+    return MockBehavior(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, chunk_interval_ms=args.chunk_interval_ms,
+        reply_chars=args.reply_chars, key_rpm=args.key_rpm, rate_limit_rate=args.rate_limit_rate,
+        retry_seconds=args.retry_seconds, timeout_rate=args.timeout_rate, hang_seconds=args.hang_seconds,
+        block_rate=args.block_rate, error_rate=args.error_rate, seed=args.seed,
+    )
+
+async def _serve(args: argparse.Namespace):
+    server = MockGeminiServer(behavior_from_args(args))
+    url = await server.start(args.host, args.port)
+    print(f"モック Gemini サーバーを起動しました: {url} (Ctrl+C で停止)")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()
+        print(json.dumps(server.describe(), ensure_ascii=False, indent=2))
+
+def main():
+    parser = argparse.ArgumentParser(description="ローカルのモック Gemini API サーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    add_behavior_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,14 @@ import google.api_core.exceptions
 import google.generativeai as genai
 import utils.config_manager as config
 from utils import data_manager # data_manager をインポート
+from utils import client_pool
+from utils import history_trimmer
+from utils import history_summarizer
+from utils import memory_extractor
+from utils import context_cache
+from utils.storage_backend import HistoryLoadError
+from utils import key_scheduler as key_scheduler_module
+from utils.key_scheduler import KeyScheduler
 from utils.console_display import log_system, log_error, log_info, log_warning, log_success
 from datetime import datetime
 import json
@@ -11,21 +19,25 @@ import logging
 import traceback
 import os
 import asyncio
-import re
+import itertools
 
 # --- グローバル変数 _histories は削除 ---
 # _histories = {} # ← 削除
 
-# APIキーの環境変数名のリスト
-API_KEY_ENV_VARS = [
-    "GEMINI_API_KEY",
-    "GEMINI_API_KEY_1",
-    "GEMINI_API_KEY_2",
-    "GEMINI_API_KEY_3",
-]
+# APIキーの環境変数名のリスト (client_pool で管理)
+API_KEY_ENV_VARS = client_pool.API_KEY_ENV_VARS
 
-# 現在使用中のAPIキーのインデックス
-current_api_key_index = 0
+# APIキーの健康状態を追跡し、リクエストごとに最適なキーを選ぶスケジューラ
+key_scheduler = KeyScheduler(requests_per_minute=config.API_KEY_REQUESTS_PER_MINUTE)
+
+# --- 履歴の copy-on-write ---
+# チャンネルの履歴リストは書き換えず、変更するときはコピーに変更を加えてから差し替える。
+# そのため get_channel_history が返したリストは、await を挟んで持ち続けても変化しない (スナップショット)。
+# 差し替えのたびにチャンネルのバージョンを進め、リクエスト中に他の処理が履歴を更新したかを判別できるようにする。
+_version_counter = itertools.count(1)
+_base_version = 0       # 履歴を再読み込みした時点のバージョン (バージョン未記録のチャンネルに使う)
+_history_versions = {}  # チャンネルID -> 最後に差し替えた時のバージョン
+_history_locks = {}     # チャンネルID -> 履歴の書き換えを直列化するロック
 
 def initialize_histories():
     """
@@ -33,13 +45,55 @@ def initialize_histories():
     この関数は実質的に不要になる可能性がありますが、互換性のために残すか、
     起動時の data_manager 読み込み確認用にするか検討できます）
     """
+    global _base_version
     if data_manager.get_data('history') is None:
         log_warning("AI_REQUEST_HANDLER", "data_managerの履歴キャッシュがまだ初期化されていません。")
         # 必要であればここで data_manager.load_all_data() を呼ぶか、エラーとする
         # data_manager.load_all_data() # ← main.py で呼ばれるはずなので通常は不要
     else:
+        # 履歴キャッシュごと差し替えられた可能性があるため、全チャンネルのバージョンを進める
+        _base_version = next(_version_counter)
+        _history_versions.clear()
+        context_cache.invalidate_all()
         log_system("AIリクエストハンドラー: data_managerの履歴キャッシュを確認しました。")
 
+def initialize_key_scheduler():
+    """クライアントプールのキーをスケジューラに登録し、設定ファイルの優先キーを反映する"""
+    key_scheduler.sync_keys(client_pool.get_api_keys())
+    settings = data_manager.get_data('setting') or {}
+    active_key = settings.get('config', {}).get('active_key')
+    if isinstance(active_key, int) and 1 <= active_key <= len(key_scheduler.get_states()):
+        key_scheduler.preferred_key = key_scheduler.get_states()[active_key - 1].api_key
+        log_info("KEY_SCHEDULER", f"APIキー {active_key} を優先キーに設定しました。")
+
+def reload_api_keys() -> bool:
+    """.env (client_pool.API_KEY_ENV_FILE) と環境変数からAPIキーを読み直し、変更があればプールとスケジューラを更新する。変更があれば True"""
+    if not client_pool.refresh_api_keys():
+        return False
+    initialize_key_scheduler()
+    return True
+
+def get_active_key_number() -> int | None:
+    """直近で成功したAPIキーの番号 (1始まり) を返す。まだなければ優先キーの番号"""
+    for api_key in (key_scheduler.last_used_key, key_scheduler.preferred_key):
+        state = key_scheduler.get_state(api_key) if api_key else None
+        if state:
+            return state.number
+    return None
+
+def set_active_key_number(key_number: int) -> bool:
+    """指定番号のAPIキーを優先キーに設定する (健康なキーがあればそちらが使われることもある)"""
+    states = key_scheduler.get_states()
+    if not 1 <= key_number <= len(states):
+        return False
+    key_scheduler.preferred_key = states[key_number - 1].api_key
+    settings = data_manager.get_data('setting')
+    if settings is not None:
+        settings.setdefault('config', {})['active_key'] = key_number
+        data_manager.mark_dirty('setting')
+    log_info("KEY_SCHEDULER", f"APIキー {key_number} を優先キーに設定しました。")
+    return True
+
 def _load_persona() -> str | None:
     """ペルソナファイルを読み込む"""
     try:
@@ -58,6 +112,35 @@ def _load_persona() -> str | None:
         log_error("PERSONA_LOAD", f"ペルソナファイルの読み込み中にエラー: {e}")
         return None
 
+def load_persona() -> bool:
+    """
+    ペルソナファイルを再読み込みできるか確認する。
+    履歴の先頭はまだ変わらないため、コンテキストキャッシュは apply_persona_to_channel で
+    適用したチャンネルのものだけが作り直される。
+    """
+    persona_content = _load_persona()
+    if not persona_content:
+        return False
+    log_success("PERSONA_LOAD", "ペルソナを再読み込みしました。")
+    return True
+
+def apply_persona_to_channel(channel_id: int) -> bool:
+    """チャンネルの履歴の先頭 (ペルソナ) を現在のペルソナファイルの内容に置き換える (会話の要約は残す)"""
+    persona_content = _load_persona()
+    if not persona_content:
+        return False
+    history = get_channel_history(channel_id)
+    if history is None:
+        return False
+    if not history or history[0].get("role") != "user":
+        log_error("PERSONA_APPLY", f"CH[{channel_id}] の履歴の先頭がペルソナではないため、適用できません。")
+        return False
+    summary = history_summarizer.get_summary(history)
+    head_turn = {"role": "user", "parts": [persona_content]}
+    replace_head_turn(channel_id, history_summarizer.with_summary(head_turn, summary) if summary else head_turn)
+    log_success("PERSONA_APPLY", f"CH[{channel_id}] の履歴にペルソナを適用しました。")
+    return True
+
 def get_channel_history(channel_id: int) -> list | None:
     """
     指定されたチャンネルIDの履歴を data_manager._data_cache から取得または初期化。
@@ -69,242 +152,338 @@ def get_channel_history(channel_id: int) -> list | None:
         return None # エラーを示すために None を返す
 
     str_channel_id = str(channel_id)
+    try:
+        history = history_cache.get(str_channel_id)
+    except HistoryLoadError as e:
+        # 読めない履歴を空とみなしてリセットすると、ディスク上の履歴まで上書きしてしまう
+        log_error("HISTORY", f"{e}今回は履歴を使わずに処理を中止します。")
+        return None
 
     # チャンネル履歴が存在しない、または空の場合に初期化
-    if str_channel_id not in history_cache or not history_cache[str_channel_id]:
+    if not history:
         log_action = "初期化" if str_channel_id not in history_cache else "再初期化"
         log_info("HISTORY", f"CH[{channel_id}] の履歴が見つからないか空のため、ペルソナファイルから{log_action}します。")
-        persona_content = _load_persona()
-        if persona_content:
-            initial_history = [{"role": "user", "parts": [persona_content]}]
-            # ★ 直接 data_manager のキャッシュを更新
-            history_cache[str_channel_id] = initial_history
-            log_success("HISTORY", f"CH[{channel_id}] の履歴をペルソナで正常に{log_action}しました。")
-        else:
-            log_error("HISTORY", f"CH[{channel_id}] の履歴{log_action}に失敗しました。ペルソナが読み込めません。")
-            history_cache[str_channel_id] = [] # 空のリストで初期化しておく
+        _reset_channel_history(str_channel_id, log_action)
 
     # 更新されたキャッシュからチャンネル履歴を返す
     # ★ history_cache が None でないことは上で確認済み
     return history_cache.get(str_channel_id) # .get() で安全にアクセス
 
-def add_message_to_history(channel_id: int, role: str, message: str):
-    """履歴にメッセージを追加 (data_manager._data_cache を直接更新)"""
+def _reset_channel_history(str_channel_id: str, log_action: str):
+    """チャンネルの履歴をペルソナだけの状態にする"""
+    persona_content = _load_persona()
+    if persona_content:
+        initial_history = [{"role": "user", "parts": [persona_content]}]
+        _swap_history(str_channel_id, initial_history)
+        data_manager.get_history_backend().reset_channel(str_channel_id, initial_history)
+        history_trimmer.invalidate(str_channel_id)
+        context_cache.invalidate_channel(str_channel_id)
+        log_success("HISTORY", f"CH[{str_channel_id}] の履歴をペルソナで正常に{log_action}しました。")
+    else:
+        log_error("HISTORY", f"CH[{str_channel_id}] の履歴{log_action}に失敗しました。ペルソナが読み込めません。")
+        _swap_history(str_channel_id, []) # 空のリストで初期化しておく
+        data_manager.get_history_backend().reset_channel(str_channel_id, [])
+
+def reset_histories():
+    """全チャンネルの会話履歴 (要約を含む) をペルソナだけの状態に戻す"""
+    history_cache = data_manager.get_data('history')
+    if history_cache is None:
+        raise RuntimeError("履歴キャッシュが初期化されていません。")
+    for str_channel_id in history_cache.known_channels():
+        history_summarizer.discard_pending(str_channel_id)
+        memory_extractor.discard_pending(str_channel_id)
+        _reset_channel_history(str_channel_id, "リセット")
+
+def get_history_for_channel(channel_id: int) -> list | None:
+    """チャンネルの履歴を返す (存在しなければ初期化せずに None)。返したリストは変更しないこと"""
+    history_cache = data_manager.get_data('history')
+    if history_cache is None:
+        return None
+    try:
+        return history_cache.get(str(channel_id))
+    except HistoryLoadError as e:
+        log_error("HISTORY", str(e))
+        return None
+
+def history_lock(channel_id) -> asyncio.Lock:
+    """
+    チャンネルの履歴を書き換える処理を直列化するロック。
+    読み取りはスナップショットで行えるためロック不要。書き換えの途中で await する場合は必ずこのロックの中で行う。
+    """
+    str_channel_id = str(channel_id)
+    lock = _history_locks.get(str_channel_id)
+    if lock is None:
+        lock = _history_locks[str_channel_id] = asyncio.Lock()
+    return lock
+
+def get_history_version(channel_id) -> int:
+    """チャンネルの履歴のバージョン (履歴が差し替えられるたびに変わる)"""
+    return _history_versions.get(str(channel_id), _base_version)
+
+def get_history_snapshot(channel_id) -> tuple[int, list] | None:
+    """
+    (バージョン, 履歴リスト) を返す。履歴は copy-on-write で差し替えられるため、
+    このリストは後から変更されない。取得・初期化に失敗した場合は None
+    """
+    history = get_channel_history(channel_id)
+    if history is None:
+        return None
+    return get_history_version(channel_id), history
+
+def _swap_history(channel_id, new_history: list):
+    """履歴リストを差し替えてバージョンを進める (履歴への変更はすべてここを通す)"""
+    str_channel_id = str(channel_id)
+    data_manager.get_data('history')[str_channel_id] = new_history
+    _history_versions[str_channel_id] = next(_version_counter)
+
+def replace_head_turn(channel_id, head_turn: dict):
+    """履歴の先頭 (ペルソナ・要約) を差し替える"""
+    history = get_channel_history(channel_id)
+    if not history:
+        return
+    _swap_history(channel_id, [head_turn] + history[1:])
+    data_manager.get_history_backend().update_turn(str(channel_id), 0, head_turn)
+    on_history_head_changed(channel_id)
+
+def on_history_head_changed(channel_id):
+    """履歴の先頭 (ペルソナ・要約) が差し替えられたときに呼ぶ"""
+    history_trimmer.invalidate(channel_id)
+    context_cache.invalidate_channel(channel_id)
+
+def commit_turns(channel_id: int, turns: list[dict], model_name: str = None):
+    """
+    履歴の末尾にターンをまとめて追加する (user と model のターンが他の処理の追加と交互に混ざらない)。
+    追加前に、model_name のトークン予算に収まるよう古い会話を削除する。
+    現在の履歴をコピーして変更し、最後に差し替える (copy-on-write)。
+    """
+    if not turns:
+        return
     # 履歴リストを取得（存在しなければ初期化も試みる）
     history = get_channel_history(channel_id)
     if history is None:
          log_error("HISTORY_ADD", f"CH[{channel_id}] の履歴リスト取得に失敗したため、メッセージを追加できません。")
          return # 履歴リストが取得できなければ追加しない
+    new_history = list(history)
+    history_trimmer.carry_over(channel_id, history, new_history)
 
-    # 履歴制限チェック
+    # 履歴制限チェック (推定トークン数と最大メッセージ数)
     try:
-        max_history_length = config.get_max_history_length()
-        if len(history) >= max_history_length:
-            if len(history) >= 3: # ペルソナ + 1ペア以上ある場合
-                 # ペルソナ(最初のuserメッセージ)は削除しない
-                 del history[1:3] # インデックス1と2 (ペルソナ直後のペア) を削除
-                 log_warning("HISTORY", f"CH[{channel_id}] の履歴が長すぎるため、古い会話ペア(ペルソナ直後)を削除しました。")
-            elif len(history) == 2 and history[0].get("role") == "user":
-                 # ペルソナ + model応答のみの場合、model応答を削除？(仕様による)
-                 # ここでは何もしないか、警告を出す程度が良いかも
-                 log_warning("HISTORY", f"CH[{channel_id}] 履歴が最大長ですが、ペルソナと応答のみのため削除しませんでした。")
-
-    except AttributeError:
-        log_warning("HISTORY", "configにget_max_history_lengthが見つかりません。履歴制限はスキップされます。")
+        evicted = history_trimmer.trim_to_budget(channel_id, new_history, model_name or config.MODEL_PRO)
+        if evicted:
+            # ペルソナ(インデックス0)の直後から削除されている
+            data_manager.get_history_backend().delete_turns(str(channel_id), 1, 1 + len(evicted))
+            context_cache.invalidate_channel(channel_id)
+            # 削除した会話はバックグラウンドで要約に畳み込む
+            history_summarizer.queue_evicted(channel_id, evicted)
     except Exception as e:
         log_error("HISTORY", f"履歴削除中にエラー: {e}")
 
-    # ★ history は _data_cache['history'][str_channel_id] への参照なので、
-    #    ここに append すれば直接キャッシュが更新される
-    history.append({"role": role, "parts": [message]})
-    log_info("HISTORY", f"CH[{channel_id}] の履歴に {role} のメッセージを追加しました。 (現在の履歴数: {len(history)})")
+    for turn in turns:
+        new_history.append(turn)
+        history_trimmer.note_appended(channel_id, new_history, turn)
+    _swap_history(channel_id, new_history)
+    data_manager.get_history_backend().append_turns(str(channel_id), turns) # 追加分だけを書き込む
+    memory_extractor.queue_turns(channel_id, turns) # 記憶の抽出はバックグラウンドでまとめて行う
+    roles = ", ".join(turn["role"] for turn in turns)
+    log_info("HISTORY", f"CH[{channel_id}] の履歴に {roles} のメッセージを追加しました。 (現在の履歴数: {len(new_history)})")
+
+def add_message_to_history(channel_id: int, role: str, message: str, model_name: str = None):
+    """履歴にメッセージを1件追加する"""
+    commit_turns(channel_id, [{"role": role, "parts": [message]}], model_name)
+
 
+async def _consume_stream(chat, prompt: str, on_text, generation_config: dict | None = None):
+    """ストリーミングで応答を受信し、届いたテキストを順に on_text に渡す。受信し終えた応答を返す"""
+    response = await chat.send_message_async(prompt, stream=True, generation_config=generation_config)
+    async for chunk in response:
+        try:
+            text = chunk.text
+        except ValueError:
+            continue # テキストを含まないチャンク (終了理由のみなど)
+        if text:
+            on_text(text)
+    return response
 
-async def send_request(model_name: str, prompt: str, channel_id: int = None):
-    """AIモデルにリクエストを送信し、応答を取得 (APIキー再試行・レート制限対応付き)"""
-    global current_api_key_index
+async def send_request(model_name: str, prompt: str, channel_id: int = None, stream_callback=None, user_message: str = None,
+                       low_priority: bool = False, generation_config: dict | None = None):
+    """
+    AIモデルにリクエストを送信し、応答を取得 (APIキー再試行・レート制限対応付き)
+    stream_callback を指定するとストリーミングで受信し、届いたテキストを順に渡す。
+    user_message は成功時に応答と一緒に履歴へ追加するユーザー側の発言 (channel_id を指定した場合のみ)。
+    low_priority の場合は空いているAPIキーだけを使い、なければ待たずに None を返す (バックグラウンド処理用)。
+    generation_config は構造化出力 (response_mime_type, response_schema) などの生成設定。
+    """
     log_info("AI_REQUEST", f"モデル '{model_name}' へのリクエスト処理を開始します...")
     log_info("AI_REQUEST_DEBUG", f"使用モデル名: {model_name}")
 
-    # --- ユーザーメッセージの履歴追加準備 ---
-    user_message_content = None
+    # --- 履歴のスナップショット取得（ここで初期化も行われる） ---
+    # ★ 履歴は copy-on-write なので、リクエスト中に他の処理が履歴を更新してもこのリストは変化しない
+    history_version = None
+    history_list_ref = []
     if channel_id is not None:
-        try:
-            if config.bot is None:
-                log_error("AI_REQUEST_CONFIG", "config.botがNoneです。Cogにアクセスできません。")
-            else:
-                chat_cog = config.bot.get_cog('ChatManagerCog')
-                if chat_cog:
-                    str_channel_id = str(channel_id)
-                    unread_messages = chat_cog.unread_data.get(str_channel_id, [])
-                    if unread_messages:
-                         user_messages_for_history = [
-                             f"[{m.get('author','Unknown')} @ {m.get('timestamp','')}]: {m.get('content','')}"
-                             for m in unread_messages
-                         ]
-                         user_message_content = "\n".join(user_messages_for_history)
-                else:
-                    log_warning("AI_REQUEST_COG", "ChatManagerCogが見つかりません。")
-        except Exception as e:
-            log_error("AI_REQUEST_HISTORY_PREP", f"履歴準備中にエラー: {e}")
-            user_message_content = None
-    # ------------------------------------
-
-    # --- 履歴取得（ここで初期化も行われる） ---
-    # ★ get_channel_history は data_manager._data_cache['history'] 内のリストへの参照を返す
-    history_list_ref = get_channel_history(channel_id) if channel_id is not None else []
-    if history_list_ref is None and channel_id is not None:
-         log_error("AI_REQUEST", f"CH[{channel_id}] の履歴取得/初期化に失敗したため、リクエストを中止します。")
-         return None # 履歴がなければリクエストできない
+        snapshot = get_history_snapshot(channel_id)
+        if snapshot is None:
+            log_error("AI_REQUEST", f"CH[{channel_id}] の履歴取得/初期化に失敗したため、リクエストを中止します。")
+            return None # 履歴がなければリクエストできない
+        history_version, history_list_ref = snapshot
+
+    # usage_metadata との比較用に、送信するプロンプトの推定トークン数(補正前)を控えておく
+    estimated_prompt_tokens = history_trimmer.estimate_text_tokens(prompt)
+    if channel_id is not None:
+        estimated_prompt_tokens += history_trimmer.history_raw_tokens(channel_id, history_list_ref)
     # ------------------------------------
 
-    # --- APIキーリスト作成 ---
-    api_keys_to_try = []
-    for env_var in API_KEY_ENV_VARS:
-        key = os.getenv(env_var)
-        if key:
-            api_keys_to_try.append(key)
+    # --- APIキーリスト取得 (起動時に構築したプールを使用) ---
+    api_keys_to_try = client_pool.get_api_keys()
+    if not api_keys_to_try:
+        # プール未構築の場合のみ環境変数を読み直す
+        client_pool.refresh_api_keys()
+        api_keys_to_try = client_pool.get_api_keys()
     log_info("AI_REQUEST_DEBUG", f"読み込んだAPIキーの数: {len(api_keys_to_try)}")
     if not api_keys_to_try:
         log_error("AI_REQUEST_ERROR", "利用可能なGemini APIキーが環境変数に見つかりません。")
         return None
     # ------------------------------------
 
-    # --- 再試行ループ ---
+    # --- キースケジューラによる再試行ループ ---
+    # レート制限を受けたキーは待たずにクールダウンさせ、次に健康なキーへ即座に切り替える。
+    # 全キーがクールダウン中の場合のみ、最短で空くキーを待つ。
+    key_scheduler.sync_keys(api_keys_to_try)
     last_exception = None
     successful_key = None
     response = None
-    max_retries_per_key = 1
+    failed_keys = set() # レート制限以外のエラーで失敗したキー (このリクエストでは再利用しない)
+    max_attempts = len(api_keys_to_try) * 2
+    attempts = 0
+    streamed = False # ストリーミングで一部でも表示したか (表示後は別のキーで再試行しない)
 
-    start_index = current_api_key_index if 0 <= current_api_key_index < len(api_keys_to_try) else 0
-    ordered_keys = api_keys_to_try[start_index:] + api_keys_to_try[:start_index]
+    def on_stream_text(text: str):
+        nonlocal streamed
+        streamed = True
+        stream_callback(text)
+
+    try:
+        api_timeout = config.get_api_timeout()
+    except AttributeError:
+        log_warning("AI_REQUEST_CONFIG", "configにget_api_timeoutが見つかりません。デフォルトの120秒を使用します。")
+        api_timeout = 120
+
+    while attempts < max_attempts and len(failed_keys) < len(api_keys_to_try):
+        if streamed:
+            log_error("AI_REQUEST_STREAM", "応答の一部を表示した後に失敗したため、再試行しません。")
+            break
+        key_state = key_scheduler.acquire(model_name, exclude=failed_keys, low_priority=low_priority)
+        if key_state is None:
+            if low_priority:
+                log_info("AI_REQUEST", "低優先度のリクエストに使える空きAPIキーがないため、送信を見送ります。")
+                return None
+            wait_duration = key_scheduler.seconds_until_any_available(model_name, exclude=failed_keys)
+            if wait_duration is None:
+                break
+            max_wait = config.get_max_key_wait()
+            if wait_duration > max_wait:
+                log_error("AI_REQUEST_RATE_LIMIT", f"すべてのAPIキーがクールダウン中です (最短 {wait_duration:.1f}秒 > 上限 {max_wait}秒)。リクエストを中止します。")
+                break
+            log_info("AI_REQUEST_RATE_LIMIT", f"すぐに使えるAPIキーがありません。{wait_duration:.1f}秒待機します...")
+            await asyncio.sleep(wait_duration)
+            continue
+
+        attempts += 1
+        api_key = key_state.api_key
+        key_number = key_state.number
+        log_info("AI_REQUEST", f"APIキー {key_number}/{len(api_keys_to_try)} を使用して試行します... (実行中: {key_state.in_flight})")
 
-    key_index_to_try = 0
-    while key_index_to_try < len(ordered_keys):
-        api_key = ordered_keys[key_index_to_try]
-        current_index_in_original_list = -1
         try:
-            current_index_in_original_list = api_keys_to_try.index(api_key)
-        except ValueError:
-             log_error("AI_REQUEST_INTERNAL", f"キーインデックスの取得に失敗: {api_key[:5]}...")
-             key_index_to_try += 1
-             continue
-
-        log_info("AI_REQUEST", f"APIキー {current_index_in_original_list + 1}/{len(api_keys_to_try)} (Index: {current_index_in_original_list}) を使用して試行します...")
-
-        retries_with_current_key = 0
-        should_wait_before_next_key = False
-        wait_duration = 0
-
-        while retries_with_current_key <= max_retries_per_key:
-            try:
-                genai.configure(api_key=api_key)
-                model = genai.GenerativeModel(model_name)
-
-                # ★★★ start_chat に渡す履歴リストの参照を使用 ★★★
-                if not history_list_ref or history_list_ref[0].get("role") != "user":
-                     log_warning("AI_REQUEST_HISTORY_WARN", f"CH[{channel_id}] の履歴が空か、最初の要素が'user'ではありません。API呼び出しに失敗する可能性があります。History: {history_list_ref}")
-                     # 空リストで試行
-                     chat = model.start_chat(history=[])
-                else:
-                     chat = model.start_chat(history=history_list_ref) # ★ ここで参照を渡す
-
-                log_info("AI_REQUEST", f"モデル '{model_name}' にリクエストを送信します...")
-                try:
-                    api_timeout = config.get_api_timeout()
-                except AttributeError:
-                    log_warning("AI_REQUEST_CONFIG", "configにget_api_timeoutが見つかりません。デフォルトの120秒を使用します。")
-                    api_timeout = 120
+            # ★ プールからキー専用のモデルを取得 (genai.configure は使わない)
+            model = client_pool.get_model(api_key, model_name)
+
+            # ★★★ start_chat に渡す履歴リストの参照を使用 ★★★
+            if not history_list_ref or history_list_ref[0].get("role") != "user":
+                 log_warning("AI_REQUEST_HISTORY_WARN", f"CH[{channel_id}] の履歴が空か、最初の要素が'user'ではありません。API呼び出しに失敗する可能性があります。History: {history_list_ref}")
+                 # 空リストで試行
+                 chat = model.start_chat(history=[])
+            else:
+                 # ★ 履歴の前半がキャッシュ済みなら、キャッシュを参照するモデルと残りの履歴だけを使う
+                 model, chat_history = context_cache.prepare(api_key, model_name, channel_id, history_list_ref)
+                 chat = model.start_chat(history=chat_history)
 
+            log_info("AI_REQUEST", f"モデル '{model_name}' にリクエストを送信します...")
+            if stream_callback is None:
                 response = await asyncio.wait_for(
-                    chat.send_message_async(prompt), # 安全性設定なし
+                    chat.send_message_async(prompt, generation_config=generation_config), # 安全性設定なし
                     timeout=api_timeout
                 )
-                log_info("AI_REQUEST_DEBUG", "chat.send_message_async の呼び出しが完了しました。")
-
-                if not hasattr(response, 'text'):
-                     # (応答オブジェクトのチェック処理)
-                     feedback = getattr(response, 'prompt_feedback', None)
-                     candidates = getattr(response, 'candidates', [])
-                     log_error("AI_RESPONSE", "モデルからの応答に text 属性が含まれていません。")
-                     if feedback: log_error("AI_RESPONSE_DEBUG", f"Prompt Feedback: {feedback}")
-                     if candidates: log_error("AI_RESPONSE_DEBUG", f"Candidates: {candidates}")
-                     else: log_error("AI_RESPONSE_DEBUG", f"受信したresponseオブジェクト: {response}")
-                     last_exception = Exception(f"Invalid response object received. Feedback: {feedback}, Candidates: {candidates}")
-                     retries_with_current_key = max_retries_per_key + 1
-                     continue
-
-                # 成功！
-                successful_key = api_key
-                current_api_key_index = current_index_in_original_list
-                log_success("AI_RESPONSE", f"APIキー {current_index_in_original_list + 1} で応答を受信しました。")
-                break # 内側ループ脱出
-
-            except google.api_core.exceptions.ResourceExhausted as e:
-                # (レート制限エラーの処理)
-                log_warning("AI_REQUEST_RATE_LIMIT", f"レート制限エラー発生 (APIキー {current_index_in_original_list + 1}): {e}")
-                last_exception = e
-                retries_with_current_key += 1
-                retry_delay_seconds = 60
-                try:
-                    match = re.search(r"Please retry in (\d+\.?\d*)s", str(e))
-                    if match: retry_delay_seconds = float(match.group(1)) + 1.5
-                except Exception as parse_error:
-                    log_warning("AI_REQUEST_RATE_LIMIT", f"待機時間の抽出に失敗: {parse_error}。デフォルトの{retry_delay_seconds}秒を使用します。")
-                wait_duration = retry_delay_seconds
-                should_wait_before_next_key = True
-                if retries_with_current_key <= max_retries_per_key:
-                    log_info("AI_REQUEST_RATE_LIMIT", f"{retry_delay_seconds:.1f}秒待機してから同じAPIキーで再試行します (試行 {retries_with_current_key}/{max_retries_per_key})...")
-                    await asyncio.sleep(retry_delay_seconds)
-                    continue
-                else:
-                    log_warning("AI_REQUEST_RATE_LIMIT", f"APIキー {current_index_in_original_list + 1} での再試行上限に達しました。")
-                    break
-
-            except genai.types.StopCandidateException as e:
-                 # (安全性ブロックエラーの処理 - 次のキーへ)
-                 log_error("AI_REQUEST_SAFETY", f"コンテンツが安全性によりブロックされました (APIキー {current_index_in_original_list + 1}) - 安全設定削除後も発生?: {e}")
-                 try:
-                     if response and hasattr(response, 'prompt_feedback') and response.prompt_feedback:
-                          log_error("AI_REQUEST_SAFETY", f"Prompt Feedback: {response.prompt_feedback}")
-                 except Exception as feedback_error:
-                      log_error("AI_REQUEST_SAFETY", f"Feedback取得中にエラー: {feedback_error}")
-                 last_exception = e
-                 retries_with_current_key = max_retries_per_key + 1
-                 break
-
-            except asyncio.TimeoutError:
-                # (タイムアウトエラーの処理 - 次のキーへ)
-                log_error("AI_REQUEST_ERROR", f"APIリクエストがタイムアウトしました (APIキー {current_index_in_original_list + 1})。")
-                last_exception = asyncio.TimeoutError("API request timed out.")
-                retries_with_current_key = max_retries_per_key + 1
-                break
-            except Exception as e:
-                # (その他のエラーの処理)
-                if "history must begin with a user message" in str(e) or "must alternate between" in str(e):
-                    log_error("AI_REQUEST_HISTORY_INVALID", f"履歴形式エラー (APIキー {current_index_in_original_list + 1}): {e}")
-                    log_error("AI_REQUEST_HISTORY_INVALID", f"問題の履歴 (先頭5件): {history_list_ref[:5]}")
-                    last_exception = e
-                    successful_key = None
-                    key_index_to_try = len(ordered_keys)
-                    break
-                else:
-                    log_error("AI_REQUEST_ERROR", f"予期せぬエラー (APIキー {current_index_in_original_list + 1}): {type(e).__name__} - {e}")
-                    log_error("AI_REQUEST_ERROR", traceback.format_exc())
-                    last_exception = e
-                    retries_with_current_key = max_retries_per_key + 1
-                    break
-        # --- 内側ループ終了 ---
-
-        if successful_key:
+            else:
+                response = await asyncio.wait_for(
+                    _consume_stream(chat, prompt, on_stream_text, generation_config),
+                    timeout=api_timeout
+                )
+            log_info("AI_REQUEST_DEBUG", "chat.send_message_async の呼び出しが完了しました。")
+
+            if not hasattr(response, 'text'):
+                 # (応答オブジェクトのチェック処理)
+                 feedback = getattr(response, 'prompt_feedback', None)
+                 candidates = getattr(response, 'candidates', [])
+                 log_error("AI_RESPONSE", "モデルからの応答に text 属性が含まれていません。")
+                 if feedback: log_error("AI_RESPONSE_DEBUG", f"Prompt Feedback: {feedback}")
+                 if candidates: log_error("AI_RESPONSE_DEBUG", f"Candidates: {candidates}")
+                 else: log_error("AI_RESPONSE_DEBUG", f"受信したresponseオブジェクト: {response}")
+                 last_exception = Exception(f"Invalid response object received. Feedback: {feedback}, Candidates: {candidates}")
+                 key_scheduler.report_error(key_state)
+                 failed_keys.add(api_key)
+                 continue
+
+            # 成功！
+            successful_key = api_key
+            key_scheduler.report_success(key_state)
+            log_success("AI_RESPONSE", f"APIキー {key_number} で応答を受信しました。")
             break
 
-        if should_wait_before_next_key and wait_duration > 0:
-            log_info("AI_REQUEST_RATE_LIMIT", f"{wait_duration:.1f}秒待機してから次のAPIキーを試します...")
-            await asyncio.sleep(wait_duration)
+        except google.api_core.exceptions.ResourceExhausted as e:
+            # (レート制限エラーの処理 - キーをクールダウンさせて即座に次のキーへ)
+            log_warning("AI_REQUEST_RATE_LIMIT", f"レート制限エラー発生 (APIキー {key_number}): {e}")
+            last_exception = e
+            retry_delay_seconds = key_scheduler_module.parse_retry_delay(str(e), default=58.5) + 1.5
+            key_scheduler.report_rate_limited(key_state, model_name, retry_delay_seconds)
+
+        except genai.types.StopCandidateException as e:
+             # (安全性ブロックエラーの処理 - 次のキーへ)
+             log_error("AI_REQUEST_SAFETY", f"コンテンツが安全性によりブロックされました (APIキー {key_number}) - 安全設定削除後も発生?: {e}")
+             try:
+                 if response and hasattr(response, 'prompt_feedback') and response.prompt_feedback:
+                      log_error("AI_REQUEST_SAFETY", f"Prompt Feedback: {response.prompt_feedback}")
+             except Exception as feedback_error:
+                  log_error("AI_REQUEST_SAFETY", f"Feedback取得中にエラー: {feedback_error}")
+             last_exception = e
+             key_scheduler.report_error(key_state)
+             failed_keys.add(api_key)
+
+        except asyncio.TimeoutError:
+            # (タイムアウトエラーの処理 - 次のキーへ)
+            log_error("AI_REQUEST_ERROR", f"APIリクエストがタイムアウトしました (APIキー {key_number})。")
+            last_exception = asyncio.TimeoutError("API request timed out.")
+            key_scheduler.report_error(key_state)
+            failed_keys.add(api_key)
+
+        except asyncio.CancelledError:
+            key_scheduler.release(key_state)
+            raise
 
-        key_index_to_try += 1
-    # --- 外側ループ終了 ---
+        except Exception as e:
+            # (その他のエラーの処理)
+            key_scheduler.report_error(key_state)
+            failed_keys.add(api_key)
+            if channel_id is not None:
+                context_cache.discard(api_key, model_name, channel_id) # 失効したキャッシュが原因の可能性があるため手放す
+            if "history must begin with a user message" in str(e) or "must alternate between" in str(e):
+                log_error("AI_REQUEST_HISTORY_INVALID", f"履歴形式エラー (APIキー {key_number}): {e}")
+                log_error("AI_REQUEST_HISTORY_INVALID", f"問題の履歴 (先頭5件): {history_list_ref[:5]}")
+                last_exception = e
+                break # 履歴の問題はキーを変えても解決しない
+            log_error("AI_REQUEST_ERROR", f"予期せぬエラー (APIキー {key_number}): {type(e).__name__} - {e}")
+            log_error("AI_REQUEST_ERROR", traceback.format_exc())
+            last_exception = e
+    # --- ループ終了 ---
 
     # --- 最終的な失敗処理 ---
     if successful_key is None:
@@ -321,21 +500,23 @@ async def send_request(model_name: str, prompt: str, channel_id: int = None):
     if channel_id is not None:
         log_info("AI_REQUEST_HISTORY_ADD", f"履歴追加処理を開始: channel_id={channel_id}")
         try:
-            # ★ add_message_to_history は内部で get_channel_history を呼ぶので、
-            #   ここで history_list_ref を渡す必要はない
-            if user_message_content:
-                log_info("AI_REQUEST_HISTORY_ADD", f"ユーザーメッセージを履歴に追加試行 (内容冒頭): {user_message_content[:100]}...")
-                add_message_to_history(channel_id, "user", user_message_content) # ★ 直接キャッシュを更新
-                log_info("AI_REQUEST_HISTORY_ADD", "ユーザーメッセージを履歴に追加完了。")
+            turns = []
+            if user_message:
+                log_info("AI_REQUEST_HISTORY_ADD", f"ユーザーメッセージを履歴に追加 (内容冒頭): {user_message[:100]}...")
+                turns.append({"role": "user", "parts": [user_message]})
             else:
-                log_info("AI_REQUEST_HISTORY_ADD", "ユーザーメッセージ(user_message_content)が空のため、履歴に追加しません。")
-
+                log_info("AI_REQUEST_HISTORY_ADD", "ユーザーメッセージ(user_message)が空のため、履歴に追加しません。")
             if response_text:
-                 log_info("AI_REQUEST_HISTORY_ADD", f"モデル応答を履歴に追加試行 (内容冒頭): {response_text[:100]}...")
-                 add_message_to_history(channel_id, "model", response_text) # ★ 直接キャッシュを更新
-                 log_info("AI_REQUEST_HISTORY_ADD", "モデル応答を履歴に追加完了。")
+                 log_info("AI_REQUEST_HISTORY_ADD", f"モデル応答を履歴に追加 (内容冒頭): {response_text[:100]}...")
+                 turns.append({"role": "model", "parts": [response_text]})
             else:
                  log_info("AI_REQUEST_HISTORY_ADD", "モデル応答(response_text)が空のため、履歴に追加しません。")
+            async with history_lock(channel_id):
+                if get_history_version(channel_id) != history_version:
+                    log_info("AI_REQUEST_HISTORY_ADD", f"CH[{channel_id}] の履歴がリクエスト中に更新されたため、最新の履歴の末尾に追加します。")
+                # user と model のターンは1回の差し替えでまとめて追加する
+                commit_turns(channel_id, turns, model_name)
+            log_info("AI_REQUEST_HISTORY_ADD", "履歴追加完了。")
         except Exception as history_error:
             log_error("AI_REQUEST_HISTORY_ADD", f"履歴追加中に予期せぬエラーが発生しました: {type(history_error).__name__} - {history_error}")
             log_error("AI_REQUEST_HISTORY_ADD", traceback.format_exc())
@@ -350,6 +531,7 @@ async def send_request(model_name: str, prompt: str, channel_id: int = None):
             candidates_token_count = response.usage_metadata.candidates_token_count
             total_token_count = response.usage_metadata.total_token_count
             log_info("TOKEN_COUNT", f"Prompt: {prompt_token_count}, Candidates: {candidates_token_count}, Total: {total_token_count}")
+            history_trimmer.calibrate(model_name, estimated_prompt_tokens, prompt_token_count)
         else:
             log_info("TOKEN_COUNT", "Usage metadata not available.")
     except Exception as token_error:
@@ -0,0 +1,69 @@
+# channel_scheduler.py
+#
+# チャンネルごとの次回の活動時刻を優先度付きキュー (ヒープ) で管理する。
+# 予定を変更した場合、古いエントリはヒープに残したまま無効として扱い、取り出す時に読み飛ばす。
+
+import heapq
+import itertools
+
+class ChannelScheduler:
+    """チャンネルIDごとに1つの予定 (time.monotonic 基準の時刻) を持つ"""
+
+    def __init__(self):
+        self._heap = []  # (予定時刻, 連番, チャンネルID)
+        self._plans = {} # チャンネルID -> (予定時刻, 連番) (有効な予定)
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._plans)
+
+    def __contains__(self, channel_id) -> bool:
+        return channel_id in self._plans
+
+    def get_due(self, channel_id) -> float | None:
+        plan = self._plans.get(channel_id)
+        return plan[0] if plan else None
+
+    def plan(self, channel_id, due: float, only_if_earlier: bool = False) -> bool:
+        """
+        チャンネルの予定を設定する。only_if_earlier が True なら、
+        既存の予定より早い場合のみ置き換える。予定を変更した場合は True を返す。
+        """
+        current = self._plans.get(channel_id)
+        if current is not None and only_if_earlier and current[0] <= due:
+            return False
+        seq = next(self._counter)
+        self._plans[channel_id] = (due, seq)
+        heapq.heappush(self._heap, (due, seq, channel_id))
+        # 無効なエントリが溜まりすぎたら作り直す
+        if len(self._heap) > 4 * len(self._plans) + 64:
+            self._heap = [(d, s, ch) for ch, (d, s) in self._plans.items()]
+            heapq.heapify(self._heap)
+        return True
+
+    def cancel(self, channel_id):
+        self._plans.pop(channel_id, None)
+
+    def _discard_stale(self):
+        while self._heap:
+            due, seq, channel_id = self._heap[0]
+            if self._plans.get(channel_id) == (due, seq):
+                return
+            heapq.heappop(self._heap)
+
+    def pop_due(self, now: float):
+        """予定時刻を過ぎたチャンネルのうち最も早いものを取り出す (なければ None)"""
+        self._discard_stale()
+        if not self._heap or self._heap[0][0] > now:
+            return None
+        _, _, channel_id = heapq.heappop(self._heap)
+        del self._plans[channel_id]
+        return channel_id
+
+    def seconds_until_next(self, now: float) -> float | None:
+        self._discard_stale()
+        return max(0.0, self._heap[0][0] - now) if self._heap else None
+
+    def items(self) -> list[tuple]:
+        """(チャンネルID, 予定時刻) を予定の早い順に返す"""
+        return sorted(((ch, plan[0]) for ch, plan in self._plans.items()), key=lambda item: item[1])
@@ -0,0 +1,168 @@
+# client_pool.py
+
+import os
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.api_core import client_options as client_options_lib
+from utils.console_display import log_system, log_info, log_warning
+
+try:
+    from dotenv import dotenv_values # 任意: .env からキーを読み直す場合のみ使う
+except ImportError:
+    dotenv_values = None
+
+# APIキーの環境変数名のリスト
+API_KEY_ENV_VARS = [
+    "GEMINI_API_KEY",
+    "GEMINI_API_KEY_1",
+    "GEMINI_API_KEY_2",
+    "GEMINI_API_KEY_3",
+]
+
+# 実行中に変更できるAPIキーの定義ファイル (作業ディレクトリからの相対パス)。
+# このファイルに書かれたキーは環境変数より優先し、refresh_api_keys() のたびに読み直す。
+API_KEY_ENV_FILE = ".env"
+
+# 起動時に読み込んだAPIキー (環境変数の順序を保持)
+_api_keys: tuple = ()
+# APIキーごとの非同期クライアント
+_async_clients = {}
+# (APIキー, モデル名) ごとの GenerativeModel
+_models = {}
+# APIキーごとのコンテキストキャッシュ用クライアント
+_cache_clients = {}
+# キャッシュ名 -> キャッシュを参照する GenerativeModel
+_cached_models = {}
+
+# 負荷試験用: 設定するとモック Gemini サーバー (tools/mock_gemini_server.py) に接続する偽のクライアントを使う
+FAKE_ENDPOINT_ENV_VAR = "GEMINI_FAKE_ENDPOINT"
+
+def _read_env_file() -> dict:
+    """API_KEY_ENV_FILE の内容を読む (ファイルがないか python-dotenv がなければ空)"""
+    if not os.path.isfile(API_KEY_ENV_FILE):
+        return {}
+    if dotenv_values is None:
+        log_warning("CLIENT_POOL", f"python-dotenv がインストールされていないため、'{API_KEY_ENV_FILE}' を読み込めません。")
+        return {}
+    return dotenv_values(API_KEY_ENV_FILE)
+
+def load_api_keys_from_env() -> list[str]:
+    """
+    APIキーを読み込む (重複は除外)。API_KEY_ENV_FILE に書かれたキーを優先し、
+    書かれていないものはプロセスの環境変数から読む。
+    """
+    env_file = _read_env_file()
+    keys = []
+    for env_var in API_KEY_ENV_VARS:
+        key = env_file.get(env_var) if env_var in env_file else os.getenv(env_var)
+        if key and key not in keys:
+            keys.append(key)
+    return keys
+
+def _build_async_client(api_key: str):
+    """
+    APIキー専用の非同期クライアントを作成する。
+    genai.configure() のようなグローバル状態は変更しないため、
+    異なるキーでの同時リクエストでも安全。
+    """
+    options = client_options_lib.ClientOptions(api_key=api_key)
+    return glm.GenerativeServiceAsyncClient(client_options=options)
+
+def get_fake_endpoint() -> str | None:
+    return os.getenv(FAKE_ENDPOINT_ENV_VAR) or None
+
+def _build_model(api_key: str, model_name: str):
+    fake_endpoint = get_fake_endpoint()
+    if fake_endpoint:
+        from tools.fake_gemini_client import FakeGenerativeModel # 負荷試験時のみ使う
+        return FakeGenerativeModel(model_name, api_key, fake_endpoint)
+    model = genai.GenerativeModel(model_name)
+    # ★ モデルにキー専用クライアントを結び付ける (デフォルトクライアントは使わない)
+    model._async_client = get_async_client(api_key)
+    return model
+
+def initialize(model_names: list[str] | None = None) -> int:
+    """
+    起動時にクライアントプールを構築する。
+    model_names が指定されていれば、各キーについてモデルも事前に作成しておく。
+    読み込んだAPIキーの数を返す。
+    """
+    refresh_api_keys()
+    for api_key in _api_keys:
+        get_async_client(api_key)
+        for model_name in model_names or []:
+            get_model(api_key, model_name)
+    log_system(f"Geminiクライアントプールを構築しました。(APIキー: {len(_api_keys)}個, モデル: {len(_models)}個)")
+    if get_fake_endpoint():
+        log_warning("CLIENT_POOL", f"{FAKE_ENDPOINT_ENV_VAR} が設定されているため、モックサーバー ({get_fake_endpoint()}) に接続します。")
+    return len(_api_keys)
+
+def refresh_api_keys() -> bool:
+    """
+    .env と環境変数からAPIキーを読み直し、変更があった場合のみプールを更新する。
+    削除されたキーのクライアントとモデルは破棄される。変更があれば True を返す。
+    """
+    global _api_keys
+    new_keys = tuple(load_api_keys_from_env())
+    if new_keys == _api_keys:
+        return False
+
+    removed_keys = set(_api_keys) - set(new_keys)
+    for api_key in removed_keys:
+        _async_clients.pop(api_key, None)
+        _cache_clients.pop(api_key, None)
+    for cache_name in [n for n, m in _cached_models.items() if m[0] in removed_keys]:
+        del _cached_models[cache_name]
+    for pool_key in [k for k in _models if k[0] in removed_keys]:
+        del _models[pool_key]
+
+    _api_keys = new_keys
+    if not _api_keys:
+        log_warning("CLIENT_POOL", "利用可能なGemini APIキーが環境変数に見つかりません。")
+    else:
+        log_info("CLIENT_POOL", f"APIキーを読み込みました。(キー数: {len(_api_keys)}, 破棄: {len(removed_keys)})")
+    return True
+
+def get_api_keys() -> list[str]:
+    """プールに登録されているAPIキーのリストを返す"""
+    return list(_api_keys)
+
+def get_async_client(api_key: str):
+    """APIキー専用の非同期クライアントを取得 (なければ作成)"""
+    client = _async_clients.get(api_key)
+    if client is None:
+        client = _build_async_client(api_key)
+        _async_clients[api_key] = client
+    return client
+
+def get_model(api_key: str, model_name: str):
+    """(APIキー, モデル名) に対応する GenerativeModel を取得 (なければ作成)"""
+    pool_key = (api_key, model_name)
+    model = _models.get(pool_key)
+    if model is None:
+        model = _build_model(api_key, model_name)
+        _models[pool_key] = model
+    return model
+
+def get_cache_client(api_key: str):
+    """APIキー専用のコンテキストキャッシュ用クライアントを取得 (なければ作成)"""
+    client = _cache_clients.get(api_key)
+    if client is None:
+        options = client_options_lib.ClientOptions(api_key=api_key)
+        client = glm.CacheServiceAsyncClient(client_options=options)
+        _cache_clients[api_key] = client
+    return client
+
+def get_cached_model(api_key: str, model_name: str, cache_name: str):
+    """サーバー側のキャッシュ (CachedContent) を前提として使う GenerativeModel を取得 (なければ作成)"""
+    entry = _cached_models.get(cache_name)
+    if entry is None:
+        model = _build_model(api_key, model_name)
+        model._cached_content = cache_name
+        entry = (api_key, model)
+        _cached_models[cache_name] = entry
+    return entry[1]
+
+def drop_cached_model(cache_name: str):
+    """削除・失効したキャッシュを参照するモデルを破棄する"""
+    _cached_models.pop(cache_name, None)
@@ -11,12 +11,16 @@ DATA_DIR = ""
 TOKEN_ENV_VAR = ""
 PERSONA_FILE = ""
 EMOTION_ANALYZER_PERSONA_FILE = ""
+EMOTION_LEXICON_FILE = ""
 SETTING_FILE = ""
 HISTORY_FILE = ""
+HISTORY_JOURNAL_DIR = ""
+HISTORY_DB_FILE = ""
 UNREAD_MESSAGES_FILE = ""
 EMOTION_FILE = ""
 SCHEDULE_FILE = ""
 MEMORY_FILE = ""
+VOICE_CACHE_DIR = ""
 
 GEMINI_API_KEY_1 = os.getenv("GEMINI_API_KEY_1")
 GEMINI_API_KEY_2 = os.getenv("GEMINI_API_KEY_2")
@@ -37,18 +41,183 @@ VOICEVOX_STYLE_MAP = {
 }
 VOICEVOX_DEFAULT_STYLE_ID = 50
 VOICEVOX_SPEED_SCALE = 1.0
+VOICEVOX_VOLUME_SCALE = 3.0
+# VOICEVOXへの同時リクエスト数 (CPU版のエンジンでは増やしすぎると逆に遅くなる)
+VOICEVOX_MAX_CONCURRENCY = 2
+# VOICEVOXへのリクエストのタイムアウト (秒)
+VOICEVOX_TIMEOUT = 60
+# 合成後に短いダミークエリを送ってエンジンのメモリを解放させるか (バックグラウンドで送信)
+VOICEVOX_RELEASE_MEMORY_QUERY = False
+
+# 応答をストリーミングで受信しながら、区切りごとに音声合成を始めるか
+VOICE_PIPELINE_ENABLED = True
+# 音声モードで、テキストを先に送信して音声を後から別メッセージで送るか
+# (ストリーミング表示が有効なチャンネルでは常にテキストが先になる)
+VOICE_SEND_TEXT_FIRST = False
+
+# 音声セグメントの間に挟む無音の長さ (ミリ秒)
+VOICE_SEGMENT_GAP_MS = 500
+# 送信する音声ファイルの形式: "wav" または "ogg" (ffmpeg で Opus に圧縮。失敗時は wav)
+VOICE_OUTPUT_FORMAT = "wav"
+VOICE_OPUS_BITRATE = "48k"
+FFMPEG_PATH = "ffmpeg"
+
+# 合成した音声と audio_query の結果をキャッシュするか
+VOICE_CACHE_ENABLED = True
+# メモリキャッシュの合計サイズの上限 (バイト)
+VOICE_CACHE_MEMORY_BYTES = 32 * 1024 * 1024
+# ディスクキャッシュの合計サイズの上限 (バイト)
+VOICE_CACHE_DISK_BYTES = 256 * 1024 * 1024
 
 # APIリクエストのタイムアウト時間 (秒)
 API_TIMEOUT = 120 # 例: 120秒
 
 # 履歴の最大長 (会話ターン数ではなく、user/modelメッセージの合計数)
 # 例: 50件 = 25往復分程度
+# トークン予算とは別の上限として併用されます
 MAX_HISTORY_LENGTH = 200
 
+# モデルごとのプロンプトトークン予算 (履歴 + 今回のプロンプト)
+# 応答時間とコストを抑えるための上限で、モデルのコンテキスト長そのものではありません
+PROMPT_TOKEN_BUDGETS = {
+    MODEL_PRO: 120000,
+    MODEL_PRO_2: 120000,
+    MODEL_PRO_3: 60000,
+    MODEL_FLASH: 60000,
+}
+DEFAULT_PROMPT_TOKEN_BUDGET = 60000
+# 予算のうち、今回のプロンプト (状態テキスト + 未読メッセージ) のために空けておくトークン数
+PROMPT_TOKEN_RESERVE = 8000
+# 予算を超えたとき、この割合まで一度にまとめて削除する
+HISTORY_TRIM_LOW_WATERMARK = 0.8
+
+# APIキー1つあたりの1分間のリクエスト上限 (モデルごと)
+API_KEY_REQUESTS_PER_MINUTE = 10
+
+# 全APIキーがクールダウン中のとき、空くのを待つ最大時間 (秒)
+MAX_KEY_WAIT_SECONDS = 30
+
+# チャンネルごとに保持する未読メッセージの上限件数
+UNREAD_MAX_PER_CHANNEL = 50
+# 上限を超えた場合の処理
+#   "drop_oldest": 古いメッセージから捨てる
+#   "summarize"  : 古いメッセージを省略し、件数と発言者だけをプロンプトに含める
+#   "collapse"   : 同じ発言者の連続したメッセージを1件にまとめ、それでも超える分は古いものから捨てる
+UNREAD_OVERFLOW_POLICY = "collapse"
+
+# プロンプトに含める記憶の上限 (応答するメッセージに関係の深いものから選ぶ)
+MEMORY_RETRIEVAL_TOP_K = 20
+# プロンプトに含める記憶の推定トークン数の上限
+MEMORY_RETRIEVAL_TOKEN_BUDGET = 1500
+
+# 会話から記憶を自動で抽出する (バックグラウンドで低優先度のリクエストを行う)
+MEMORY_EXTRACTION_ENABLED = True
+# 抽出に使うモデル (安価なもの)
+MEMORY_EXTRACTION_MODEL = MODEL_PRO_3
+# 抽出待ちの会話を確認する間隔 (秒)
+MEMORY_EXTRACTION_INTERVAL_SECONDS = 60
+# 抽出待ちのターンがこの数に達するか、溜まり始めてからこの秒数が経ったら抽出する
+MEMORY_EXTRACTION_MIN_TURNS = 20
+MEMORY_EXTRACTION_MAX_WAIT_SECONDS = 1800
+# 1回の抽出に使うターン数と、抽出する記憶の最大数
+MEMORY_EXTRACTION_MAX_BATCH_TURNS = 40
+MEMORY_EXTRACTION_MAX_ITEMS = 5
+# 抽出待ちとして保持するターンの上限 (超えた分は古いものから捨てる)
+MEMORY_EXTRACTION_MAX_PENDING_TURNS = 200
+# 既存の記憶との類似度 (文字 bigram の Dice 係数) がこれ以上なら重複とみなす
+MEMORY_DUPLICATE_THRESHOLD = 0.85
+
+# 感情が既定値 (default_emotions) へ戻っていく半減期 (秒)。None なら減衰しない
+# emotion.json の "decay_half_lives" で感情ごとに上書きできる
+EMOTION_DECAY_HALF_LIFE_SECONDS = 6 * 60 * 60
+
+# 感情分析の方法
+#   "llm"   : 対話をまとめて LLM で分析する
+#   "local" : ローカルの感情辞書だけで分析する (APIを呼ばない)
+#   "hybrid": ローカルの辞書で即座に反映し、手がかり語がない対話と補正用の対話だけ LLM で分析する
+EMOTION_ANALYSIS_MODE = "llm"
+# "hybrid" で、ローカルの辞書の倍率を LLM の結果で補正する間隔 (対話の件数)
+EMOTION_CALIBRATION_INTERVAL = 10
+# 感情分析に使うモデル
+EMOTION_ANALYSIS_MODEL = MODEL_FLASH
+# 応答後の感情分析は、この秒数だけ待って届いた対話 (全チャンネル) をまとめて1回で行う
+EMOTION_BATCH_WINDOW_SECONDS = 5
+# 1回の感情分析にまとめる対話の最大数
+EMOTION_BATCH_MAX_EXCHANGES = 8
+# 感情分析待ちとして保持する対話の上限 (超えた分は古いものから捨てる)
+EMOTION_MAX_PENDING_EXCHANGES = 64
+
+# 同時に応答処理を行うチャンネル数の上限 (None ならAPIキーの数)
+ACTIVITY_MAX_CONCURRENCY = None
+
+# リアクティブモード (メッセージを受信したら、連投が落ち着くのを待って応答する) の既定値
+# チャンネルごとに !reactive on/off で切り替えられる
+REACTIVE_MODE_DEFAULT = False
+# 活動レベルごとのリアクティブモードの待機時間 (秒)
+#   debounce : 最後のメッセージからこの時間新しいメッセージがなければ応答する
+#   min_delay: 最初のメッセージから最低限待つ時間
+#   max_delay: 連投が続いても、最初のメッセージからこの時間が経てば応答する
+# schedule.json の "reactive_params" で上書きできる
+REACTIVE_PARAMS = {
+    'active': {'debounce': 5, 'min_delay': 3, 'max_delay': 30},
+    'normal': {'debounce': 15, 'min_delay': 10, 'max_delay': 120},
+    'inactive': {'debounce': 60, 'min_delay': 60, 'max_delay': 900},
+}
+
+# 会話履歴の保存先: "journal" (チャンネルごとのJSONL) または "sqlite"
+STORAGE_BACKEND = "journal"
+
+# メモリ上に常駐させる会話履歴のチャンネル数 (超えると古いものから解放)
+HISTORY_MAX_RESIDENT_CHANNELS = 32
+
+# 履歴ジャーナルのコンパクション条件
+# 行数が max(最小行数, 履歴の長さ × 倍率) を超えたら書き直す
+HISTORY_JOURNAL_COMPACT_MIN_OPS = 100
+HISTORY_JOURNAL_COMPACT_RATIO = 2
+
 def get_api_timeout():
     """APIリクエストのタイムアウト時間を取得"""
     return API_TIMEOUT
 
+# 履歴から削除された会話を要約して先頭に保持するか
+HISTORY_SUMMARY_ENABLED = True
+# 要約に使うモデル (安価なもの)
+HISTORY_SUMMARY_MODEL = MODEL_PRO_3
+# 要約の最大文字数
+HISTORY_SUMMARY_MAX_CHARS = 1500
+# 要約待ちのターンの上限 (要約が見送られ続けた場合は古いものから捨てる)
+HISTORY_SUMMARY_MAX_PENDING_TURNS = 200
+
+# ペルソナと履歴の前半をサーバー側にキャッシュする (コンテキストキャッシュ)
+#   "gemini": Gemini の CachedContent を使用
+#   "local" : サーバーを使わずにキャッシュの作成・失効だけを模擬する (テスト用)
+#   "off"   : 使用しない
+CONTEXT_CACHE_MODE = "gemini"
+# キャッシュする履歴の単位 (ターン数)。この数ごとに固定部分を伸ばしてキャッシュを作り直す
+CONTEXT_CACHE_BLOCK_TURNS = 40
+# 固定部分の推定トークン数がこれ未満ならキャッシュしない (APIの最小トークン数)
+CONTEXT_CACHE_MIN_TOKENS = 4096
+# キャッシュの有効期間 (秒)
+CONTEXT_CACHE_TTL_SECONDS = 3600
+# キャッシュの作成に失敗したキーとモデルの組み合わせを再試行しない時間 (秒)
+CONTEXT_CACHE_RETRY_SECONDS = 600
+
+# ストリーミング表示 (応答を受信しながら Discord のメッセージを編集して伸ばす) の既定値
+# チャンネルごとに !stream on/off で切り替えられる
+STREAM_MODE_DEFAULT = False
+# ストリーミング表示でメッセージを編集する最短間隔 (秒)
+# Discord の編集レート制限 (おおむね5秒に5回) を超えないようにする
+STREAM_EDIT_INTERVAL = 1.0
+
+def get_history_token_budget(model_name: str) -> int:
+    """履歴に使えるトークン数 (プロンプト予算から今回のプロンプト分を除いたもの) を取得"""
+    budget = PROMPT_TOKEN_BUDGETS.get(model_name, DEFAULT_PROMPT_TOKEN_BUDGET)
+    return max(0, budget - PROMPT_TOKEN_RESERVE)
+
+def get_max_key_wait():
+    """全キーがクールダウン中の場合に待機する最大時間を取得"""
+    return MAX_KEY_WAIT_SECONDS
+
 def get_max_history_length():
     """履歴の最大長を取得"""
     return MAX_HISTORY_LENGTH
@@ -75,8 +244,8 @@ def init(character_name: str):
     起動時に指定されたキャラクター名に基づいて、全てのパスと設定を動的に初期化する
     """
     global CHARACTER_NAME, BASE_DIR, DATA_DIR, TOKEN_ENV_VAR, PERSONA_FILE
-    global EMOTION_ANALYZER_PERSONA_FILE, SETTING_FILE, HISTORY_FILE
-    global UNREAD_MESSAGES_FILE, EMOTION_FILE, SCHEDULE_FILE, MEMORY_FILE
+    global EMOTION_ANALYZER_PERSONA_FILE, EMOTION_LEXICON_FILE, SETTING_FILE, HISTORY_FILE, HISTORY_JOURNAL_DIR, HISTORY_DB_FILE
+    global UNREAD_MESSAGES_FILE, EMOTION_FILE, SCHEDULE_FILE, MEMORY_FILE, VOICE_CACHE_DIR
     
     CHARACTER_NAME = character_name
     log_system(f"キャラクター '{CHARACTER_NAME}' の設定を初期化します。")
@@ -96,13 +265,17 @@ def init(character_name: str):
     # --- ファイルパス ---
     PERSONA_FILE = os.path.join(BASE_DIR, "persona.txt")
     EMOTION_ANALYZER_PERSONA_FILE = os.path.join(BASE_DIR, "emotion.txt")
+    EMOTION_LEXICON_FILE = os.path.join(BASE_DIR, "emotion_lexicon.json") # 任意 (なければ既定の辞書のみ)
     
     SETTING_FILE = os.path.join(DATA_DIR, "setting.json")
-    HISTORY_FILE = os.path.join(DATA_DIR, "history.json")
+    HISTORY_FILE = os.path.join(DATA_DIR, "history.json") # 旧形式 (ジャーナルへの移行元)
+    HISTORY_JOURNAL_DIR = os.path.join(DATA_DIR, "history")
+    HISTORY_DB_FILE = os.path.join(DATA_DIR, "history.db")
     UNREAD_MESSAGES_FILE = os.path.join(DATA_DIR, "unread_messages.json")
     EMOTION_FILE = os.path.join(DATA_DIR, "emotion.json")
     SCHEDULE_FILE = os.path.join(DATA_DIR, "schedule.json")
     MEMORY_FILE = os.path.join(DATA_DIR, "memory.json")
+    VOICE_CACHE_DIR = os.path.join(DATA_DIR, "voice_cache")
 
     # --- 環境変数 ---
     token_name = json.load(open(SETTING_FILE)).get("config").get("character_name")
@@ -0,0 +1,231 @@
+# context_cache.py
+#
+# ペルソナと履歴の前半 (変化しない部分) をサーバー側のコンテキストキャッシュに載せ、
+# リクエストのたびに同じ内容を送り直してトークン化させないようにする。
+# キャッシュはAPIキーのプロジェクトに属するため、(APIキー, モデル名, チャンネルID) ごとに作成する。
+# 固定部分は CONTEXT_CACHE_BLOCK_TURNS 単位で伸ばし、履歴の削除・先頭の差し替え (ペルソナの適用を含む)・
+# 履歴の再読み込みがあった場合は作り直す。
+
+import time
+import asyncio
+import datetime
+import itertools
+from google.ai import generativelanguage as glm
+import utils.config_manager as config
+from utils import client_pool, history_trimmer
+from utils.console_display import log_info, log_warning, log_success
+
+# 失効直前のキャッシュは使わずに作り直す (秒)
+EXPIRY_MARGIN_SECONDS = 60
+
+class CacheEntry:
+    __slots__ = ("name", "generation", "prefix_length", "expires_at")
+
+    def __init__(self, name: str, generation: tuple, prefix_length: int, expires_at: float):
+        self.name = name
+        self.generation = generation
+        self.prefix_length = prefix_length
+        self.expires_at = expires_at
+
+class GeminiCacheService:
+    """Gemini の CachedContent を使う"""
+    name = "gemini"
+
+    @staticmethod
+    def _to_content(turn: dict):
+        parts = [glm.Part(text=p) for p in turn.get("parts", []) if isinstance(p, str)]
+        return glm.Content(role=turn.get("role", "user"), parts=parts)
+
+    async def create(self, api_key: str, model_name: str, turns: list, ttl_seconds: int) -> str:
+        cached_content = glm.CachedContent(
+            model=model_name if model_name.startswith("models/") else f"models/{model_name}",
+            contents=[self._to_content(t) for t in turns],
+            ttl=datetime.timedelta(seconds=ttl_seconds),
+        )
+        result = await client_pool.get_cache_client(api_key).create_cached_content(cached_content=cached_content)
+        return result.name
+
+    async def delete(self, api_key: str, cache_name: str):
+        client_pool.drop_cached_model(cache_name)
+        await client_pool.get_cache_client(api_key).delete_cached_content(name=cache_name)
+
+    def bind(self, api_key: str, model_name: str, entry: CacheEntry, history: list):
+        """キャッシュを参照するモデルと、キャッシュに含まれない残りの履歴を返す"""
+        return client_pool.get_cached_model(api_key, model_name, entry.name), history[entry.prefix_length:]
+
+class LocalCacheService:
+    """
+    サーバーを使わずにキャッシュの作成・失効・作り直しだけを模擬する (テスト・開発用)。
+    モデルには保存しておいた固定部分と残りの履歴をつなげて渡すため、応答内容は変わらない。
+    """
+    name = "local"
+
+    def __init__(self):
+        self._contents = {}
+        self._counter = itertools.count(1)
+
+    async def create(self, api_key: str, model_name: str, turns: list, ttl_seconds: int) -> str:
+        cache_name = f"localCachedContents/{next(self._counter)}"
+        self._contents[cache_name] = list(turns)
+        return cache_name
+
+    async def delete(self, api_key: str, cache_name: str):
+        self._contents.pop(cache_name, None)
+
+    def bind(self, api_key: str, model_name: str, entry: CacheEntry, history: list):
+        return client_pool.get_model(api_key, model_name), self._contents.get(entry.name, []) + history[entry.prefix_length:]
+
+_service = None
+# 全チャンネル共通の世代 (履歴の再読み込みで増やす)
+_epoch = 0
+# チャンネルID -> 世代 (固定部分が変わるたびに増やす)
+_generations = {}
+# (APIキー, モデル名, チャンネルID) -> CacheEntry
+_entries = {}
+# 作成中のキャッシュのキー (同じキャッシュを重複して作らない)
+_creating = set()
+# (APIキー, モデル名) -> 作成を再試行しない期限 (time.monotonic)
+_retry_after = {}
+# チャンネルID -> (世代, 固定部分の長さ, 推定トークン数(補正前))
+_prefix_tokens = {}
+stats = {"hits": 0, "misses": 0, "created": 0, "failed": 0}
+
+def get_service():
+    """config.CONTEXT_CACHE_MODE に応じたサービスを返す (無効なら None)"""
+    global _service
+    mode = config.CONTEXT_CACHE_MODE
+    if mode == "gemini" and client_pool.get_fake_endpoint():
+        mode = "local" # モックサーバーにはキャッシュ API がない
+    if mode == "off":
+        return None
+    if _service is None or _service.name != mode:
+        if mode == "local":
+            _service = LocalCacheService()
+        else:
+            if mode != "gemini":
+                log_warning("CONTEXT_CACHE", f"不明なキャッシュモード '{mode}' です。Gemini のキャッシュを使用します。")
+            _service = GeminiCacheService()
+    return _service
+
+def _generation(channel_id: str) -> tuple:
+    return (_epoch, _generations.get(channel_id, 0))
+
+def invalidate_channel(channel_id):
+    """チャンネルの履歴の固定部分が変わったときに呼ぶ (次回のリクエストで作り直す)"""
+    str_channel_id = str(channel_id)
+    _generations[str_channel_id] = _generations.get(str_channel_id, 0) + 1
+    _prefix_tokens.pop(str_channel_id, None)
+
+def invalidate_all():
+    """履歴の再読み込みなどで、全チャンネルのキャッシュを作り直させる"""
+    global _epoch
+    _epoch += 1
+    _prefix_tokens.clear()
+    log_info("CONTEXT_CACHE", "全チャンネルのコンテキストキャッシュを無効化しました。")
+
+def discard(api_key: str, model_name: str, channel_id):
+    """リクエストが失敗した場合など、サーバー側で使えなくなった可能性のあるキャッシュを手放す"""
+    entry = _entries.pop((api_key, model_name, str(channel_id)), None)
+    if entry is not None:
+        _schedule_delete(api_key, entry.name)
+
+def _prefix_length(history: list) -> int:
+    """
+    キャッシュする先頭部分の長さ。ペルソナ (インデックス0) にブロック単位の会話を加えた長さとし、
+    最後のターンは必ずキャッシュの外に残す。削除はペア単位なので、残りは user ターンから始まる。
+    """
+    block = max(2, config.CONTEXT_CACHE_BLOCK_TURNS)
+    if len(history) < 2:
+        return 0
+    return 1 + ((len(history) - 2) // block) * block
+
+def _estimate_prefix_tokens(channel_id: str, generation: tuple, history: list, prefix_length: int) -> float:
+    cached = _prefix_tokens.get(channel_id)
+    if cached and cached[0] == generation and cached[1] == prefix_length:
+        return cached[2]
+    tokens = sum(history_trimmer.estimate_turn_tokens(t) for t in history[:prefix_length])
+    _prefix_tokens[channel_id] = (generation, prefix_length, tokens)
+    return tokens
+
+def prepare(api_key: str, model_name: str, channel_id, history: list):
+    """
+    リクエストに使うモデルと start_chat に渡す履歴を返す。
+    有効なキャッシュがあればキャッシュを参照するモデルと残りの履歴を、
+    なければ通常のモデルと履歴全体を返し、キャッシュの作成をバックグラウンドで開始する。
+    """
+    base = (client_pool.get_model(api_key, model_name), history)
+    service = get_service()
+    if service is None or channel_id is None or not history or history[0].get("role") != "user":
+        return base
+    now = time.monotonic()
+    if _retry_after.get((api_key, model_name), 0) > now:
+        return base
+
+    str_channel_id = str(channel_id)
+    prefix_length = _prefix_length(history)
+    if prefix_length == 0:
+        return base
+    generation = _generation(str_channel_id)
+    prefix_tokens = _estimate_prefix_tokens(str_channel_id, generation, history, prefix_length)
+    if prefix_tokens * history_trimmer.get_calibration(model_name) < config.CONTEXT_CACHE_MIN_TOKENS:
+        return base
+
+    entry_key = (api_key, model_name, str_channel_id)
+    entry = _entries.get(entry_key)
+    if entry and entry.generation == generation and entry.prefix_length == prefix_length and entry.expires_at - now > EXPIRY_MARGIN_SECONDS:
+        stats["hits"] += 1
+        return service.bind(api_key, model_name, entry, history)
+
+    stats["misses"] += 1
+    if entry_key not in _creating:
+        _creating.add(entry_key)
+        # 固定部分はここで確定させる (作成中に履歴が追加されても影響しない)
+        asyncio.get_running_loop().create_task(
+            _create_entry(service, entry_key, generation, list(history[:prefix_length]))
+        )
+    return base
+
+async def _create_entry(service, entry_key: tuple, generation: tuple, prefix_turns: list):
+    api_key, model_name, channel_id = entry_key
+    ttl = config.CONTEXT_CACHE_TTL_SECONDS
+    try:
+        cache_name = await service.create(api_key, model_name, prefix_turns, ttl)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        stats["failed"] += 1
+        _retry_after[(api_key, model_name)] = time.monotonic() + config.CONTEXT_CACHE_RETRY_SECONDS
+        log_warning("CONTEXT_CACHE", f"CH[{channel_id}] のキャッシュ作成に失敗しました ('{model_name}')。{config.CONTEXT_CACHE_RETRY_SECONDS}秒間は通常の送信を使います: {type(e).__name__} - {e}")
+        return
+    finally:
+        _creating.discard(entry_key)
+
+    if generation != _generation(channel_id):
+        # 作成中に履歴の固定部分が変わった場合は使わない
+        _schedule_delete(api_key, cache_name)
+        return
+    stats["created"] += 1
+    old_entry = _entries.get(entry_key)
+    _entries[entry_key] = CacheEntry(cache_name, generation, len(prefix_turns), time.monotonic() + ttl)
+    if old_entry is not None:
+        _schedule_delete(api_key, old_entry.name)
+    log_success("CONTEXT_CACHE", f"CH[{channel_id}] のコンテキストキャッシュを作成しました。({len(prefix_turns)}ターン, '{model_name}')")
+
+def _schedule_delete(api_key: str, cache_name: str):
+    service = get_service()
+    if service is None:
+        return
+
+    async def delete():
+        try:
+            await service.delete(api_key, cache_name)
+        except Exception as e:
+            # 削除できなくても有効期限で消える
+            log_warning("CONTEXT_CACHE", f"キャッシュ '{cache_name}' の削除に失敗しました: {type(e).__name__} - {e}")
+
+    asyncio.get_running_loop().create_task(delete())
+
+def describe() -> str:
+    """!status 表示用の統計"""
+    return (f"モード: {config.CONTEXT_CACHE_MODE} / 保持: {len(_entries)}件 / "
+            f"ヒット: {stats['hits']} / ミス: {stats['misses']} / 作成: {stats['created']} / 失敗: {stats['failed']}")
@@ -1,34 +1,84 @@
+import copy
 import utils.config_manager as config
 from .json_handler import load_json, save_json
+from . import persistence_writer
+from .storage_backend import create_history_backend, LazyHistoryCache
+from . import unread_queue
 from utils.console_display import log_system
 
 # メモリ上に全データを保持する辞書
 _data_cache = {}
+# 前回の保存以降に変更されたセクション
+_dirty_sections = set()
+# 会話履歴の保存先 (config.STORAGE_BACKEND で選択)
+_history_backend = None
+
+def get_history_backend():
+    """会話履歴のバックエンドを取得する"""
+    return _history_backend
+
+def _load_history_cache():
+    return LazyHistoryCache(_history_backend, config.HISTORY_MAX_RESIDENT_CHANNELS)
+
+def _load_unread_queue():
+    return unread_queue.create_from_json(load_json(config.UNREAD_MESSAGES_FILE, default_data={}))
 
 def load_all_data():
     """起動時に全てのJSONファイルを読み込み、メモリにキャッシュする"""
-    global _data_cache
+    global _data_cache, _history_backend
+    if _history_backend is None:
+        _history_backend = create_history_backend()
+        log_system(f"会話履歴のストレージバックエンド: {_history_backend.name}")
     _data_cache = {
         'emotion': load_json(config.EMOTION_FILE),
         'setting': load_json(config.SETTING_FILE),
         'memory': load_json(config.MEMORY_FILE, default_data=[]),
         'schedule': load_json(config.SCHEDULE_FILE),
-        'history': load_json(config.HISTORY_FILE, default_data={}),
-        'unread': load_json(config.UNREAD_MESSAGES_FILE, default_data={})
+        'history': _load_history_cache(), # 履歴はチャンネル単位で必要になった時に読み込む
+        'unread': _load_unread_queue()
     }
     log_system("全てのデータファイルをメモリにロードしました。")
 
-def save_all_data():
-    """終了時にメモリ上の全てのデータをJSONファイルに書き出す"""
+# 保存対象のセクションと保存先ファイル (schedule は読み込み専用)
+def _section_files() -> dict:
+    return {
+        'emotion': config.EMOTION_FILE,
+        'setting': config.SETTING_FILE,
+        'unread': config.UNREAD_MESSAGES_FILE,
+        'memory': config.MEMORY_FILE,
+    }
+
+def _snapshot_section(key: str):
+    """書き込み用にセクションのコピーを取る (書き込み中にメモリ上で変更されても影響しない)"""
+    if key == 'unread':
+        return _data_cache['unread'].to_json()
+    return copy.deepcopy(_data_cache[key])
+
+def mark_dirty(key: str):
+    """セクションが変更されたことを記録する (次回の save_all_data で保存される)"""
+    _dirty_sections.add(key)
+
+def save_all_data(force: bool = False):
+    """
+    変更されたセクションの保存を書き込みスレッドに予約する (force=True なら全セクション)。
+    書き込みはイベントループの外で行われるため、完了を待つ場合は flush() を await する。
+    """
     if not _data_cache:
         return
-    save_json(_data_cache['emotion'], config.EMOTION_FILE)
-    save_json(_data_cache['setting'], config.SETTING_FILE)
-    # save_json(_data_cache['schedule'], config.SCHEDULE_FILE)
-    save_json(_data_cache['history'], config.HISTORY_FILE)
-    save_json(_data_cache['unread'], config.UNREAD_MESSAGES_FILE)
-    save_json(_data_cache['memory'], config.MEMORY_FILE)
-    log_system("全てのデータをファイルに保存しました。")
+    section_files = _section_files()
+    keys_to_save = list(section_files) if force else [k for k in section_files if k in _dirty_sections]
+    for key in keys_to_save:
+        # スナップショットは書き込み直前に取るため、ここで dirty を解除しても変更は失われない
+        _dirty_sections.discard(key)
+        persistence_writer.schedule_save(section_files[key], lambda key=key: _snapshot_section(key), save_json)
+    # 履歴は変更時にバックエンドへ書き込み済み。必要ならメモリ上の履歴で保存領域を整理する
+    _history_backend.compact_if_needed(_data_cache['history'])
+    if keys_to_save:
+        log_system(f"データの保存を予約しました。({', '.join(keys_to_save)})")
+
+async def flush():
+    """予約済みの保存が全てディスクに書き込まれるまで待つ"""
+    await persistence_writer.flush()
 
 def get_data(key: str):
     """メモリ上のデータキャッシュへの参照を取得する"""
@@ -37,7 +87,7 @@ def get_data(key: str):
 def reload_data(key: str):
     """指定されたキーのデータのみをファイルから再読み込みする"""
     if key == 'history':
-        _data_cache['history'] = load_json(config.HISTORY_FILE, default_data={})
+        _data_cache['history'] = _load_history_cache()
         from . import ai_request_handler # 循環参照を避けるためここでインポート
         ai_request_handler.initialize_histories() # ai_request_handler側のキャッシュも更新
         log_system("履歴ファイルを再読み込みしました。")
@@ -45,11 +95,13 @@ def reload_data(key: str):
     
     if key == 'emotion':
         _data_cache['emotion'] = load_json(config.EMOTION_FILE)
+        _dirty_sections.discard('emotion')
         log_system("感情ファイルを再読み込みしました。")
         return True
     
     if key == 'unread':
-        _data_cache['unread'] = load_json(config.UNREAD_MESSAGES_FILE, default_data={})
+        _data_cache['unread'] = _load_unread_queue()
+        _dirty_sections.discard('unread')
         log_system("未読メッセージファイルを再読み込みしました。")
         return True
 
@@ -0,0 +1,38 @@
+# emotion_dynamics.py
+#
+# 感情が時間とともに既定値 (default_emotions) へ戻っていく変化 (指数関数的な減衰)。
+# 定期的なタスクで値を書き換えるのではなく、最後に値を確定させた時刻 (updated_at) と
+# その時点の値 (アンカー) を保持し、読み出すたびに経過時間から現在の値を計算する。
+# 減衰は感情ごとにループせず、アンカー・既定値・半減期を NumPy の配列にして全ての感情を一度に計算する。
+
+import time
+import numpy as np
+import utils.config_manager as config
+
+def now() -> float:
+    """updated_at に使う時刻 (再起動をまたいで減衰させるため壁時計の時刻を使う)"""
+    return time.time()
+
+def decayed_values(anchors: dict, defaults: dict, elapsed: float, half_lives: dict | None = None) -> dict:
+    """
+    アンカーの値から elapsed 秒後の値を全ての感情について計算する。
+    半減期 (秒) は half_lives の感情ごとの値、なければ EMOTION_DECAY_HALF_LIFE_SECONDS。
+    半減期が 0 または None の感情と、既定値がない感情は減衰しない。
+    """
+    if elapsed <= 0 or not anchors:
+        return dict(anchors)
+    half_lives = half_lives or {}
+    default_half_life = config.EMOTION_DECAY_HALF_LIFE_SECONDS
+    names = list(anchors)
+    anchor_array = np.array([anchors[name] for name in names], dtype=float)
+    target_array = np.array([defaults.get(name, np.nan) for name in names], dtype=float)
+    half_life_array = np.array([half_lives.get(name, default_half_life) or 0 for name in names], dtype=float)
+    decaying = (half_life_array > 0) & ~np.isnan(target_array)
+    factors = np.ones_like(anchor_array)
+    factors[decaying] = 0.5 ** (elapsed / half_life_array[decaying])
+    decayed = target_array + (anchor_array - target_array) * factors
+    # 減衰しない感情はアンカーの値をそのまま返す
+    return {
+        name: float(decayed[i]) if decaying[i] else anchors[name]
+        for i, name in enumerate(names)
+    }
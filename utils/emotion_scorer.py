@@ -0,0 +1,175 @@
+# emotion_scorer.py
+#
+# 辞書 (手がかり語 -> 感情ごとの変化量) とルールで対話から感情の変化量を求める、ローカルの感情分析。
+# APIを呼ばずにすぐ結果が出るため、EMOTION_ANALYSIS_MODE が "local" / "hybrid" のときに使う。
+#   - 手がかり語の出現数 (否定・強調で重み付け) と重み行列の積で、全感情の変化量を一度に計算する
+#     (NumPy があれば行列積、なければ出現した語だけを足し合わせる)
+#   - LLM の分析結果と比べて、感情ごとの倍率を補正できる (calibrate)
+# 辞書はインスタンスの emotion_lexicon.json ({感情名: {手がかり語: 変化量}}) で追加・上書きできる。
+
+import re
+import json
+import utils.config_manager as config
+from utils.console_display import log_info, log_error
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 既定の辞書 (感情名: {手がかり語: 変化量})。emotion_map にない感情は使わない
+# 形容詞は活用 (嬉しかった・嬉しくない) にも一致するよう語幹で登録する
+DEFAULT_LEXICON = {
+    "joy": {"嬉し": 10, "うれし": 10, "楽し": 10, "たのし": 10, "よかった": 8, "最高": 12, "幸せ": 12,
+            "ありがとう": 6, "やった": 10, "笑": 4, "わーい": 10},
+    "anticipation": {"楽しみ": 12, "待ち遠し": 12, "わくわく": 10, "ワクワク": 10, "明日": 3, "今度": 4, "予定": 4},
+    "anger": {"怒": 10, "ムカつく": 12, "むかつく": 12, "イライラ": 10, "いらいら": 10, "ふざけ": 10, "許さない": 14, "うるさい": 8},
+    "disgust": {"気持ち悪": 12, "キモい": 12, "きもい": 12, "嫌い": 10, "最低": 10, "うざい": 10, "ウザい": 10},
+    "sadness": {"悲し": 12, "かなし": 12, "寂し": 10, "さみし": 10, "つらい": 10, "つらかった": 10, "泣": 8, "残念": 8,
+                "ごめん": 4, "さよなら": 8},
+    "surprise": {"びっくり": 12, "ビックリ": 12, "驚": 10, "まさか": 8, "えっ": 6, "本当に？": 6, "マジで": 6},
+    "fear": {"怖": 12, "こわい": 12, "こわく": 12, "恐ろし": 14, "不安": 10, "心配": 8, "やばい": 4},
+    "trust": {"信じ": 10, "信頼": 10, "頼り": 8, "任せ": 8, "ありがとう": 6, "約束": 6, "大丈夫": 4},
+    "love": {"好き": 10, "すき": 8, "大好き": 14, "愛して": 16, "かわいい": 8, "可愛い": 8, "会いたい": 10},
+    "shame": {"恥ずかし": 12, "はずかし": 12, "照れ": 10, "赤面": 10},
+    "guilty": {"ごめん": 6, "すみません": 6, "申し訳": 10, "悪かった": 10, "反省": 8},
+    "jealousy": {"ずるい": 10, "羨まし": 10, "うらやまし": 10, "嫉妬": 12, "他の子": 8},
+}
+
+# 手がかり語の直後にあると重みを反転・減衰させる否定表現
+NEGATION_PATTERN = re.compile(r"^(?:く|じゃ|では)?(?:ない|なかった|ません|ねえ|ねー)")
+NEGATION_FACTOR = -0.5
+# 手がかり語の直前にあると重みを強める表現と、直後の感嘆符
+INTENSIFIER_PATTERN = re.compile(r"(?:とても|すごく|すっごく|めっちゃ|本当に|超|かなり)$")
+INTENSIFIER_FACTOR = 1.5
+EXCLAMATION_FACTOR = 1.2
+# 否定・強調を探す範囲 (文字数)
+MODIFIER_WINDOW = 4
+# ユーザーの発言と、キャラクター自身の応答に含まれる手がかり語の重み
+USER_WEIGHT = 1.0
+RESPONSE_WEIGHT = 0.5
+# LLM との比較で求める倍率の範囲と、過去の比較結果を減衰させる係数
+GAIN_RANGE = (0.2, 3.0)
+CALIBRATION_DECAY = 0.9
+
+def load_lexicon(path: str | None) -> dict:
+    """既定の辞書に、インスタンスの辞書ファイル (あれば) を重ねたものを返す"""
+    lexicon = {emotion: dict(cues) for emotion, cues in DEFAULT_LEXICON.items()}
+    if not path:
+        return lexicon
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            custom = json.load(f)
+    except FileNotFoundError:
+        return lexicon
+    except (json.JSONDecodeError, OSError) as e:
+        log_error("EMOTION_SCORER", f"感情辞書 '{path}' の読み込みに失敗しました: {e}")
+        return lexicon
+    for emotion, cues in custom.items():
+        if isinstance(cues, dict):
+            lexicon.setdefault(emotion, {}).update({cue: weight for cue, weight in cues.items() if isinstance(weight, (int, float))})
+    log_info("EMOTION_SCORER", f"感情辞書 '{path}' を読み込みました。")
+    return lexicon
+
+class EmotionScorer:
+    """emotion_map の感情について、手がかり語 × 感情の重み行列を持つ"""
+
+    def __init__(self, emotion_map: dict, lexicon: dict):
+        self.emotion_names = list(emotion_map)
+        emotion_index = {name: i for i, name in enumerate(self.emotion_names)}
+        cues = {}
+        for emotion, emotion_cues in lexicon.items():
+            if emotion not in emotion_index:
+                continue
+            for cue, weight in emotion_cues.items():
+                if cue:
+                    cues.setdefault(cue, []).append((emotion_index[emotion], float(weight)))
+        self.cues = list(cues)
+        self.rows = [cues[cue] for cue in self.cues] # 手がかり語ごとの (感情の位置, 変化量)
+        self._cue_index = {cue: i for i, cue in enumerate(self.cues)}
+        # 長い語を優先して一致させる (「大好き」を「好き」より先に)
+        self._pattern = re.compile("|".join(re.escape(c) for c in sorted(self.cues, key=len, reverse=True))) if self.cues else None
+        if np is not None:
+            self._matrix = np.zeros((len(self.cues), len(self.emotion_names)))
+            for i, row in enumerate(self.rows):
+                for j, weight in row:
+                    self._matrix[i, j] = weight
+        # 感情ごとの倍率の補正 (LLM の変化量との最小二乗) に使う累積値
+        self._sum_xy = [0.0] * len(self.emotion_names)
+        self._sum_xx = [0.0] * len(self.emotion_names)
+        self.stats = {"scored": 0, "matched": 0, "calibrations": 0}
+
+    def _count_cues(self, text: str, weight: float, counts: dict):
+        """text の手がかり語の出現数を、否定・強調の重みを付けて counts に加える"""
+        if not text or self._pattern is None:
+            return
+        for match in self._pattern.finditer(text):
+            factor = weight
+            after = text[match.end():match.end() + MODIFIER_WINDOW]
+            if NEGATION_PATTERN.match(after):
+                factor *= NEGATION_FACTOR
+            elif after[:1] in ("!", "！"):
+                factor *= EXCLAMATION_FACTOR
+            if INTENSIFIER_PATTERN.search(text[max(0, match.start() - MODIFIER_WINDOW):match.start()]):
+                factor *= INTENSIFIER_FACTOR
+            index = self._cue_index[match.group()]
+            counts[index] = counts.get(index, 0.0) + factor
+
+    def score_raw(self, user_input: str, bot_response: str) -> list[float]:
+        """対話から、補正前の感情ごとの変化量 (emotion_names の順) を求める"""
+        counts = {}
+        self._count_cues(user_input, USER_WEIGHT, counts)
+        self._count_cues(bot_response, RESPONSE_WEIGHT, counts)
+        self.stats["scored"] += 1
+        if not counts:
+            return [0.0] * len(self.emotion_names)
+        self.stats["matched"] += 1
+        if np is not None:
+            vector = np.zeros(len(self.cues))
+            vector[list(counts)] = list(counts.values())
+            return (vector @ self._matrix).tolist()
+        raw = [0.0] * len(self.emotion_names)
+        for index, count in counts.items():
+            for j, weight in self.rows[index]:
+                raw[j] += count * weight
+        return raw
+
+    def gain(self, position: int) -> float:
+        if self._sum_xx[position] <= 0:
+            return 1.0
+        return max(GAIN_RANGE[0], min(GAIN_RANGE[1], self._sum_xy[position] / self._sum_xx[position]))
+
+    def to_deltas(self, raw: list[float], limit: int) -> dict:
+        """補正した変化量を、整数の {感情名: 変化量} にする (0 は含めない)"""
+        deltas = {}
+        for position, value in enumerate(raw):
+            delta = max(-limit, min(limit, round(value * self.gain(position))))
+            if delta:
+                deltas[self.emotion_names[position]] = delta
+        return deltas
+
+    def calibrate(self, raw: list[float], llm_deltas: dict):
+        """同じ対話の LLM の変化量と比べて、手がかり語が出現した感情の倍率を補正する"""
+        calibrated = False
+        for position, value in enumerate(raw):
+            if not value:
+                continue
+            target = llm_deltas.get(self.emotion_names[position], 0)
+            if not isinstance(target, (int, float)):
+                continue
+            self._sum_xy[position] = self._sum_xy[position] * CALIBRATION_DECAY + value * target
+            self._sum_xx[position] = self._sum_xx[position] * CALIBRATION_DECAY + value * value
+            calibrated = True
+        if calibrated:
+            self.stats["calibrations"] += 1
+
+    def describe(self) -> str:
+        """!status 表示用の統計"""
+        gains = ", ".join(f"{name}×{self.gain(i):.2f}" for i, name in enumerate(self.emotion_names) if self._sum_xx[i] > 0)
+        return (f"手がかり語: {len(self.cues)}語 ({'NumPy' if np is not None else 'Python'}) / "
+                f"分析: {self.stats['scored']} / 一致: {self.stats['matched']} / 補正: {self.stats['calibrations']}"
+                + (f"\n倍率: {gains}" if gains else ""))
+
+def create_scorer(emotion_map: dict) -> EmotionScorer:
+    """設定値に従って、emotion_map 用のスコアラーを作成する"""
+    return EmotionScorer(emotion_map, load_lexicon(config.EMOTION_LEXICON_FILE))
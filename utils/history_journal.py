@@ -0,0 +1,150 @@
+# history_journal.py
+#
+# 会話履歴をチャンネルごとの追記専用ジャーナル (JSONL) として保存する。
+# 1行が1つの操作を表し、読み込み時に先頭から再生して履歴を復元する。
+#   {"op": "append", "turn": {"role": "user", "parts": [...]}}
+#   {"op": "delete", "start": 1, "stop": 3}
+#   {"op": "reset", "turns": [...]}
+#   {"op": "set", "index": 0, "turn": {...}}
+# 操作が溜まったファイルは現在の履歴だけに書き直す (コンパクション)。
+# 書き込みの実行タイミングは storage_backend.JournalHistoryBackend が管理する。
+
+import os
+import json
+from datetime import datetime
+import utils.config_manager as config
+from .json_handler import load_json
+from .console_display import log_error, log_success, log_warning
+
+JOURNAL_SUFFIX = ".jsonl"
+
+# チャンネルID -> ジャーナルの行数 (コンパクション判定用)
+_op_counts = {}
+
+class HistoryLoadError(Exception):
+    """履歴が存在するのに読み込めなかった (「履歴がない」とは区別し、チャンネルをリセットしない)"""
+
+def _journal_path(channel_id: str) -> str:
+    return os.path.join(config.HISTORY_JOURNAL_DIR, f"{channel_id}{JOURNAL_SUFFIX}")
+
+def _dump_line(record: dict) -> str:
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + "\n"
+
+def encode_records(channel_id: str, records: list[dict]) -> str:
+    """操作をジャーナルの行に変換し、行数を記録する (呼び出し時点の内容で確定させる)"""
+    _op_counts[channel_id] = _op_counts.get(channel_id, 0) + len(records)
+    return "".join(_dump_line(r) for r in records)
+
+def append_records(turns: list[dict]) -> list[dict]:
+    return [{"op": "append", "turn": t} for t in turns]
+
+def delete_record(start: int, stop: int) -> dict:
+    return {"op": "delete", "start": start, "stop": stop}
+
+def reset_record(turns: list[dict]) -> dict:
+    return {"op": "reset", "turns": turns}
+
+def set_record(index: int, turn: dict) -> dict:
+    return {"op": "set", "index": index, "turn": turn}
+
+def write_lines(channel_id: str, text: str):
+    """エンコード済みの行をジャーナルに追記する"""
+    try:
+        with open(_journal_path(channel_id), 'a', encoding='utf-8') as f:
+            f.write(text)
+    except Exception as e:
+        log_error("JOURNAL", f"CH[{channel_id}] のジャーナル追記中にエラー: {e}")
+
+def _replay(path: str) -> tuple[list, int, bool]:
+    """ジャーナルを再生して履歴リスト・行数・不正行の有無を返す"""
+    turns = []
+    line_count = 0
+    has_invalid_lines = False
+    with open(path, 'r', encoding='utf-8') as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            line_count += 1
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 書き込み途中で終了した最終行などは読み飛ばす
+                log_warning("JOURNAL", f"'{path}' の {line_no} 行目が不正なため読み飛ばします。")
+                has_invalid_lines = True
+                continue
+            op = record.get("op")
+            if op == "append":
+                turns.append(record["turn"])
+            elif op == "delete":
+                del turns[record["start"]:record["stop"]]
+            elif op == "reset":
+                turns = list(record["turns"])
+            elif op == "set":
+                if 0 <= record["index"] < len(turns):
+                    turns[record["index"]] = record["turn"]
+    return turns, line_count, has_invalid_lines
+
+def write_compacted(channel_id: str, turns: list):
+    """現在の履歴だけを含むジャーナルを一時ファイルに書き、置き換える"""
+    path = _journal_path(channel_id)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write("".join(_dump_line({"op": "append", "turn": t}) for t in turns))
+    os.replace(tmp_path, path)
+
+def mark_compacted(channel_id: str, turn_count: int):
+    _op_counts[channel_id] = turn_count
+
+def needs_compaction(channel_id: str, turn_count: int) -> bool:
+    """行数が max(最小行数, 履歴の長さ × 倍率) を超えていれば True"""
+    threshold = max(config.HISTORY_JOURNAL_COMPACT_MIN_OPS, turn_count * config.HISTORY_JOURNAL_COMPACT_RATIO)
+    return _op_counts.get(channel_id, 0) > threshold
+
+def get_op_count(channel_id: str) -> int:
+    return _op_counts.get(channel_id, 0)
+
+def list_channels() -> list[str]:
+    """
+    ジャーナルが存在するチャンネルIDの一覧を返す。
+    ジャーナルがまだ存在しない場合は従来の history.json から移行する。
+    """
+    os.makedirs(config.HISTORY_JOURNAL_DIR, exist_ok=True)
+    channel_ids = [name[:-len(JOURNAL_SUFFIX)] for name in os.listdir(config.HISTORY_JOURNAL_DIR) if name.endswith(JOURNAL_SUFFIX)]
+    if not channel_ids:
+        channel_ids = list(_migrate_from_json())
+    return channel_ids
+
+def load_channel(channel_id: str) -> list | None:
+    """
+    1チャンネル分のジャーナルを再生して履歴を返す (なければ None)。
+    再生できない場合はジャーナルを .corrupt-<日時> に退避して HistoryLoadError を送出する。
+    """
+    path = _journal_path(channel_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        turns, line_count, has_invalid_lines = _replay(path)
+    except Exception as e:
+        log_error("JOURNAL", f"CH[{channel_id}] のジャーナル再生中にエラー: {type(e).__name__} - {e}")
+        corrupt_path = f"{path}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        os.replace(path, corrupt_path)
+        log_warning("JOURNAL", f"再生できないジャーナルを '{corrupt_path}' に退避しました。")
+        raise HistoryLoadError(f"CH[{channel_id}] のジャーナルを再生できません。") from e
+    _op_counts[channel_id] = line_count
+    if has_invalid_lines:
+        # 壊れた行の後ろに追記しないよう、正常な内容だけで書き直しておく
+        write_compacted(channel_id, turns)
+        mark_compacted(channel_id, len(turns))
+    return turns
+
+def _migrate_from_json() -> dict:
+    histories = load_json(config.HISTORY_FILE, default_data={})
+    for channel_id, turns in histories.items():
+        try:
+            write_compacted(channel_id, turns)
+            mark_compacted(channel_id, len(turns))
+        except Exception as e:
+            log_error("JOURNAL", f"CH[{channel_id}] の履歴移行中にエラー: {e}")
+    if histories:
+        log_success("JOURNAL", f"'{config.HISTORY_FILE}' から {len(histories)}チャンネル分の履歴をジャーナルに移行しました。")
+    return histories
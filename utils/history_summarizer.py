@@ -0,0 +1,99 @@
+# history_summarizer.py
+#
+# 履歴の削除で押し出された古い会話を、バックグラウンドで要約に畳み込む。
+# 要約はチャンネル履歴の先頭 (ペルソナと同じ user ターン) の2つ目の part として保持する。
+
+import asyncio
+import utils.config_manager as config
+from utils import prompt_builder
+from utils.console_display import log_info, log_error, log_success, log_warning
+
+SUMMARY_HEADER = "# これまでの会話の要約"
+
+# チャンネルID -> 要約待ちのターン
+_pending_turns = {}
+# チャンネルID -> 要約処理中のタスク
+_tasks = {}
+# チャンネルID -> 履歴をリセットした回数 (リセット前に始めた要約の結果を捨てるため)
+_generations = {}
+
+def get_summary(history: list) -> str | None:
+    """履歴の先頭ターンから要約本文を取り出す"""
+    if not history:
+        return None
+    parts = history[0].get("parts", [])
+    if len(parts) >= 2 and isinstance(parts[-1], str) and parts[-1].startswith(SUMMARY_HEADER):
+        return parts[-1][len(SUMMARY_HEADER):].strip()
+    return None
+
+def with_summary(head_turn: dict, summary: str) -> dict:
+    """先頭ターン (ペルソナ) の要約部分を差し替えた新しいターンを返す"""
+    parts = list(head_turn.get("parts", []))
+    if len(parts) >= 2 and isinstance(parts[-1], str) and parts[-1].startswith(SUMMARY_HEADER):
+        parts = parts[:-1]
+    parts.append(f"{SUMMARY_HEADER}\n{summary}")
+    return {"role": head_turn.get("role", "user"), "parts": parts}
+
+def queue_evicted(channel_id, turns: list):
+    """削除されたターンを要約待ちに追加し、要約タスクが動いていなければ開始する"""
+    if not config.HISTORY_SUMMARY_ENABLED or not turns:
+        return
+    str_channel_id = str(channel_id)
+    _set_pending(str_channel_id, _pending_turns.get(str_channel_id, []) + turns)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return # ループ外では次回の削除時にまとめて要約する
+    task = _tasks.get(str_channel_id)
+    if task is None or task.done():
+        _tasks[str_channel_id] = loop.create_task(_summarize_pending(str_channel_id))
+
+def _set_pending(channel_id: str, turns: list):
+    """要約待ちのターンを設定する。上限を超える分は古いものから捨てる"""
+    overflow = len(turns) - config.HISTORY_SUMMARY_MAX_PENDING_TURNS
+    if overflow > 0:
+        log_warning("SUMMARY", f"CH[{channel_id}] の要約待ちが上限 ({config.HISTORY_SUMMARY_MAX_PENDING_TURNS}件) を超えたため、古い会話 {overflow}件 を要約せずに捨てます。")
+        turns = turns[overflow:]
+    _pending_turns[channel_id] = turns
+
+def discard_pending(channel_id):
+    """履歴をリセットした場合などに、要約待ちのターンを捨てる (実行中の要約の結果も使わない)"""
+    str_channel_id = str(channel_id)
+    _pending_turns.pop(str_channel_id, None)
+    _generations[str_channel_id] = _generations.get(str_channel_id, 0) + 1
+
+async def _summarize_pending(channel_id: str):
+    from utils import ai_request_handler # 循環参照を避けるためここでインポート
+
+    while _pending_turns.get(channel_id):
+        turns = _pending_turns.pop(channel_id)
+        generation = _generations.get(channel_id, 0)
+        history = ai_request_handler.get_channel_history(channel_id)
+        if not history:
+            return
+        log_info("SUMMARY", f"CH[{channel_id}] の古い会話 {len(turns)}件 を要約に統合します...")
+        prompt = prompt_builder.build_history_summary_prompt(get_summary(history), turns, config.HISTORY_SUMMARY_MAX_CHARS)
+        try:
+            # 応答処理とキーを取り合わないよう低優先度で送る (空いているキーがなければ次回に持ち越す)
+            summary = await ai_request_handler.send_request(
+                config.HISTORY_SUMMARY_MODEL, prompt, channel_id=None, low_priority=True
+            )
+        except Exception as e:
+            log_error("SUMMARY", f"CH[{channel_id}] の要約中にエラー: {type(e).__name__} - {e}")
+            summary = None
+        if _generations.get(channel_id, 0) != generation:
+            log_info("SUMMARY", f"CH[{channel_id}] の履歴が要約中にリセットされたため、要約結果を破棄します。")
+            continue # リセット後に押し出された会話があれば続けて要約する
+        if not summary:
+            # 失敗した分は次回の削除時に一緒に要約する
+            _set_pending(channel_id, turns + _pending_turns.get(channel_id, []))
+            log_error("SUMMARY", f"CH[{channel_id}] の要約に失敗したか見送りました。次回に持ち越します。")
+            return
+
+        # 要約中に履歴が更新・再読み込みされている可能性があるため、最新の先頭ターンに要約を入れて差し替える
+        async with ai_request_handler.history_lock(channel_id):
+            history = ai_request_handler.get_channel_history(channel_id)
+            if _generations.get(channel_id, 0) != generation or not history or history[0].get("role") != "user":
+                return
+            ai_request_handler.replace_head_turn(channel_id, with_summary(history[0], summary.strip()[:config.HISTORY_SUMMARY_MAX_CHARS * 2]))
+        log_success("SUMMARY", f"CH[{channel_id}] の会話要約を更新しました。({len(summary)}文字)")
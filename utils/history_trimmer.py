@@ -0,0 +1,111 @@
+# history_trimmer.py
+#
+# 会話履歴をメッセージ数ではなく推定トークン数で制限する。
+# トークン数は文字数から推定し、APIが返す usage_metadata の実測値でモデルごとに補正する。
+
+import utils.config_manager as config
+from utils.console_display import log_info, log_warning
+
+# 1ターンあたりの固定オーバーヘッド (role などの区切り)
+TURN_OVERHEAD_TOKENS = 4
+# 補正係数の指数移動平均の重みと範囲
+CALIBRATION_ALPHA = 0.3
+CALIBRATION_RANGE = (0.3, 3.0)
+
+# モデル名 -> 推定値に掛ける補正係数
+_calibration = {}
+# チャンネルID -> [履歴リストのid, 履歴の長さ, 推定トークン数(補正前)の合計]
+_channel_totals = {}
+
+def estimate_text_tokens(text: str) -> float:
+    """
+    文字列のトークン数を推定する (補正前)。
+    英数字はおよそ4文字で1トークン、日本語などの非ASCII文字はおよそ1文字1トークンとみなす。
+    非ASCII文字数はUTF-8のバイト数から求める (日本語は主に3バイト)。
+    """
+    if not text:
+        return 0.0
+    char_count = len(text)
+    byte_count = len(text.encode('utf-8'))
+    non_ascii = min(char_count, (byte_count - char_count) / 2)
+    ascii_count = char_count - non_ascii
+    return ascii_count / 4 + non_ascii
+
+def estimate_turn_tokens(turn: dict) -> float:
+    return TURN_OVERHEAD_TOKENS + sum(estimate_text_tokens(p) for p in turn.get("parts", []) if isinstance(p, str))
+
+def get_calibration(model_name: str) -> float:
+    return _calibration.get(model_name, 1.0)
+
+def calibrate(model_name: str, estimated_tokens: float, actual_tokens: int):
+    """推定値(補正前)と usage_metadata の実測値から、モデルごとの補正係数を更新する"""
+    if estimated_tokens <= 0 or not actual_tokens:
+        return
+    ratio = min(CALIBRATION_RANGE[1], max(CALIBRATION_RANGE[0], actual_tokens / estimated_tokens))
+    previous = _calibration.get(model_name)
+    _calibration[model_name] = ratio if previous is None else (1 - CALIBRATION_ALPHA) * previous + CALIBRATION_ALPHA * ratio
+    log_info("TOKEN_ESTIMATE", f"'{model_name}' の補正係数を更新しました: {_calibration[model_name]:.2f} (推定 {estimated_tokens:.0f} / 実測 {actual_tokens})")
+
+def history_raw_tokens(channel_id, history: list) -> float:
+    """履歴全体の推定トークン数(補正前)。追加のたびに差分だけ更新し、履歴が置き換えられた場合は数え直す"""
+    key = str(channel_id)
+    entry = _channel_totals.get(key)
+    if entry is None or entry[0] != id(history) or entry[1] != len(history):
+        entry = [id(history), len(history), sum(estimate_turn_tokens(t) for t in history)]
+        _channel_totals[key] = entry
+    return entry[2]
+
+def invalidate(channel_id):
+    """履歴の内容が差し替えられた場合に、推定トークン数を数え直させる"""
+    _channel_totals.pop(str(channel_id), None)
+
+def carry_over(channel_id, old_history: list, new_history: list):
+    """履歴をコピーして差し替える場合に、コピー元の推定トークン数をコピー先に引き継ぐ"""
+    entry = _channel_totals.get(str(channel_id))
+    if entry is not None and entry[0] == id(old_history) and entry[1] == len(old_history) == len(new_history):
+        entry[0] = id(new_history)
+
+def note_appended(channel_id, history: list, turn: dict):
+    """履歴の末尾にターンが追加されたことを反映する"""
+    entry = _channel_totals.get(str(channel_id))
+    if entry is not None and entry[0] == id(history) and entry[1] == len(history) - 1:
+        entry[1] += 1
+        entry[2] += estimate_turn_tokens(turn)
+
+def trim_to_budget(channel_id, history: list, model_name: str) -> list:
+    """
+    履歴がモデルのトークン予算か最大メッセージ数を超えていれば、ペルソナ(先頭)を残して
+    古い会話ペアから削除する。削除は下限(ローウォーターマーク)まで一度にまとめて行い、
+    リストの詰め直しが毎回発生しないようにする。削除したターンのリストを返す。
+    """
+    factor = get_calibration(model_name)
+    budget = config.get_history_token_budget(model_name)
+    max_length = config.get_max_history_length()
+    raw_total = history_raw_tokens(channel_id, history)
+
+    if raw_total * factor <= budget and len(history) < max_length:
+        return []
+    if len(history) < 3:
+        log_warning("HISTORY", f"CH[{channel_id}] 履歴が上限を超えていますが、ペルソナと応答のみのため削除しませんでした。")
+        return []
+
+    low_watermark = config.HISTORY_TRIM_LOW_WATERMARK
+    target_tokens = budget * low_watermark
+    target_length = max(3, int(max_length * low_watermark))
+
+    remove_count = 0
+    removed_raw = 0.0
+    # ペルソナ(インデックス0)は常に残し、ペア単位で削除する
+    while len(history) - remove_count >= 3 and (
+        (raw_total - removed_raw) * factor > target_tokens or len(history) - remove_count > target_length
+    ):
+        removed_raw += estimate_turn_tokens(history[1 + remove_count])
+        removed_raw += estimate_turn_tokens(history[2 + remove_count]) if 2 + remove_count < len(history) else 0
+        remove_count += 2
+    remove_count = min(remove_count, len(history) - 1)
+
+    evicted = history[1:1 + remove_count]
+    del history[1:1 + remove_count]
+    _channel_totals[str(channel_id)] = [id(history), len(history), raw_total - removed_raw]
+    log_warning("HISTORY", f"CH[{channel_id}] の履歴が上限を超えたため、古い会話 {remove_count}件 を削除しました。(推定 {(raw_total - removed_raw) * factor:.0f} / 予算 {budget} トークン)")
+    return evicted
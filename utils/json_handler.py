@@ -1,20 +1,119 @@
+import os
 import json
-from .console_display import log_info, log_error, log_success
+import shutil
+import hashlib
+from datetime import datetime
+from .console_display import log_info, log_error, log_success, log_warning
+
+# 保存のたびに、以下のファイルを保存先の隣に作成します。
+#   <file>.bak  : 1つ前の世代 (書き込みが壊れていた場合の復旧用)
+#   <file>.meta : 世代番号とチェックサム (読み込み時の破損検出用)
+BACKUP_SUFFIX = ".bak"
+META_SUFFIX = ".meta"
+
+def _sha256(payload: bytes) -> str:
+    return hashlib.sha256(payload).hexdigest()
+
+def _fsync_directory(file_path: str):
+    """rename をディスクに確定させる (対応していないOSでは何もしない)"""
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def _atomic_write_bytes(file_path: str, payload: bytes):
+    """一時ファイルに書き込み fsync してから rename で置き換える"""
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+def _keep_backup(file_path: str):
+    """現在のファイルを .bak として残す (可能ならハードリンクでコピーを避ける)"""
+    if not os.path.exists(file_path):
+        return
+    backup_path = file_path + BACKUP_SUFFIX
+    link_tmp_path = backup_path + ".tmp"
+    try:
+        if os.path.exists(link_tmp_path):
+            os.remove(link_tmp_path)
+        os.link(file_path, link_tmp_path)
+    except OSError:
+        shutil.copy2(file_path, link_tmp_path)
+    os.replace(link_tmp_path, backup_path)
+
+def _read_meta(file_path: str) -> dict:
+    try:
+        with open(file_path + META_SUFFIX, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def _parse_file(file_path: str):
+    """ファイルを読み込み、(データ, 生のバイト列) を返す"""
+    with open(file_path, 'rb') as f:
+        payload = f.read()
+    return json.loads(payload.decode('utf-8')), payload
+
+def _move_aside(file_path: str) -> str:
+    """壊れたファイルを上書きせずに退避する"""
+    corrupt_path = f"{file_path}.corrupt-{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    os.replace(file_path, corrupt_path)
+    return corrupt_path
+
+def _recover_from_backup(file_path: str):
+    """1つ前の世代から復旧する。復旧できなければ None を返す"""
+    backup_path = file_path + BACKUP_SUFFIX
+    try:
+        data, payload = _parse_file(backup_path)
+    except (FileNotFoundError, json.JSONDecodeError, UnicodeDecodeError):
+        return None
+    _atomic_write_bytes(file_path, payload)
+    meta = _read_meta(file_path)
+    meta.update({"sha256": _sha256(payload), "size": len(payload)})
+    _atomic_write_bytes(file_path + META_SUFFIX, json.dumps(meta).encode('utf-8'))
+    log_warning("JSON", f"'{file_path}' を1つ前の世代 ('{backup_path}') から復旧しました。")
+    return data
 
 def load_json(file_path: str, default_data=None):
     """
     JSONファイルを安全に読み込みます。
-    ファイルが存在しない、または空の場合はデフォルト値を返します。
+    ファイルが壊れている場合は1つ前の世代から復旧し、それも無理な場合は
+    壊れたファイルを退避したうえでデフォルト値を返します。
     """
     if default_data is None:
         default_data = {}
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            log_success("JSON", f"'{file_path}' を読み込みました。")
-            return data
-    except (FileNotFoundError, json.JSONDecodeError):
-        log_info("JSON", f"'{file_path}' が見つからないか不正な形式のため、デフォルトデータで初期化します。")
+        data, payload = _parse_file(file_path)
+        meta = _read_meta(file_path)
+        if meta and meta.get("sha256") != _sha256(payload):
+            # 手動で編集された場合もここに来るため、内容が正しく読めれば採用する
+            log_warning("JSON", f"'{file_path}' のチェックサムが世代 {meta.get('generation')} の記録と一致しません。(手動編集または書き込み中断の可能性)")
+        log_success("JSON", f"'{file_path}' を読み込みました。")
+        return data
+    except FileNotFoundError:
+        recovered = _recover_from_backup(file_path)
+        if recovered is not None:
+            return recovered
+        log_info("JSON", f"'{file_path}' が見つからないため、デフォルトデータで初期化します。")
+        save_json(default_data, file_path)
+        return default_data
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        log_error("JSON", f"'{file_path}' が破損しています。")
+        corrupt_path = _move_aside(file_path)
+        log_warning("JSON", f"破損したファイルを '{corrupt_path}' に退避しました。")
+        recovered = _recover_from_backup(file_path)
+        if recovered is not None:
+            return recovered
+        log_info("JSON", f"'{file_path}' を復旧できないため、デフォルトデータで初期化します。")
         save_json(default_data, file_path)
         return default_data
     except Exception as e:
@@ -24,9 +123,15 @@ def load_json(file_path: str, default_data=None):
 def save_json(data, file_path: str):
     """
     指定されたパスにデータをJSON形式で保存します。
+    一時ファイル + fsync + rename で置き換えるため、書き込み中に終了しても元のファイルは壊れません。
     """
     try:
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        payload = json.dumps(data, indent=2, ensure_ascii=False).encode('utf-8')
+        generation = _read_meta(file_path).get("generation", 0) + 1
+        _keep_backup(file_path)
+        _atomic_write_bytes(file_path, payload)
+        meta = {"generation": generation, "sha256": _sha256(payload), "size": len(payload)}
+        _atomic_write_bytes(file_path + META_SUFFIX, json.dumps(meta).encode('utf-8'))
+        _fsync_directory(file_path)
     except Exception as e:
-        log_error("JSON", f"'{file_path}' の保存中にエラー: {e}")
\ No newline at end of file
+        log_error("JSON", f"'{file_path}' の保存中にエラー: {e}")
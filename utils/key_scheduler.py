@@ -0,0 +1,184 @@
+# key_scheduler.py
+
+import re
+import time
+from utils.console_display import log_info, log_warning
+
+# "Please retry in 12.5s" 形式の待機時間
+_RETRY_IN_PATTERN = re.compile(r"Please retry in (\d+\.?\d*)s")
+
+def parse_retry_delay(error_message: str, default: float) -> float:
+    """エラーメッセージから再試行までの待機時間(秒)を抽出する"""
+    match = _RETRY_IN_PATTERN.search(error_message)
+    if match:
+        return float(match.group(1))
+    return default
+
+class TokenBucket:
+    """1分あたりのリクエスト数を制限するトークンバケット"""
+    __slots__ = ("capacity", "refill_per_second", "tokens", "updated_at")
+
+    def __init__(self, requests_per_minute: float):
+        self.capacity = float(requests_per_minute)
+        self.refill_per_second = requests_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_second)
+            self.updated_at = now
+
+    def available(self, now: float) -> float:
+        self._refill(now)
+        return self.tokens
+
+    def seconds_until_available(self, now: float) -> float:
+        self._refill(now)
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.refill_per_second
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1.0
+
+class KeyState:
+    """1つのAPIキーの健康状態"""
+
+    def __init__(self, api_key: str, number: int, requests_per_minute: float):
+        self.api_key = api_key
+        self.number = number # 1始まりのキー番号 (表示用)
+        self.requests_per_minute = requests_per_minute
+        self.in_flight = 0
+        self.success_count = 0
+        self.error_count = 0
+        self.rate_limited_count = 0
+        self.error_rate = 0.0 # 直近のエラー率 (指数移動平均)
+        self._buckets = {}   # モデル名 -> TokenBucket
+        self._cooldowns = {} # モデル名 -> クールダウン終了時刻 (monotonic)
+
+    def bucket(self, model_name: str) -> TokenBucket:
+        bucket = self._buckets.get(model_name)
+        if bucket is None:
+            bucket = TokenBucket(self.requests_per_minute)
+            self._buckets[model_name] = bucket
+        return bucket
+
+    def cooldown_remaining(self, model_name: str, now: float) -> float:
+        return max(0.0, self._cooldowns.get(model_name, 0.0) - now)
+
+    def seconds_until_available(self, model_name: str, now: float) -> float:
+        return max(self.cooldown_remaining(model_name, now),
+                   self.bucket(model_name).seconds_until_available(now))
+
+    def record(self, success: bool, alpha: float):
+        if success:
+            self.success_count += 1
+        else:
+            self.error_count += 1
+        self.error_rate = (1 - alpha) * self.error_rate + alpha * (0.0 if success else 1.0)
+
+class KeyScheduler:
+    """
+    APIキーごとのレート制限・クールダウン・エラー率・実行中リクエスト数を追跡し、
+    各リクエストを最も健康なキーに即座に割り当てる。
+    """
+
+    def __init__(self, requests_per_minute: float = 10, error_rate_alpha: float = 0.2):
+        self.requests_per_minute = requests_per_minute
+        self.error_rate_alpha = error_rate_alpha
+        self._states = {}  # APIキー -> KeyState
+        self._keys = ()
+        self.preferred_key = None # 優先して使うAPIキー (!key コマンド)
+        self.last_used_key = None
+
+    def sync_keys(self, api_keys: list[str]):
+        """client_pool のキー一覧と同期する (変更時のみ状態を作り直す)"""
+        new_keys = tuple(api_keys)
+        if new_keys == self._keys:
+            return
+        self._states = {
+            key: self._states.get(key) or KeyState(key, i + 1, self.requests_per_minute)
+            for i, key in enumerate(new_keys)
+        }
+        for i, key in enumerate(new_keys):
+            self._states[key].number = i + 1
+        self._keys = new_keys
+        if self.preferred_key not in self._states:
+            self.preferred_key = None
+        log_info("KEY_SCHEDULER", f"APIキー {len(new_keys)}個 の状態を同期しました。")
+
+    def get_states(self) -> list[KeyState]:
+        return [self._states[key] for key in self._keys]
+
+    def get_state(self, api_key: str) -> KeyState | None:
+        return self._states.get(api_key)
+
+    def _score(self, state: KeyState, model_name: str, now: float) -> tuple:
+        # 小さいほど良い: 実行中の数 → エラー率 → 残りトークンの多さ → 優先キー
+        preferred = 0 if state.api_key == self.preferred_key else 1
+        return (state.in_flight, round(state.error_rate, 2), -state.bucket(model_name).available(now), preferred, state.number)
+
+    def acquire(self, model_name: str, exclude: set = frozenset(), low_priority: bool = False) -> KeyState | None:
+        """
+        今すぐ使えるキーの中から最も健康なものを選び、実行中として登録する。
+        使えるキーがなければ None を返す (待機はしない)。
+        low_priority の場合は、実行中リクエストがなくトークンに余裕があるキーだけを使う。
+        """
+        now = time.monotonic()
+        candidates = []
+        for state in self.get_states():
+            if state.api_key in exclude:
+                continue
+            if state.seconds_until_available(model_name, now) > 0:
+                continue
+            if low_priority and (state.in_flight > 0 or state.bucket(model_name).available(now) < state.bucket(model_name).capacity / 2):
+                continue
+            candidates.append(state)
+        if not candidates:
+            return None
+
+        best = min(candidates, key=lambda s: self._score(s, model_name, now))
+        best.bucket(model_name).take(now)
+        best.in_flight += 1
+        return best
+
+    def seconds_until_any_available(self, model_name: str, exclude: set = frozenset()) -> float | None:
+        """除外されていないキーのうち、最も早く使えるようになるまでの秒数"""
+        now = time.monotonic()
+        waits = [s.seconds_until_available(model_name, now) for s in self.get_states() if s.api_key not in exclude]
+        return min(waits) if waits else None
+
+    def release(self, state: KeyState):
+        """結果を記録せずに実行中カウントだけ戻す (キャンセル時など)"""
+        state.in_flight = max(0, state.in_flight - 1)
+
+    def report_success(self, state: KeyState):
+        state.in_flight = max(0, state.in_flight - 1)
+        state.record(True, self.error_rate_alpha)
+        self.last_used_key = state.api_key
+
+    def report_error(self, state: KeyState):
+        state.in_flight = max(0, state.in_flight - 1)
+        state.record(False, self.error_rate_alpha)
+
+    def report_rate_limited(self, state: KeyState, model_name: str, retry_after: float):
+        """レート制限を受けたキーを retry_after 秒間クールダウンさせる"""
+        now = time.monotonic()
+        state.in_flight = max(0, state.in_flight - 1)
+        state.rate_limited_count += 1
+        state.record(False, self.error_rate_alpha)
+        state._cooldowns[model_name] = max(state._cooldowns.get(model_name, 0.0), now + retry_after)
+        log_warning("KEY_SCHEDULER", f"APIキー {state.number} をモデル '{model_name}' について {retry_after:.1f}秒間クールダウンします。")
+
+    def describe(self) -> list[str]:
+        """各キーの状態を表示用の文字列で返す"""
+        now = time.monotonic()
+        lines = []
+        for state in self.get_states():
+            cooldown = max((state.cooldown_remaining(m, now) for m in state._cooldowns), default=0.0)
+            status = f"⏳{cooldown:.0f}s" if cooldown > 0 else "✅"
+            lines.append(f"#{state.number} {status} 成功:{state.success_count} 失敗:{state.error_count} 実行中:{state.in_flight}")
+        return lines
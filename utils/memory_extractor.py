@@ -0,0 +1,135 @@
+# memory_extractor.py
+#
+# 会話履歴に追加されたターンから、長く覚えておくべき事実を安価なモデルで抽出して記憶に加える。
+# ターンはチャンネルごとに溜めておき、MemoryCog の定期処理でまとめて抽出する (応答処理では待たない)。
+# リクエストは低優先度で行い、応答処理で使われているAPIキーやトークンに余裕のないキーは使わない。
+# 既存の記憶とほぼ同じ内容は追加しない。
+
+import json
+import time
+import utils.config_manager as config
+from utils import prompt_builder
+from utils.console_display import log_info, log_error, log_success
+
+# チャンネルID -> 抽出待ちのターン
+_pending_turns = {}
+# チャンネルID -> 最も古い抽出待ちのターンを受け取った時刻 (time.monotonic)
+_pending_since = {}
+# チャンネルID -> 抽出中に古い方から捨てられたターン数 (抽出中のチャンネルのみ)
+_trimmed_in_flight = {}
+stats = {"batches": 0, "added": 0, "duplicates": 0, "deferred": 0, "failed": 0}
+
+def queue_turns(channel_id, turns: list):
+    """履歴に追加されたターンを抽出待ちに加える (古すぎる分は捨てる)"""
+    if not config.MEMORY_EXTRACTION_ENABLED or not turns:
+        return
+    str_channel_id = str(channel_id)
+    pending = _pending_turns.setdefault(str_channel_id, [])
+    pending.extend(turns)
+    overflow = len(pending) - config.MEMORY_EXTRACTION_MAX_PENDING_TURNS
+    if overflow > 0:
+        del pending[:overflow]
+        if str_channel_id in _trimmed_in_flight:
+            _trimmed_in_flight[str_channel_id] += overflow
+    _pending_since.setdefault(str_channel_id, time.monotonic())
+
+def discard_pending(channel_id):
+    """履歴をリセットした場合などに、抽出待ちのターンを捨てる"""
+    _pending_turns.pop(str(channel_id), None)
+    _pending_since.pop(str(channel_id), None)
+
+def _ready_channels(now: float) -> list[str]:
+    """十分なターンが溜まったか、溜まり始めてから時間が経ったチャンネル"""
+    ready = []
+    for channel_id, pending in _pending_turns.items():
+        if not pending:
+            continue
+        waited = now - _pending_since.get(channel_id, now)
+        if len(pending) >= config.MEMORY_EXTRACTION_MIN_TURNS or waited >= config.MEMORY_EXTRACTION_MAX_WAIT_SECONDS:
+            ready.append(channel_id)
+    return ready
+
+def parse_memories(response_text: str) -> list[str] | None:
+    """モデルの応答 (文字列の JSON 配列) から記憶を取り出す。形式が不正なら None"""
+    json_text = response_text.strip().replace('```json', '').replace('```', '')
+    try:
+        items = json.loads(json_text)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(items, list):
+        return None
+    return [item.strip() for item in items if isinstance(item, str) and item.strip()]
+
+async def run_pending(memory_cog) -> int:
+    """抽出の準備ができたチャンネルを1つずつ処理し、追加した記憶の件数を返す"""
+    added = 0
+    for channel_id in _ready_channels(time.monotonic()):
+        result = await _extract_channel(channel_id, memory_cog)
+        if result is None:
+            break # 空いているキーがなければ、他のチャンネルも次回に回す
+        added += result
+    return added
+
+async def _extract_channel(channel_id: str, memory_cog) -> int | None:
+    """1チャンネル分の抽出。リクエストを見送った場合は None"""
+    from utils import ai_request_handler # 循環参照を避けるためここでインポート
+
+    pending = _pending_turns.get(channel_id)
+    if not pending:
+        return 0
+    turns = pending[:config.MEMORY_EXTRACTION_MAX_BATCH_TURNS]
+    conversation_text = "\n".join(p for t in turns for p in t.get("parts", []) if isinstance(p, str))
+    prompt = prompt_builder.build_memory_extraction_prompt(
+        memory_cog.select_memories(conversation_text), turns, config.MEMORY_EXTRACTION_MAX_ITEMS
+    )
+    log_info("MEMORY_EXTRACT", f"CH[{channel_id}] の会話 {len(turns)}件 から記憶を抽出します...")
+    _trimmed_in_flight[channel_id] = 0
+    try:
+        response_text = await ai_request_handler.send_request(
+            config.MEMORY_EXTRACTION_MODEL, prompt, channel_id=None, low_priority=True
+        )
+    except Exception as e:
+        log_error("MEMORY_EXTRACT", f"CH[{channel_id}] の記憶抽出中にエラー: {type(e).__name__} - {e}")
+        response_text = None
+    finally:
+        trimmed = _trimmed_in_flight.pop(channel_id, 0)
+    if not response_text:
+        # 抽出待ちのターンは残し、次回の定期処理で再試行する
+        stats["deferred"] += 1
+        log_info("MEMORY_EXTRACT", f"CH[{channel_id}] の記憶抽出を次回に見送ります。")
+        return None
+
+    # 抽出中に追加されたターンは残す (リセットされていた場合は何もしない)。
+    # 抽出中に古い方から捨てられた分は先頭がずれているので、その分だけ削除数を減らす
+    if _pending_turns.get(channel_id) is pending:
+        del pending[:max(0, len(turns) - trimmed)]
+        if pending:
+            _pending_since[channel_id] = time.monotonic()
+        else:
+            discard_pending(channel_id)
+    stats["batches"] += 1
+
+    memories = parse_memories(response_text)
+    if memories is None:
+        stats["failed"] += 1
+        log_error("MEMORY_EXTRACT", f"AIからの返答が不正なJSON形式でした: {response_text}")
+        return 0
+
+    added = 0
+    for memory_text in memories[:config.MEMORY_EXTRACTION_MAX_ITEMS]:
+        duplicate = memory_cog.find_duplicate(memory_text)
+        if duplicate is not None:
+            stats["duplicates"] += 1
+            log_info("MEMORY_EXTRACT", f"既存の記憶と重複するため追加しません: {memory_text} (既存: {duplicate})")
+            continue
+        memory_cog.add_memory(memory_text)
+        added += 1
+    stats["added"] += added
+    log_success("MEMORY_EXTRACT", f"CH[{channel_id}] から {added}件 の記憶を追加しました。(候補 {len(memories)}件)")
+    return added
+
+def describe() -> str:
+    """!status 表示用の統計"""
+    pending = sum(len(turns) for turns in _pending_turns.values())
+    return (f"抽出待ち: {pending}ターン / 抽出: {stats['batches']}回 / 追加: {stats['added']} / "
+            f"重複: {stats['duplicates']} / 見送り: {stats['deferred']} / 失敗: {stats['failed']}")
@@ -0,0 +1,169 @@
+# memory_index.py
+#
+# 記憶 (memory.json のリスト) の検索用インデックス。
+# プロンプトに全ての記憶を入れる代わりに、応答するメッセージに関係の深い記憶だけを選ぶ。
+# 日本語は単語の区切りがないため、非ASCII文字は文字 bigram、英数字は単語で索引し、BM25 で順位を付ける。
+# 記憶の追加・削除はインデックスを作り直さずに差分で反映する。
+
+import re
+import math
+import heapq
+import unicodedata
+from collections import Counter
+from utils import history_trimmer
+
+# BM25 のパラメーター
+BM25_K1 = 1.2
+BM25_B = 0.75
+# 記憶の半数を超えて現れる索引語は区別に役立たないため、スコア計算に使わない
+MAX_DOCUMENT_FREQUENCY_RATIO = 0.5
+# 重複判定で類似度を計算する候補の数 (記憶がこれ以下なら全てと比較する)
+SIMILARITY_CANDIDATES = 20
+
+# 英数字の単語、または日本語などの文字の連続 (空白・記号は区切りとして捨てる)
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+|[^\W\da-z_]+")
+
+def similarity(terms_a: set, terms_b: set) -> float:
+    """索引語の集合の Dice 係数 (0.0〜1.0)"""
+    if not terms_a or not terms_b:
+        return 0.0
+    return 2 * len(terms_a & terms_b) / (len(terms_a) + len(terms_b))
+
+def tokenize(text: str) -> list[str]:
+    """テキストを索引語に分割する (英数字は単語、日本語などは文字 bigram)"""
+    terms = []
+    for run in _TOKEN_PATTERN.findall(unicodedata.normalize("NFKC", text).lower()):
+        if run.isascii() or len(run) == 1:
+            terms.append(run)
+        else:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return terms
+
+class MemoryIndex:
+    """
+    記憶のリストと同じ順序で文書を保持する BM25 インデックス。
+    文書IDは追加順に増えるため、IDの順序がそのまま記憶リストの順序になる。
+    """
+
+    def __init__(self, memories: list | None = None):
+        self._ids = []         # 記憶リストの位置 -> 文書ID
+        self._texts = {}       # 文書ID -> 記憶のテキスト
+        self._lengths = {}     # 文書ID -> 索引語数
+        self._tokens = {}      # 文書ID -> 推定トークン数
+        self._postings = {}    # 索引語 -> {文書ID: 出現回数}
+        self._total_length = 0
+        self._total_tokens = 0.0
+        self._next_id = 0
+        for memory in memories or []:
+            self.add(memory)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, text: str):
+        """記憶リストの末尾に追加された記憶を索引する"""
+        doc_id = self._next_id
+        self._next_id += 1
+        terms = Counter(tokenize(text))
+        for term, count in terms.items():
+            self._postings.setdefault(term, {})[doc_id] = count
+        length = sum(terms.values())
+        self._ids.append(doc_id)
+        self._texts[doc_id] = text
+        self._lengths[doc_id] = length
+        self._tokens[doc_id] = history_trimmer.estimate_text_tokens(text)
+        self._total_length += length
+        self._total_tokens += self._tokens[doc_id]
+
+    def remove(self, index: int):
+        """記憶リストの index 番目から削除された記憶を索引から除く"""
+        doc_id = self._ids.pop(index)
+        for term in set(tokenize(self._texts.pop(doc_id))):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(doc_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= self._lengths.pop(doc_id)
+        self._total_tokens -= self._tokens.pop(doc_id)
+
+    def clear(self):
+        self._ids.clear()
+        self._texts.clear()
+        self._lengths.clear()
+        self._tokens.clear()
+        self._postings.clear()
+        self._total_length = 0
+        self._total_tokens = 0.0
+
+    def _score(self, query: str) -> dict:
+        """クエリに含まれる索引語を持つ文書の BM25 スコア"""
+        doc_count = len(self._ids)
+        if not doc_count:
+            return {}
+        average_length = self._total_length / doc_count or 1.0
+        max_frequency = max(1, doc_count * MAX_DOCUMENT_FREQUENCY_RATIO)
+        lengths = self._lengths
+        scores = {}
+        for term, query_count in Counter(tokenize(query)).items():
+            postings = self._postings.get(term)
+            if not postings or len(postings) > max_frequency:
+                continue
+            weight = query_count * (BM25_K1 + 1) * math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, count in postings.items():
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths[doc_id] / average_length)
+                scores[doc_id] = scores.get(doc_id, 0.0) + weight * count / (count + norm)
+        return scores
+
+    def _fill_budget(self, doc_ids, top_k: int, token_budget: float) -> list:
+        """doc_ids の順に、件数とトークン数の上限まで選ぶ"""
+        selected = []
+        used_tokens = 0.0
+        for doc_id in doc_ids:
+            if len(selected) >= top_k or used_tokens >= token_budget:
+                break
+            tokens = self._tokens[doc_id]
+            if used_tokens + tokens > token_budget:
+                continue
+            selected.append(doc_id)
+            used_tokens += tokens
+        return selected
+
+    def select(self, query: str | None, top_k: int, token_budget: float) -> list[str]:
+        """
+        クエリに関係の深い記憶を最大 top_k 件、推定トークン数の合計が token_budget 以内で選び、
+        記憶リストの順序で返す。全ての記憶が上限内に収まる場合は全てを返す。
+        一致する記憶が上限に満たない場合は、新しい記憶で埋める。
+        """
+        if len(self._ids) <= top_k and self._total_tokens <= token_budget:
+            return [self._texts[doc_id] for doc_id in self._ids]
+
+        scores = self._score(query) if query else {}
+        ranked = heapq.nlargest(top_k, scores, key=lambda doc_id: (scores[doc_id], doc_id))
+        selected = self._fill_budget(ranked, top_k, token_budget)
+        if len(selected) < top_k:
+            chosen = set(selected)
+            used_tokens = sum(self._tokens[doc_id] for doc_id in selected)
+            recent = (doc_id for doc_id in reversed(self._ids) if doc_id not in chosen)
+            selected += self._fill_budget(recent, top_k - len(selected), token_budget - used_tokens)
+        return [self._texts[doc_id] for doc_id in sorted(selected)]
+
+    def find_similar(self, text: str, threshold: float) -> str | None:
+        """text とほぼ同じ内容の記憶 (類似度が threshold 以上で最も近いもの) を返す"""
+        terms = set(tokenize(text))
+        if len(self._ids) <= SIMILARITY_CANDIDATES:
+            candidates = self._ids
+        else:
+            scores = self._score(text)
+            candidates = heapq.nlargest(SIMILARITY_CANDIDATES, scores, key=scores.get)
+        best_text, best_score = None, threshold
+        for doc_id in candidates:
+            candidate_text = self._texts[doc_id]
+            score = 1.0 if candidate_text == text else similarity(terms, set(tokenize(candidate_text)))
+            if score >= best_score:
+                best_text, best_score = candidate_text, score
+        return best_text
+
+    def describe(self) -> str:
+        """!status 表示用の統計"""
+        return f"{len(self._ids)}件 / 索引語 {len(self._postings)}種類"
@@ -0,0 +1,121 @@
+# message_streamer.py
+#
+# ストリーミングで届くモデルの応答を、文・段落の区切りごとに Discord のメッセージへ反映する。
+# 最初の区切りが届いた時点で投稿し、以降は一定間隔で同じメッセージを編集して伸ばしていく。
+
+import asyncio
+import discord
+from utils.console_display import log_info, log_error
+
+# Discord の1メッセージあたりの最大文字数
+DISCORD_MESSAGE_LIMIT = 2000
+# ここまで届いたら表示してよい区切り文字
+SENTENCE_BOUNDARIES = "。！？!?\n"
+
+def find_split_point(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> int:
+    """limit 文字以内で分割する位置を返す (改行があればその直前、なければ limit)"""
+    split_point = text.rfind('\n', 0, limit)
+    return limit if split_point == -1 else split_point
+
+class MessageStreamer:
+    """
+    feed() で受け取ったテキストを、edit_interval 秒に1回まで Discord に反映する。
+    2000文字を超えた分は send_splittable_message と同じ規則で分割し、新しいメッセージとして続ける。
+    """
+
+    def __init__(self, channel: discord.abc.Messageable, edit_interval: float):
+        self.channel = channel
+        self.edit_interval = edit_interval
+        self.messages = [] # 投稿したメッセージ
+        self._text = ""          # 受信済みの全テキスト
+        self._shown = 0          # 表示済みの位置 (self._text のインデックス)
+        self._segment_start = 0  # 現在のメッセージが始まる位置
+        self._message = None     # 編集中のメッセージ
+        self._rendered = ""      # 編集中のメッセージの現在の内容
+        self._wake = asyncio.Event()
+        self._closing = False
+        self._task = None
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def feed(self, text: str):
+        """モデルから届いたテキストを追加する (表示はバックグラウンドで行う)"""
+        self._text += text
+        self._wake.set()
+
+    async def finish(self, file: discord.File = None):
+        """残りのテキストを全て表示する。file があれば最後に別メッセージで送る"""
+        self._closing = True
+        self._wake.set()
+        if self._task:
+            await self._task
+        await self._flush(final=True)
+        if file:
+            await self._send(file=file)
+        log_info("STREAM", f"ストリーミング表示を完了しました。({len(self._text)}文字, {len(self.messages)}メッセージ)")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        last_flush = 0.0
+        while not self._closing:
+            await self._wake.wait()
+            self._wake.clear()
+            if self._closing:
+                break
+            delay = self.edit_interval - (loop.time() - last_flush)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self._flush(final=False)
+            last_flush = loop.time()
+
+    def _last_boundary(self) -> int:
+        """未表示の部分にある最後の区切りの直後の位置 (なければ表示済みの位置)"""
+        end = max(self._text.rfind(c, self._shown) for c in SENTENCE_BOUNDARIES)
+        return end + 1 if end != -1 else self._shown
+
+    async def _flush(self, final: bool):
+        end = len(self._text) if final else self._last_boundary()
+        if end <= self._shown:
+            return
+        while end - self._segment_start > DISCORD_MESSAGE_LIMIT:
+            segment = self._text[self._segment_start:end]
+            split_point = find_split_point(segment)
+            await self._render(segment[:split_point])
+            # 続きは新しいメッセージにする (先頭の空白は詰める)
+            start = self._segment_start + split_point
+            while start < end and self._text[start].isspace():
+                start += 1
+            self._segment_start = start
+            self._message = None
+            self._rendered = ""
+        await self._render(self._text[self._segment_start:end])
+        self._shown = end
+
+    async def _render(self, content: str):
+        if not content.strip() or content == self._rendered:
+            return
+        if self._message is None:
+            self._message = await self._send(content)
+            if self._message is None:
+                return
+        else:
+            try:
+                await self._message.edit(content=content)
+            except discord.HTTPException as e:
+                log_error("STREAM", f"メッセージの編集に失敗しました: {e}")
+                return
+        self._rendered = content
+
+    async def _send(self, content: str = None, file: discord.File = None):
+        try:
+            message = await self.channel.send(content, file=file)
+        except discord.HTTPException as e:
+            log_error("STREAM", f"メッセージの送信に失敗しました: {e}")
+            return None
+        self.messages.append(message)
+        return message
@@ -0,0 +1,89 @@
+# persistence_writer.py
+#
+# ディスクへの書き込みをイベントループの外 (専用の書き込みスレッド) で行う。
+# 書き込みスレッドは1本だけなので、投入された処理は投入順に実行される。
+
+import asyncio
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from .console_display import log_error, log_info
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="persistence")
+
+# ファイルパス -> (スナップショット関数, 書き込み関数)
+# 同じファイルへの保存要求は、実際に書き込むまでの間1つにまとめられる
+_pending_saves = {}
+_drain_task = None
+# 実行中の書き込み処理
+_inflight = set()
+
+def _get_running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+def _on_done(future):
+    _inflight.discard(future)
+    if not future.cancelled() and future.exception() is not None:
+        error = future.exception()
+        log_error("PERSISTENCE", f"書き込み処理中にエラー: {type(error).__name__} - {error}")
+        log_error("PERSISTENCE", "".join(traceback.format_exception(error)))
+
+def submit(fn, *args):
+    """
+    書き込み処理を書き込みスレッドで実行する (投入順は保たれる)。
+    イベントループ外から呼ばれた場合はその場で同期的に実行する。
+    """
+    loop = _get_running_loop()
+    if loop is None:
+        fn(*args)
+        return
+    future = loop.run_in_executor(_executor, fn, *args)
+    _inflight.add(future)
+    future.add_done_callback(_on_done)
+
+def schedule_save(file_path: str, snapshot_fn, writer):
+    """
+    ファイルの保存を予約する。
+    snapshot_fn は書き込み直前にイベントループ上で呼ばれ、書き込むデータのコピーを返す。
+    まだ書き込まれていない同じファイルへの要求は1回の書き込みにまとめられる。
+    """
+    global _drain_task
+    loop = _get_running_loop()
+    if loop is None:
+        writer(snapshot_fn(), file_path)
+        return
+    _pending_saves[file_path] = (snapshot_fn, writer)
+    if _drain_task is None or _drain_task.done():
+        _drain_task = loop.create_task(_drain_pending_saves())
+
+async def _drain_pending_saves():
+    loop = asyncio.get_running_loop()
+    while _pending_saves:
+        file_path, (snapshot_fn, writer) = _pending_saves.popitem()
+        try:
+            # スナップショットはループ上で取り、シリアライズと書き込みはスレッドで行う
+            data = snapshot_fn()
+            await loop.run_in_executor(_executor, writer, data, file_path)
+        except Exception as e:
+            log_error("PERSISTENCE", f"'{file_path}' の保存中にエラー: {type(e).__name__} - {e}")
+
+def has_pending_writes() -> bool:
+    return bool(_pending_saves or _inflight or (_drain_task and not _drain_task.done()))
+
+async def flush():
+    """予約・実行中の全ての書き込みが完了するまで待つ"""
+    global _drain_task
+    while has_pending_writes():
+        if _drain_task and not _drain_task.done():
+            await _drain_task
+        elif _pending_saves:
+            _drain_task = asyncio.get_running_loop().create_task(_drain_pending_saves())
+        elif _inflight:
+            await asyncio.gather(*list(_inflight), return_exceptions=True)
+
+def shutdown():
+    """書き込みスレッドを停止する (flush() の後に呼ぶ)"""
+    _executor.shutdown(wait=True)
+    log_info("PERSISTENCE", "書き込みスレッドを停止しました。")
@@ -9,8 +9,11 @@ def get_current_time_str():
     weekday_jp = weekday_jp_list[now.weekday()]
     return now.strftime(f"%Y年%m月%d日({weekday_jp}) %H時%M分")
 
-def get_bot_status_text(bot) -> str:
-    """Botの現在の感情と記憶から、状況説明テキストを生成します。"""
+def get_bot_status_text(bot, memory_query: str | None = None) -> str:
+    """
+    Botの現在の感情と記憶から、状況説明テキストを生成します。
+    記憶は memory_query (応答するメッセージ) に関係の深いものだけを含めます。
+    """
     emotion_cog = bot.get_cog('EmotionCog')
     memory_cog = bot.get_cog('MemoryCog')
     chat_cog = bot.get_cog('ChatManagerCog')
@@ -19,14 +22,14 @@ def get_bot_status_text(bot) -> str:
         return "# 内部状態\n（Cogがロードされていません）"
 
     # 感情データを取得
-    current_emotions = emotion_cog.current_emotions
+    current_emotions = emotion_cog.get_current_emotions() # 既定値への減衰を反映した値
     emotion_map = emotion_cog.emotion_map
     
     emotion_lines = [f"* {ja_name}: {current_emotions.get(name, 0)}" for name, (_, ja_name) in emotion_map.items()]
     emotions_text = "\n".join(emotion_lines)
 
     # 記憶データを取得
-    memories = memory_cog.memories
+    memories = memory_cog.select_memories(memory_query)
     memories_text = ""
     if memories:
         memories_list = "\n".join(f"* {m}" for m in memories)
@@ -43,36 +46,98 @@ def get_bot_status_text(bot) -> str:
 {get_current_time_str()}
 """
 
-def build_response_prompt(messages: list, bot_status: str) -> str:
+def build_memory_query(messages: list) -> str | None:
+    """未読メッセージ (UnreadMessage のリスト) から、記憶を検索するためのテキストを作ります。"""
+    if not messages:
+        return None
+    return "\n".join(m.content for m in messages)
+
+def build_response_prompt(messages: list, bot_status: str, overflow_note: str | None = None) -> str:
     """
     AIに応答を生成させるためのプロンプトを組み立てます。
-    未読メッセージの有無で内容を切り替えます。
+    未読メッセージ (UnreadMessage のリスト) の有無で内容を切り替えます。
+    overflow_note は上限を超えて省略された未読メッセージの説明です。
     """
-    if messages:
+    if messages or overflow_note:
         # 1. 未読メッセージがある場合
         # ★ アクティビティ情報を含めるようにフォーマットを変更
-        conversation_log = "\n".join(
-            # f"[{m['author']} @ {m['timestamp']}] (現在の行動: {m.get('activity', '不明')}): {m['content']}"
-            f"[{m['author']} @ {m['timestamp']}] : {m['content']}"
+        log_lines = [overflow_note] if overflow_note else []
+        log_lines.extend(
+            # f"[{m.author} @ {m.timestamp}] (現在の行動: {m.activity}): {m.content}"
+            f"[{m.author} @ {m.timestamp}] : {m.content}"
             for m in messages
         )
+        conversation_log = "\n".join(log_lines)
         instruction = "あなたはDiscordを確認したところ、以下の未読メッセージが溜まっていました。\n相手の「現在の行動」も参考にしながら、これら全ての会話の流れを踏まえて、あなたの次のメッセージを生成してください。"
         return f"{instruction}\n\n{conversation_log}\n\n{bot_status}"
     else:
         # 2. 自発的メッセージを生成させたい場合
         instruction = "あなたはDiscordを確認したところ、未読メッセージはありませんでした。\n相手の「現在の行動」も参考にしながら、これら全ての会話の流れを踏まえて、あなたの次のメッセージを生成してください。"
-        return f"{instruction}\n\n{conversation_log}\n\n{bot_status}"
+        return f"{instruction}\n\n{bot_status}"
 
-def build_emotion_analysis_prompt(emotion_map: dict, persona: str, user_input: str, bot_response: str) -> str:
+def build_user_message_for_history(messages: list, overflow_note: str | None = None) -> str | None:
     """
-    対話から感情の変化を分析させるためのプロンプトを組み立てます。
+    応答した未読メッセージを、会話履歴に残すユーザー側の発言にまとめます。
+    """
+    lines = [overflow_note] if overflow_note else []
+    lines.extend(f"[{m.author} @ {m.timestamp}]: {m.content}" for m in messages)
+    return "\n".join(lines) if lines else None
+
+def build_emotion_batch_prompt(emotion_map: dict, persona: str, exchanges: list) -> str:
+    """
+    複数の対話 ((ユーザーの発言, AIの応答) のリスト) から感情の変化を1回で分析させるためのプロンプトを組み立てます。
     """
     emotion_list_str = ", ".join([f"'{name}({ja_name})'" for name, (_, ja_name) in emotion_map.items()])
-    
+    dialogues = "\n\n".join(
+        f'[対話{i}]\n[ユーザー]: "{user_input}"\n[AIの応答]: "{bot_response}"'
+        for i, (user_input, bot_response) in enumerate(exchanges, 1)
+    )
     return (
         f"{persona}\n\n"
         f"分析可能な感情リスト:\n{emotion_list_str}\n\n"
-        f'分析対象の対話:\n'
-        f'[ユーザー]: "{user_input}"\n'
-        f'[AIの応答]: "{bot_response}"'
-    )
\ No newline at end of file
+        "分析対象の対話は番号の順に起きた出来事です。対話ごとに、その対話による感情の変化量を分析してください。\n"
+        "出力は、対話の番号 (id) と変化量 (deltas) を持つオブジェクトの JSON 配列にしてください。\n"
+        '例: [{"id": 1, "deltas": {"joy": 10}}, {"id": 2, "deltas": {}}]\n\n'
+        f"分析対象の対話:\n{dialogues}"
+    )
+
+def _format_turns(turns: list) -> str:
+    """履歴のターンを、記録係に渡す会話ログの形式にします。"""
+    role_labels = {"user": "[ユーザー]", "model": "[あなた]"}
+    return "\n".join(
+        f"{role_labels.get(t.get('role'), '[不明]')}: {' '.join(p for p in t.get('parts', []) if isinstance(p, str))}"
+        for t in turns
+    )
+
+def build_history_summary_prompt(previous_summary: str | None, turns: list, max_chars: int) -> str:
+    """
+    履歴から削除される古い会話を、これまでの要約に畳み込ませるためのプロンプトを組み立てます。
+    """
+    conversation_log = _format_turns(turns)
+    previous_text = previous_summary if previous_summary else "（まだ要約はありません）"
+    return (
+        "あなたはロールプレイの記録係です。\n"
+        "以下の「これまでの要約」に「新たに古くなった会話」の内容を統合し、新しい要約を作成してください。\n"
+        "登場人物の関係、約束、出来事、話題の流れなど、今後の会話に必要な情報を優先して残してください。\n"
+        f"要約は日本語の箇条書きで、{max_chars}文字以内にしてください。要約本文のみを出力してください。\n\n"
+        f"# これまでの要約\n{previous_text}\n\n"
+        f"# 新たに古くなった会話\n{conversation_log}"
+    )
+
+def build_memory_extraction_prompt(existing_memories: list, turns: list, max_items: int) -> str:
+    """
+    会話から、長期的な記憶として残すべき事実を抽出させるためのプロンプトを組み立てます。
+    """
+    conversation_log = _format_turns(turns)
+    existing_text = "\n".join(f"* {m}" for m in existing_memories) if existing_memories else "（まだ記憶はありません）"
+    return (
+        "あなたはロールプレイの記録係です。\n"
+        "以下の会話から、今後の会話でも覚えておくべき長期的な記憶を抽出してください。\n"
+        "ユーザーの名前・好み・予定・約束・人間関係など、時間が経っても変わりにくい事実を優先し、"
+        "その場限りの挨拶や感想は含めないでください。\n"
+        "「既存の記憶」と同じ内容は含めないでください。\n"
+        f"記憶は1件1文の日本語で最大{max_items}件とし、文字列の JSON 配列のみを出力してください。"
+        "抽出するものがなければ [] を出力してください。\n\n"
+        f"# 既存の記憶\n{existing_text}\n\n"
+        f"# 抽出対象の会話\n{conversation_log}"
+    )
@@ -0,0 +1,319 @@
+# storage_backend.py
+#
+# 会話履歴の保存先 (バックエンド) を切り替えるための仕組み。
+#   - JournalHistoryBackend : チャンネルごとの追記専用ジャーナル (JSONL)
+#   - SqliteHistoryBackend  : SQLite (WALモード) のテーブル
+# どちらも書き込みは persistence_writer の書き込みスレッドで行い、
+# 履歴は LazyHistoryCache によってチャンネル単位で必要になった時に読み込まれる。
+
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+import utils.config_manager as config
+from . import history_journal, persistence_writer
+from .history_journal import HistoryLoadError
+from .json_handler import load_json
+from .console_display import log_info, log_error, log_success
+
+class HistoryBackend:
+    """会話履歴バックエンドの共通処理 (書き込み待ちの数をチャンネルごとに追跡する)"""
+    name = "base"
+
+    def __init__(self):
+        self._pending_writes = {}
+        self._pending_lock = threading.Lock()
+
+    def _submit(self, channel_id: str, fn, *args):
+        with self._pending_lock:
+            self._pending_writes[channel_id] = self._pending_writes.get(channel_id, 0) + 1
+
+        def run():
+            try:
+                fn(*args)
+            finally:
+                with self._pending_lock:
+                    self._pending_writes[channel_id] -= 1
+
+        persistence_writer.submit(run)
+
+    def has_pending_writes(self, channel_id: str) -> bool:
+        with self._pending_lock:
+            return self._pending_writes.get(channel_id, 0) > 0
+
+    # --- 各バックエンドで実装する ---
+    def list_channels(self) -> list[str]:
+        raise NotImplementedError
+
+    def load_channel(self, channel_id: str) -> list | None:
+        """チャンネルの履歴を返す。履歴がなければ None、あるのに読めなければ HistoryLoadError"""
+        raise NotImplementedError
+
+    def append_turns(self, channel_id: str, turns: list[dict]):
+        raise NotImplementedError
+
+    def delete_turns(self, channel_id: str, start: int, stop: int):
+        raise NotImplementedError
+
+    def reset_channel(self, channel_id: str, turns: list[dict]):
+        raise NotImplementedError
+
+    def update_turn(self, channel_id: str, index: int, turn: dict):
+        raise NotImplementedError
+
+    def compact_if_needed(self, histories: dict):
+        """必要であれば保存領域を整理する (既定では何もしない)"""
+
+    def close(self):
+        """バックエンドを閉じる (既定では何もしない)"""
+
+class JournalHistoryBackend(HistoryBackend):
+    """チャンネルごとの追記専用ジャーナルに保存する"""
+    name = "journal"
+
+    def list_channels(self) -> list[str]:
+        return history_journal.list_channels()
+
+    def load_channel(self, channel_id: str) -> list | None:
+        return history_journal.load_channel(channel_id)
+
+    def _append_records(self, channel_id: str, records: list[dict]):
+        text = history_journal.encode_records(channel_id, records)
+        self._submit(channel_id, history_journal.write_lines, channel_id, text)
+
+    def append_turns(self, channel_id: str, turns: list[dict]):
+        self._append_records(channel_id, history_journal.append_records(turns))
+
+    def delete_turns(self, channel_id: str, start: int, stop: int):
+        self._append_records(channel_id, [history_journal.delete_record(start, stop)])
+
+    def reset_channel(self, channel_id: str, turns: list[dict]):
+        self._append_records(channel_id, [history_journal.reset_record(turns)])
+
+    def update_turn(self, channel_id: str, index: int, turn: dict):
+        self._append_records(channel_id, [history_journal.set_record(index, turn)])
+
+    def _compact(self, channel_id: str, turns: list):
+        try:
+            history_journal.write_compacted(channel_id, turns)
+        except Exception as e:
+            log_error("JOURNAL", f"CH[{channel_id}] のコンパクション中にエラー: {e}")
+
+    def compact_if_needed(self, histories: dict):
+        """操作数が履歴の長さに比べて大きくなったジャーナルを書き直す"""
+        for channel_id, turns in histories.items():
+            if not history_journal.needs_compaction(channel_id, len(turns)):
+                continue
+            op_count = history_journal.get_op_count(channel_id)
+            history_journal.mark_compacted(channel_id, len(turns))
+            # ターンは追加後に書き換えられないため、リストの浅いコピーをスナップショットとして渡す
+            self._submit(channel_id, self._compact, channel_id, list(turns))
+            log_info("JOURNAL", f"CH[{channel_id}] のジャーナルのコンパクションを予約しました。({op_count}行 -> {len(turns)}行)")
+
+class SqliteHistoryBackend(HistoryBackend):
+    """
+    SQLite に保存する。(channel_id, seq) を主キーとするテーブルに1ターン1行で格納する。
+    読み込みはイベントループ側の接続、書き込みは書き込みスレッド側の接続を使う (WALモードで並行可能)。
+    """
+    name = "sqlite"
+
+    def __init__(self, db_path: str):
+        super().__init__()
+        self.db_path = db_path
+        self._read_conn = self._connect()
+        self._write_conn = self._connect()
+        self._write_lock = threading.Lock()
+        self._next_seq = {} # チャンネルID -> 次に割り当てる seq (イベントループ側で管理)
+        self._create_schema()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _create_schema(self):
+        with self._write_conn:
+            self._write_conn.execute("""
+                CREATE TABLE IF NOT EXISTS history (
+                    channel_id TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    parts TEXT NOT NULL,
+                    PRIMARY KEY (channel_id, seq)
+                ) WITHOUT ROWID
+            """)
+
+    @staticmethod
+    def _encode_parts(turn: dict) -> str:
+        return json.dumps(turn.get("parts", []), ensure_ascii=False)
+
+    def _execute_write(self, statements: list[tuple]):
+        with self._write_lock:
+            try:
+                with self._write_conn:
+                    for sql, params in statements:
+                        self._write_conn.execute(sql, params)
+            except Exception as e:
+                log_error("SQLITE", f"履歴の書き込み中にエラー: {e}")
+
+    def _assign_seqs(self, channel_id: str, count: int) -> range:
+        start = self._next_seq.get(channel_id)
+        if start is None:
+            row = self._read_conn.execute("SELECT MAX(seq) FROM history WHERE channel_id = ?", (channel_id,)).fetchone()
+            start = (row[0] + 1) if row and row[0] is not None else 0
+        self._next_seq[channel_id] = start + count
+        return range(start, start + count)
+
+    def list_channels(self) -> list[str]:
+        rows = self._read_conn.execute("SELECT DISTINCT channel_id FROM history").fetchall()
+        if not rows:
+            return self._migrate()
+        return [row[0] for row in rows]
+
+    def load_channel(self, channel_id: str) -> list | None:
+        rows = self._read_conn.execute(
+            "SELECT seq, role, parts FROM history WHERE channel_id = ? ORDER BY seq", (channel_id,)
+        ).fetchall()
+        if not rows:
+            return None
+        self._next_seq[channel_id] = rows[-1][0] + 1
+        return [{"role": role, "parts": json.loads(parts)} for _, role, parts in rows]
+
+    def append_turns(self, channel_id: str, turns: list[dict]):
+        seqs = self._assign_seqs(channel_id, len(turns))
+        statements = [
+            ("INSERT INTO history (channel_id, seq, role, parts) VALUES (?, ?, ?, ?)",
+             (channel_id, seq, turn["role"], self._encode_parts(turn)))
+            for seq, turn in zip(seqs, turns)
+        ]
+        self._submit(channel_id, self._execute_write, statements)
+
+    def delete_turns(self, channel_id: str, start: int, stop: int):
+        # 書き込みは投入順に実行されるため、位置 (OFFSET) で削除対象を特定できる
+        statements = [(
+            "DELETE FROM history WHERE channel_id = ? AND seq IN "
+            "(SELECT seq FROM history WHERE channel_id = ? ORDER BY seq LIMIT ? OFFSET ?)",
+            (channel_id, channel_id, max(0, stop - start), start)
+        )]
+        self._submit(channel_id, self._execute_write, statements)
+
+    def _reset_statements(self, channel_id: str, turns: list[dict]) -> list[tuple]:
+        self._next_seq[channel_id] = len(turns)
+        statements = [("DELETE FROM history WHERE channel_id = ?", (channel_id,))]
+        statements.extend(
+            ("INSERT INTO history (channel_id, seq, role, parts) VALUES (?, ?, ?, ?)",
+             (channel_id, seq, turn["role"], self._encode_parts(turn)))
+            for seq, turn in enumerate(turns)
+        )
+        return statements
+
+    def reset_channel(self, channel_id: str, turns: list[dict]):
+        self._submit(channel_id, self._execute_write, self._reset_statements(channel_id, turns))
+
+    def update_turn(self, channel_id: str, index: int, turn: dict):
+        statements = [(
+            "UPDATE history SET role = ?, parts = ? WHERE channel_id = ? AND seq = "
+            "(SELECT seq FROM history WHERE channel_id = ? ORDER BY seq LIMIT 1 OFFSET ?)",
+            (turn["role"], self._encode_parts(turn), channel_id, channel_id, index)
+        )]
+        self._submit(channel_id, self._execute_write, statements)
+
+    def _migrate(self) -> list[str]:
+        """空のデータベースに、既存のジャーナル (なければ history.json) から履歴を取り込む"""
+        journal_backend = JournalHistoryBackend()
+        histories = {}
+        for channel_id in journal_backend.list_channels():
+            try:
+                turns = journal_backend.load_channel(channel_id)
+            except HistoryLoadError as e:
+                log_error("SQLITE", f"{e}このチャンネルは移行しません。")
+                continue
+            if turns is not None:
+                histories[channel_id] = turns
+        if not histories:
+            histories = load_json(config.HISTORY_FILE, default_data={})
+        for channel_id, turns in histories.items():
+            self._execute_write(self._reset_statements(channel_id, turns))
+        if histories:
+            log_success("SQLITE", f"{len(histories)}チャンネル分の履歴を '{self.db_path}' に移行しました。")
+        return list(histories)
+
+    def close(self):
+        self._read_conn.close()
+        with self._write_lock:
+            self._write_conn.close()
+
+def create_history_backend() -> HistoryBackend:
+    """config.STORAGE_BACKEND に応じたバックエンドを作成する"""
+    if config.STORAGE_BACKEND == "sqlite":
+        return SqliteHistoryBackend(config.HISTORY_DB_FILE)
+    if config.STORAGE_BACKEND != "journal":
+        log_error("STORAGE", f"不明なストレージバックエンド '{config.STORAGE_BACKEND}' です。ジャーナルを使用します。")
+    return JournalHistoryBackend()
+
+class LazyHistoryCache(dict):
+    """
+    チャンネルIDをキーとする履歴の辞書。
+    履歴は最初にアクセスされた時にバックエンドから読み込まれ、
+    常駐するチャンネル数が上限を超えると、最も長く使われていないものから解放される。
+    (書き込み待ちのあるチャンネルは解放しない)
+    """
+
+    def __init__(self, backend: HistoryBackend, max_resident: int):
+        super().__init__()
+        self._backend = backend
+        self._max_resident = max_resident
+        self._known_channels = set(backend.list_channels())
+        self._lru = OrderedDict()
+
+    def _touch(self, channel_id: str):
+        self._lru[channel_id] = None
+        self._lru.move_to_end(channel_id)
+
+    def _evict_cold_channels(self, keep: str):
+        if len(self._lru) <= self._max_resident:
+            return
+        for channel_id in list(self._lru):
+            if len(self._lru) <= self._max_resident:
+                break
+            if channel_id == keep or self._backend.has_pending_writes(channel_id):
+                continue
+            del self._lru[channel_id]
+            dict.pop(self, channel_id, None)
+            log_info("HISTORY_CACHE", f"CH[{channel_id}] の履歴をメモリから解放しました。")
+
+    def _ensure_loaded(self, channel_id: str):
+        if not dict.__contains__(self, channel_id):
+            # 読み込みに失敗した場合 (HistoryLoadError) は空の履歴として扱わず、呼び出し元に伝える
+            turns = self._backend.load_channel(channel_id)
+            dict.__setitem__(self, channel_id, turns if turns is not None else [])
+        self._touch(channel_id)
+        self._evict_cold_channels(keep=channel_id)
+
+    def __contains__(self, channel_id) -> bool:
+        return dict.__contains__(self, channel_id) or channel_id in self._known_channels
+
+    def __getitem__(self, channel_id):
+        if channel_id not in self:
+            raise KeyError(channel_id)
+        self._ensure_loaded(channel_id)
+        return dict.__getitem__(self, channel_id)
+
+    def get(self, channel_id, default=None):
+        return self[channel_id] if channel_id in self else default
+
+    def __setitem__(self, channel_id, turns):
+        dict.__setitem__(self, channel_id, turns)
+        self._known_channels.add(channel_id)
+        self._touch(channel_id)
+        self._evict_cold_channels(keep=channel_id)
+
+    def __delitem__(self, channel_id):
+        dict.pop(self, channel_id, None)
+        self._lru.pop(channel_id, None)
+        self._known_channels.discard(channel_id)
+
+    def known_channels(self) -> list[str]:
+        """メモリに常駐していないものも含めた全チャンネルID"""
+        return list(self._known_channels)
@@ -0,0 +1,249 @@
+# unread_queue.py
+#
+# チャンネルごとの未読メッセージのキュー。
+# チャンネルあたりの件数に上限を設け、超えた場合は UNREAD_OVERFLOW_POLICY に従って古いものを処理する。
+#   "drop_oldest": 古いメッセージから捨てる
+#   "summarize"  : 古いメッセージを「省略された件数と発言者」にまとめる
+#   "collapse"   : 同じ発言者の連続したメッセージを1件にまとめ、それでも超える分は古いものから捨てる
+#
+# 応答処理では seal() で処理対象のメッセージを確定させ、成功したら commit() でそれだけを取り除く。
+# 処理中に届いたメッセージは次回の処理に残る。
+
+import sys
+from collections import deque, Counter
+import utils.config_manager as config
+from utils.console_display import log_warning, log_error
+
+OVERFLOW_POLICIES = ("drop_oldest", "summarize", "collapse")
+# JSON 保存時に、省略されたメッセージの情報を入れるキー
+OVERFLOW_KEY = "_overflow"
+
+class UnreadMessage:
+    """未読メッセージ1件 (発言者名は sys.intern で共有する)"""
+    __slots__ = ("author", "content", "timestamp", "activity", "count")
+
+    def __init__(self, author: str, content: str, timestamp: str, activity: str = "特になし", count: int = 1):
+        self.author = sys.intern(author)
+        self.content = content
+        self.timestamp = timestamp
+        self.activity = activity
+        self.count = count # まとめられたメッセージの件数
+
+    def to_dict(self) -> dict:
+        data = {"author": self.author, "content": self.content, "timestamp": self.timestamp, "activity": self.activity}
+        if self.count != 1:
+            data["count"] = self.count
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "UnreadMessage":
+        return cls(
+            data.get("author", "Unknown"), data.get("content", ""), data.get("timestamp", ""),
+            data.get("activity", "特になし"), data.get("count", 1),
+        )
+
+def format_overflow_note(count: int, authors: Counter) -> str | None:
+    """省略したメッセージの、プロンプト用の説明文"""
+    if not count:
+        return None
+    author_text = "、".join(f"{author}({n}件)" for author, n in authors.most_common())
+    return f"（これより前の {count}件 のメッセージは省略されています。発言者: {author_text}）"
+
+class ChannelQueue:
+    """1チャンネル分の未読メッセージと、上限を超えて省略したメッセージの記録"""
+    __slots__ = ("messages", "overflow_count", "overflow_authors", "sealed")
+
+    def __init__(self):
+        self.messages = deque()
+        self.overflow_count = 0
+        self.overflow_authors = Counter()
+        self.sealed = 0 # 先頭から何件が処理中のバッチに含まれているか
+
+    def __len__(self) -> int:
+        return len(self.messages)
+
+    def popleft(self) -> UnreadMessage:
+        if self.sealed:
+            self.sealed -= 1
+        return self.messages.popleft()
+
+class UnreadBatch:
+    """seal() で確定させた、1回の応答処理の対象となる未読メッセージ"""
+    __slots__ = ("channel_id", "messages", "overflow_count", "overflow_authors")
+
+    def __init__(self, channel_id: str, messages: list[UnreadMessage], overflow_count: int, overflow_authors: Counter):
+        self.channel_id = channel_id
+        self.messages = messages
+        self.overflow_count = overflow_count
+        self.overflow_authors = overflow_authors
+
+    def __bool__(self) -> bool:
+        return bool(self.messages or self.overflow_count)
+
+    def overflow_note(self) -> str | None:
+        return format_overflow_note(self.overflow_count, self.overflow_authors)
+
+class UnreadQueue:
+    """チャンネルID (文字列) -> ChannelQueue"""
+
+    def __init__(self, max_per_channel: int, overflow_policy: str):
+        if overflow_policy not in OVERFLOW_POLICIES:
+            log_error("UNREAD", f"不明な未読メッセージの超過時の処理 '{overflow_policy}' です。drop_oldest を使用します。")
+            overflow_policy = "drop_oldest"
+        self.max_per_channel = max_per_channel
+        self.overflow_policy = overflow_policy
+        self._channels = {}
+        self.stats = {"appended": 0, "dropped": 0, "summarized": 0, "collapsed": 0}
+
+    # --- 参照 ---
+    def get_messages(self, channel_id) -> list[UnreadMessage]:
+        """チャンネルの未読メッセージ (古い順) のリストを返す"""
+        queue = self._channels.get(str(channel_id))
+        return list(queue.messages) if queue else []
+
+    def has_messages(self, channel_id) -> bool:
+        queue = self._channels.get(str(channel_id))
+        return bool(queue and (queue.messages or queue.overflow_count))
+
+    def channels_with_messages(self) -> list[str]:
+        return [ch for ch, queue in self._channels.items() if queue.messages or queue.overflow_count]
+
+    def has_sealed_batches(self) -> bool:
+        """応答処理中 (seal 済みで commit/release されていない) のチャンネルがあるか"""
+        return any(queue.sealed for queue in self._channels.values())
+
+    def overflow_note(self, channel_id) -> str | None:
+        """省略したメッセージがあれば、プロンプト用の説明文を返す"""
+        queue = self._channels.get(str(channel_id))
+        return format_overflow_note(queue.overflow_count, queue.overflow_authors) if queue else None
+
+    # --- 変更 ---
+    def append(self, channel_id, author: str, content: str, timestamp: str, activity: str = "特になし"):
+        self._push(str(channel_id), UnreadMessage(author, content, timestamp, activity))
+        self.stats["appended"] += 1
+
+    def _push(self, str_channel_id: str, message: UnreadMessage):
+        queue = self._channels.get(str_channel_id)
+        if queue is None:
+            queue = self._channels[str_channel_id] = ChannelQueue()
+        queue.messages.append(message)
+        if len(queue.messages) > self.max_per_channel:
+            self._handle_overflow(str_channel_id, queue)
+
+    def pop_oldest(self, channel_id) -> UnreadMessage | None:
+        queue = self._channels.get(str(channel_id))
+        if queue and queue.messages:
+            return queue.popleft()
+        return None
+
+    # --- 応答処理のバッチ ---
+    def seal(self, channel_id) -> UnreadBatch:
+        """現在の未読メッセージを処理対象として確定させる (以降に届いたメッセージは含まれない)"""
+        str_channel_id = str(channel_id)
+        queue = self._channels.get(str_channel_id)
+        if queue is None:
+            return UnreadBatch(str_channel_id, [], 0, Counter())
+        queue.sealed = len(queue.messages)
+        return UnreadBatch(str_channel_id, list(queue.messages), queue.overflow_count, Counter(queue.overflow_authors))
+
+    def commit(self, batch: UnreadBatch):
+        """処理し終えたバッチのメッセージだけを取り除く"""
+        queue = self._channels.get(batch.channel_id)
+        if queue is None:
+            return
+        # バッチのメッセージは先頭の sealed 件に残っている (超過やpopで減っている場合がある)
+        for _ in range(queue.sealed):
+            queue.messages.popleft()
+        queue.sealed = 0
+        queue.overflow_count = max(0, queue.overflow_count - batch.overflow_count)
+        queue.overflow_authors.subtract(batch.overflow_authors)
+        queue.overflow_authors += Counter() # 0件以下の発言者を取り除く
+        if not queue.messages and not queue.overflow_count:
+            del self._channels[batch.channel_id]
+
+    def release(self, batch: UnreadBatch):
+        """処理に失敗したバッチを未処理に戻す (メッセージは次回の処理に残る)"""
+        queue = self._channels.get(batch.channel_id)
+        if queue is not None:
+            queue.sealed = 0
+            # 処理中は上限を超えて保持していたため、ここで上限に合わせる
+            if len(queue.messages) > self.max_per_channel:
+                self._handle_overflow(batch.channel_id, queue)
+
+    def clear_channel(self, channel_id):
+        self._channels.pop(str(channel_id), None)
+
+    def clear(self):
+        self._channels.clear()
+
+    def _handle_overflow(self, channel_id: str, queue: ChannelQueue):
+        """
+        上限を超えた分を古いものから処理する。処理中のバッチのメッセージ (先頭の sealed 件) は
+        応答に失敗して未処理に戻る可能性があるため対象にせず、上限はそれ以降のメッセージに適用する。
+        """
+        if self.overflow_policy == "collapse":
+            self._collapse(queue)
+        overflow = len(queue.messages) - queue.sealed - self.max_per_channel
+        for _ in range(max(0, overflow)):
+            oldest = queue.messages[queue.sealed]
+            del queue.messages[queue.sealed]
+            if self.overflow_policy == "summarize":
+                queue.overflow_count += oldest.count
+                queue.overflow_authors[oldest.author] += oldest.count
+                self.stats["summarized"] += oldest.count
+            else:
+                self.stats["dropped"] += oldest.count
+        if overflow > 0 and self.overflow_policy != "summarize":
+            log_warning("UNREAD", f"CH[{channel_id}] の未読メッセージが上限 ({self.max_per_channel}件) を超えたため、古いものを {overflow}件 削除しました。")
+
+    def _collapse(self, queue: ChannelQueue):
+        """同じ発言者の連続したメッセージを1件にまとめる (処理中のバッチのメッセージには統合しない)"""
+        collapsed = deque()
+        for message in queue.messages:
+            last = collapsed[-1] if len(collapsed) > queue.sealed else None
+            if last is not None and last.author == message.author:
+                last.content = f"{last.content}\n{message.content}"
+                last.timestamp = message.timestamp
+                last.activity = message.activity
+                last.count += message.count
+                self.stats["collapsed"] += 1
+            else:
+                collapsed.append(message)
+        queue.messages = collapsed
+
+    # --- 保存・統計 ---
+    def to_json(self) -> dict:
+        data = {ch: [m.to_dict() for m in queue.messages] for ch, queue in self._channels.items() if queue.messages}
+        overflow = {
+            ch: {"count": queue.overflow_count, "authors": dict(queue.overflow_authors)}
+            for ch, queue in self._channels.items() if queue.overflow_count
+        }
+        if overflow:
+            data[OVERFLOW_KEY] = overflow
+        return data
+
+    @classmethod
+    def from_json(cls, data: dict, max_per_channel: int, overflow_policy: str) -> "UnreadQueue":
+        unread_queue = cls(max_per_channel, overflow_policy)
+        data = dict(data or {})
+        overflow = data.pop(OVERFLOW_KEY, {})
+        for channel_id, messages in data.items():
+            for message in messages:
+                unread_queue._push(str(channel_id), UnreadMessage.from_dict(message))
+        for channel_id, info in overflow.items():
+            queue = unread_queue._channels.setdefault(channel_id, ChannelQueue())
+            queue.overflow_count += info.get("count", 0)
+            queue.overflow_authors.update(info.get("authors", {}))
+        return unread_queue
+
+    def describe(self) -> str:
+        """!status 表示用の統計"""
+        total = sum(len(q.messages) for q in self._channels.values())
+        total_chars = sum(len(m.content) for q in self._channels.values() for m in q.messages)
+        largest = max((len(q.messages) for q in self._channels.values()), default=0)
+        return (f"{total}件 / {len(self._channels)}チャンネル (最大 {largest}/{self.max_per_channel}件, {total_chars}文字)\n"
+                f"超過時: {self.overflow_policy} / 削除 {self.stats['dropped']} / 省略 {self.stats['summarized']} / 統合 {self.stats['collapsed']}")
+
+def create_from_json(data: dict) -> UnreadQueue:
+    """設定値に従って、JSON から未読キューを作成する"""
+    return UnreadQueue.from_json(data, config.UNREAD_MAX_PER_CHANNEL, config.UNREAD_OVERFLOW_POLICY)
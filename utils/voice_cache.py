@@ -0,0 +1,190 @@
+# voice_cache.py
+#
+# VOICEVOX の合成結果 (音声) と audio_query の結果をキャッシュする。
+# キーは (正規化したテキスト, スタイルID, 速度, 音量, エンジンのバージョン) のハッシュで、
+# メモリ上の LRU と、その背後のディスクキャッシュの2段構成。どちらも合計サイズの上限を超えると
+# 最も長く使われていないものから削除する。
+
+import os
+import json
+import asyncio
+import hashlib
+import unicodedata
+from collections import OrderedDict
+import utils.config_manager as config
+from . import persistence_writer
+from .console_display import log_info, log_error
+
+# 種類ごとのファイル拡張子
+KIND_SUFFIXES = {"audio": ".wav", "query": ".json"}
+
+# キー -> バイト列 (最も古く使われたものが先頭)
+_memory = OrderedDict()
+_memory_bytes = 0
+# ディスク上のファイルパス -> サイズ (最初のアクセス時にディレクトリを走査して作成)
+_disk_index = None
+_disk_bytes = 0
+_disk_index_lock = None
+stats = {
+    "memory_hits": 0, "disk_hits": 0, "misses": 0,
+    "memory_evictions": 0, "disk_evictions": 0,
+}
+
+def normalize_text(text: str) -> str:
+    """全角・半角や空白の違いで別のキーにならないよう正規化する"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def make_key(kind: str, text: str, *params) -> str:
+    """キャッシュキーを作成する (kind は "audio" または "query")"""
+    payload = json.dumps([kind, normalize_text(text), *params], ensure_ascii=False, separators=(',', ':'))
+    return f"{kind}-{hashlib.sha256(payload.encode('utf-8')).hexdigest()}"
+
+def _path_for(key: str) -> str:
+    kind, digest = key.split("-", 1)
+    return os.path.join(config.VOICE_CACHE_DIR, kind, digest[:2], digest + KIND_SUFFIXES.get(kind, ".bin"))
+
+# --- メモリキャッシュ ---
+def _memory_get(key: str) -> bytes | None:
+    data = _memory.get(key)
+    if data is not None:
+        _memory.move_to_end(key)
+    return data
+
+def _memory_put(key: str, data: bytes):
+    global _memory_bytes
+    if len(data) > config.VOICE_CACHE_MEMORY_BYTES:
+        return
+    previous = _memory.pop(key, None)
+    if previous is not None:
+        _memory_bytes -= len(previous)
+    _memory[key] = data
+    _memory_bytes += len(data)
+    while _memory_bytes > config.VOICE_CACHE_MEMORY_BYTES:
+        _, evicted = _memory.popitem(last=False)
+        _memory_bytes -= len(evicted)
+        stats["memory_evictions"] += 1
+
+# --- ディスクキャッシュ ---
+def _scan_disk() -> OrderedDict:
+    """ディスク上のキャッシュを、最終アクセスが古い順に並べた索引を作る (スレッドで実行)"""
+    entries = []
+    for root, _, files in os.walk(config.VOICE_CACHE_DIR):
+        for name in files:
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, path, st.st_size))
+    entries.sort()
+    return OrderedDict((path, size) for _, path, size in entries)
+
+async def _ensure_disk_index():
+    global _disk_index, _disk_bytes, _disk_index_lock
+    if _disk_index is not None:
+        return
+    if _disk_index_lock is None:
+        _disk_index_lock = asyncio.Lock()
+    async with _disk_index_lock:
+        if _disk_index is None:
+            index = await asyncio.get_running_loop().run_in_executor(None, _scan_disk)
+            _disk_bytes = sum(index.values())
+            _disk_index = index
+            log_info("VOICE_CACHE", f"ディスクキャッシュを読み込みました。({len(index)}件, {_disk_bytes / 1024 / 1024:.1f}MB)")
+
+def _read_file(path: str) -> bytes | None:
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        os.utime(path) # LRU の順序を再起動後も保つため、最終アクセスとして更新する
+        return data
+    except OSError:
+        return None
+
+def _write_file(path: str, data: bytes):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        log_error("VOICE_CACHE", f"キャッシュの書き込み中にエラー: {e}")
+
+def _remove_files(paths: list[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def _disk_put(key: str, data: bytes):
+    global _disk_bytes
+    path = _path_for(key)
+    previous = _disk_index.pop(path, None)
+    if previous is not None:
+        _disk_bytes -= previous
+    _disk_index[path] = len(data)
+    _disk_bytes += len(data)
+    evicted = []
+    while _disk_bytes > config.VOICE_CACHE_DISK_BYTES and len(_disk_index) > 1:
+        old_path, size = _disk_index.popitem(last=False)
+        _disk_bytes -= size
+        evicted.append(old_path)
+        stats["disk_evictions"] += 1
+    # 書き込みと削除は書き込みスレッドで投入順に行う
+    persistence_writer.submit(_write_file, path, data)
+    if evicted:
+        persistence_writer.submit(_remove_files, evicted)
+
+# --- 公開API ---
+async def get(key: str) -> bytes | None:
+    """キャッシュからバイト列を取得する (メモリ → ディスクの順に探す)"""
+    if not config.VOICE_CACHE_ENABLED:
+        return None
+    data = _memory_get(key)
+    if data is not None:
+        stats["memory_hits"] += 1
+        return data
+    await _ensure_disk_index()
+    path = _path_for(key)
+    if path in _disk_index:
+        data = await asyncio.get_running_loop().run_in_executor(None, _read_file, path)
+        if data is not None:
+            _disk_index.move_to_end(path)
+            _memory_put(key, data)
+            stats["disk_hits"] += 1
+            return data
+    stats["misses"] += 1
+    return None
+
+async def put(key: str, data: bytes):
+    """バイト列をキャッシュに保存する"""
+    if not config.VOICE_CACHE_ENABLED or not data:
+        return
+    _memory_put(key, data)
+    await _ensure_disk_index()
+    _disk_put(key, data)
+
+async def get_json(key: str):
+    data = await get(key)
+    if data is None:
+        return None
+    try:
+        return json.loads(data.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+async def put_json(key: str, value):
+    await put(key, json.dumps(value, ensure_ascii=False).encode('utf-8'))
+
+def describe() -> str:
+    """!status 表示用の統計"""
+    lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+    hit_rate = (stats["memory_hits"] + stats["disk_hits"]) / lookups * 100 if lookups else 0.0
+    disk_text = f"{len(_disk_index)}件/{_disk_bytes / 1024 / 1024:.1f}MB" if _disk_index is not None else "未読込"
+    return (f"ヒット率: {hit_rate:.0f}% (メモリ {stats['memory_hits']} / ディスク {stats['disk_hits']} / ミス {stats['misses']})\n"
+            f"メモリ: {len(_memory)}件/{_memory_bytes / 1024 / 1024:.1f}MB, ディスク: {disk_text}\n"
+            f"削除: メモリ {stats['memory_evictions']} / ディスク {stats['disk_evictions']}")
@@ -1,127 +1,246 @@
 import aiohttp
+import asyncio
 import json
 import io
 import re
-import struct
 
 from utils import config_manager as config
-from utils.console_display import log_info, log_error, log_success
+from utils import voice_cache
+from utils import wav_assembler
+from utils.console_display import log_info, log_error, log_success, log_system
+
+# VOICEVOXエンジンとの接続を使い回すための共有セッション (最初の合成時に作成)
+_session = None
+# VOICEVOXへの同時リクエスト数を制限するセマフォ
+_semaphore = None
+# 実行中のメモリ解放クエリ
+_release_task = None
+# VOICEVOXエンジンのバージョン (キャッシュキーに含める)
+_engine_version = None
+
+def _get_session() -> aiohttp.ClientSession:
+    """コネクションプール付きの共有セッションを取得 (なければ作成)"""
+    global _session, _semaphore
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=config.VOICEVOX_MAX_CONCURRENCY, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(total=config.VOICEVOX_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        _semaphore = asyncio.Semaphore(config.VOICEVOX_MAX_CONCURRENCY)
+        log_info("VOICE_SYNTH", f"VOICEVOXとの共有セッションを作成しました。(同時リクエスト数: {config.VOICEVOX_MAX_CONCURRENCY})")
+    return _session
+
+async def close_session():
+    """共有セッションを閉じる (シャットダウン時に呼ぶ)"""
+    global _session
+    if _release_task and not _release_task.done():
+        _release_task.cancel()
+    if _session is not None and not _session.closed:
+        await _session.close()
+        log_system("VOICEVOXとの共有セッションを閉じました。")
+    _session = None
+
+async def _get_engine_version(session) -> str | None:
+    """エンジンのバージョンを取得する (取得できなければ None)"""
+    global _engine_version
+    if _engine_version is None:
+        try:
+            async with session.get(f"{config.VOICEVOX_URL}/version") as response:
+                if response.status == 200:
+                    _engine_version = str(await response.json())
+                    log_info("VOICE_SYNTH", f"VOICEVOXエンジンのバージョン: {_engine_version}")
+        except Exception as e:
+            log_error("VOICE_SYNTH", f"VOICEVOXエンジンのバージョン取得中にエラー: {e}")
+    return _engine_version
+
+async def _release_engine_memory(session):
+    """メモリ解放のために、短いダミークエリを投げる"""
+    try:
+        dummy_params = {"text": " ", "speaker": config.VOICEVOX_DEFAULT_STYLE_ID}
+        async with session.post(f"{config.VOICEVOX_URL}/audio_query", params=dummy_params):
+            log_success("VOICE_SYNTH", "VOICEVOXのメモリ解放クエリを送信しました。")
+    except Exception as e:
+        log_error("VOICE_SYNTH", f"メモリ解放クエリの送信中にエラー: {e}")
+
+async def _synthesize_chunk_bounded(session, text: str, style_id: int, speed: float):
+    async with _semaphore:
+        return await _synthesize_chunk(session, text, style_id, speed)
+
+async def _fetch_audio_query(session, text: str, style_id: int, engine_version: str | None) -> dict | None:
+    """audio_query の結果を取得する (キャッシュにあればそれを使う)"""
+    query_key = voice_cache.make_key("query", text, style_id, engine_version) if engine_version else None
+    if query_key:
+        audio_query = await voice_cache.get_json(query_key)
+        if audio_query is not None:
+            return audio_query
+    params = {"text": text, "speaker": style_id}
+    async with session.post(f"{config.VOICEVOX_URL}/audio_query", params=params) as response:
+        if response.status != 200: return None
+        audio_query = await response.json()
+    if query_key:
+        await voice_cache.put_json(query_key, audio_query)
+    return audio_query
 
 async def _synthesize_chunk(session, text: str, style_id: int, speed: float):
     try:
-        params = {"text": text, "speaker": style_id}
-        async with session.post(f"{config.VOICEVOX_URL}/audio_query", params=params) as response:
-            if response.status != 200: return None
-            audio_query = await response.json()
+        # エンジンのバージョンが分からない場合は、古い合成結果を使わないようキャッシュしない
+        engine_version = await _get_engine_version(session)
+        volume = config.VOICEVOX_VOLUME_SCALE
+        audio_key = voice_cache.make_key("audio", text, style_id, speed, volume, engine_version) if engine_version else None
+        if audio_key:
+            wav_data = await voice_cache.get(audio_key)
+            if wav_data is not None:
+                return wav_data
 
+        audio_query = await _fetch_audio_query(session, text, style_id, engine_version)
+        if audio_query is None: return None
+        audio_query = dict(audio_query) # キャッシュ上のデータは書き換えない
         audio_query['speedScale'] = speed
-        audio_query['volumeScale'] = 3.0
+        audio_query['volumeScale'] = volume
         
         headers = {"Content-Type": "application/json"}
         async with session.post(f"{config.VOICEVOX_URL}/synthesis", params={"speaker": style_id}, data=json.dumps(audio_query), headers=headers) as response:
             if response.status != 200: return None
-            return await response.read()
+            wav_data = await response.read()
+        if audio_key:
+            await voice_cache.put(audio_key, wav_data)
+        return wav_data
+    except aiohttp.ClientConnectorError:
+        log_error("VOICE_SYNTH", "VOICEVOXエンジンに接続できません。")
+        return None
     except Exception as e:
         log_error("VOICE_SYNTH", f"音声チャンクの合成中にエラー: {e}")
         return None
 
-def create_silent_wav_data(duration_ms: int, sample_rate: int = 24000) -> bytes:
-    num_channels = 1
-    bits_per_sample = 16
-    byte_rate = sample_rate * num_channels * bits_per_sample // 8
-    block_align = num_channels * bits_per_sample // 8
-    num_samples = int(sample_rate * duration_ms / 1000)
-    subchunk2_size = num_samples * block_align
-    chunk_size = 36 + subchunk2_size
-
-    header = struct.pack('<4sI4s4sIHHIIHH4sI',
-                         b'RIFF', chunk_size, b'WAVE', b'fmt ', 16, 1,
-                         num_channels, sample_rate, byte_rate, block_align,
-                         bits_per_sample, b'data', subchunk2_size)
-    
-    return header + (b'\x00' * subchunk2_size)
+# スタイル・速度の指定タグ (code:fun, speed:1.2 など)
+STYLE_TAG_PATTERN = re.compile(r"(code:\w+|speed:[\d.]+)")
+# ここまで届いたら合成を始めてよい区切り文字 (タグの途中で区切られることはない)
+SYNTH_BOUNDARIES = "。！？!?\n"
+SYSTEM_LINE_PREFIX = "> SYSTEM:"
 
-async def synthesize_speech_with_styles(raw_text: str) -> tuple[str, io.BytesIO | None]:
-    lines_for_speech = [line for line in raw_text.split('\n') if not line.strip().startswith("> SYSTEM:")]
-    text_for_synthesis = "\n".join(lines_for_speech)
-
-    # ★★★ 修正箇所 (正規表現の更新) ★★★
-    # speed: にも対応
-    parts = re.split(r"(code:\w+|speed:[\d.]+)", text_for_synthesis)
-    
-    final_chunks = []
-    current_style_id = config.VOICEVOX_DEFAULT_STYLE_ID
-    current_speed = config.VOICEVOX_SPEED_SCALE # ★ 速度の現在値を保持
-    clean_text_parts = []
-    
-    for part in parts:
-        if part.startswith("code:"):
-            style_key = part.replace("code:", "").lower()
-            current_style_id = config.VOICEVOX_STYLE_MAP.get(style_key, config.VOICEVOX_DEFAULT_STYLE_ID)
-        
-        # ★★★ 追加箇所 ★★★
-        elif part.startswith("speed:"):
-            try:
-                # speed:1.2 のような形式から数値を取得
-                current_speed = float(part.replace("speed:", ""))
-            except ValueError:
-                # 不正な値の場合はデフォルトに戻す
-                current_speed = config.VOICEVOX_SPEED_SCALE
-        # ★★★ ここまで ★★★
+class VoicePipeline:
+    """
+    応答テキストを受け取った分から解析し、区切りごとに VOICEVOX への合成を開始する。
+    ストリーミング中に feed() で渡せば、合成がテキストの生成と並行して進む。
+    finish() で全ての合成を待ち、1つの音声ファイルに結合する。
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._position = 0 # 解析済みの位置
+        self._at_line_start = True
+        self._skipping_line = False # "> SYSTEM:" で始まる行は読み上げない
+        self._style_id = config.VOICEVOX_DEFAULT_STYLE_ID
+        self._speed = config.VOICEVOX_SPEED_SCALE # ★ 速度の現在値を保持
+        self._new_chunk = False # タグの後は前のチャンクとの間に無音を入れる
+        self._clean_text_parts = []
+        self._tasks = []   # 合成タスク (元の順序)
+        self._gaps = []    # 各タスクの前に無音を入れるか
+        self._session = None
 
+    def feed(self, text: str, final: bool = False):
+        """テキストを追加し、区切りまで届いた部分 (final なら全て) の合成を開始する"""
+        self._buffer += text
+        self._process(final=final)
+
+    def cancel(self):
+        for task in self._tasks:
+            task.cancel()
+
+    def _process(self, final: bool):
+        if final:
+            end = len(self._buffer)
         else:
-            stripped_part = part.strip()
-            if not stripped_part: continue
-            # 現在のスタイルと速度でチャンクを作成
-            final_chunks.append((stripped_part, current_style_id, current_speed))
-            clean_text_parts.append(part)
-    
-    clean_text = "".join(clean_text_parts).strip()
-    if not final_chunks: return clean_text, None
-
-    audio_segments = []
-    try:
-        async with aiohttp.ClientSession() as session:
-            for text_chunk, style_id, speed in final_chunks:
-                # ★ ログにも速度を表示
-                # log_info("VOICE_SYNTH", f"テキスト '{text_chunk}' を Style: {style_id}, Speed: {speed} で合成中...")
-                wav_data = await _synthesize_chunk(session, text_chunk, style_id, speed)
-                if wav_data:
-                    audio_segments.append(wav_data)
-
-            # メモリ解放のために、最後に短いダミークエリを投げる
-            log_info("VOICE_SYNTH", "VOICEVOXのメモリを解放します...")
-            dummy_params = {"text": " ", "speaker": config.VOICEVOX_DEFAULT_STYLE_ID}
-            async with session.post(f"{config.VOICEVOX_URL}/audio_query", params=dummy_params):
-                log_success("VOICE_SYNTH", "VOICEVOXのメモリ解放クエリを送信しました。")
+            end = max(self._buffer.rfind(c, self._position) for c in SYNTH_BOUNDARIES) + 1
+            if end <= self._position:
+                return
+        ready_text = self._buffer[self._position:end]
+        self._position = end
 
-    except aiohttp.ClientConnectorError:
-        log_error("VOICE_SYNTH", "VOICEVOXエンジンに接続できません。")
-        return clean_text, None
+        # "> SYSTEM:" の行を除く (区切りはタグや接頭辞の途中には来ないため、行頭の判定に足りる長さがある)
+        kept = []
+        for piece in ready_text.splitlines(keepends=True):
+            if self._at_line_start:
+                self._skipping_line = piece.strip().startswith(SYSTEM_LINE_PREFIX)
+            if not self._skipping_line:
+                kept.append(piece)
+            self._at_line_start = piece.endswith("\n")
 
-    if not audio_segments:
-        log_error("VOICE_SYNTH", "音声セグメントの生成に失敗しました。")
-        return clean_text, None
+        for part in STYLE_TAG_PATTERN.split("".join(kept)):
+            if part.startswith("code:"):
+                style_key = part.replace("code:", "").lower()
+                self._style_id = config.VOICEVOX_STYLE_MAP.get(style_key, config.VOICEVOX_DEFAULT_STYLE_ID)
+                self._new_chunk = True
+            elif part.startswith("speed:"):
+                try:
+                    # speed:1.2 のような形式から数値を取得
+                    self._speed = float(part.replace("speed:", ""))
+                except ValueError:
+                    # 不正な値の場合はデフォルトに戻す
+                    self._speed = config.VOICEVOX_SPEED_SCALE
+                self._new_chunk = True
+            else:
+                self._clean_text_parts.append(part)
+                stripped_part = part.strip()
+                if not stripped_part: continue
+                # 現在のスタイルと速度で合成を開始
+                self._dispatch(stripped_part)
 
-    silent_chunk = create_silent_wav_data(500)
-    final_wav_data = io.BytesIO()
-    if not audio_segments:
-        return clean_text, None
-        
-    final_wav_data.write(audio_segments[0])
-    
-    if len(audio_segments) > 1:
-        log_info("VOICE_SYNTH", f"{len(audio_segments)}個の音声セグメントを1秒の間隔を空けて結合します...")
-        for segment in audio_segments[1:]:
-            final_wav_data.write(segment[44:])
-            final_wav_data.write(silent_chunk[44:])
-
-    total_data_size = final_wav_data.getbuffer().nbytes - 44
-    final_wav_data.seek(4)
-    final_wav_data.write((total_data_size + 36).to_bytes(4, 'little'))
-    final_wav_data.seek(40)
-    final_wav_data.write(total_data_size.to_bytes(4, 'little'))
-    
-    final_wav_data.seek(0)
-    log_success("VOICE_SYNTH", "音声ファイルの結合に成功しました。")
-    return clean_text, final_wav_data
\ No newline at end of file
+    def _dispatch(self, text: str):
+        if self._session is None:
+            self._session = _get_session()
+        self._gaps.append(self._new_chunk and bool(self._tasks))
+        self._new_chunk = False
+        self._tasks.append(asyncio.get_running_loop().create_task(
+            _synthesize_chunk_bounded(self._session, text, self._style_id, self._speed)
+        ))
+
+    async def finish(self) -> tuple[str, io.BytesIO | None]:
+        """残りのテキストを合成し、(タグを除いたテキスト, 音声ファイル) を返す"""
+        global _release_task
+        self._process(final=True)
+        clean_text = "".join(self._clean_text_parts).strip()
+        if not self._tasks: return clean_text, None
+
+        # チャンクは同時リクエスト数の上限まで並列に合成し、結果は元の順序で受け取る
+        log_info("VOICE_SYNTH", f"{len(self._tasks)}個のチャンクの合成を待っています...")
+        results = await asyncio.gather(*self._tasks)
+        audio_segments = []
+        gaps = []
+        for wav_data, gap in zip(results, self._gaps):
+            if wav_data:
+                audio_segments.append(wav_data)
+                gaps.append(gap)
+
+        if config.VOICEVOX_RELEASE_MEMORY_QUERY and (_release_task is None or _release_task.done()):
+            # 応答を待たせないよう、メモリ解放クエリはバックグラウンドで送る
+            _release_task = asyncio.get_running_loop().create_task(_release_engine_memory(self._session))
+
+        if not audio_segments:
+            log_error("VOICE_SYNTH", "音声セグメントの生成に失敗しました。")
+            return clean_text, None
+
+        if len(audio_segments) > 1:
+            log_info("VOICE_SYNTH", f"{len(audio_segments)}個の音声セグメントを結合します... (スタイルの切り替え: {sum(gaps)}箇所, 間隔 {config.VOICE_SEGMENT_GAP_MS}ミリ秒)")
+        wav_data = wav_assembler.assemble(audio_segments, config.VOICE_SEGMENT_GAP_MS, gaps)
+        if wav_data is None:
+            log_error("VOICE_SYNTH", "音声セグメントの結合に失敗しました。")
+            return clean_text, None
+
+        if config.VOICE_OUTPUT_FORMAT == "ogg":
+            encoded = await wav_assembler.encode_opus(wav_data)
+            if encoded is not None:
+                final_audio = io.BytesIO(encoded)
+                final_audio.name = "voice.ogg"
+                log_success("VOICE_SYNTH", "音声ファイルの結合に成功しました。")
+                return clean_text, final_audio
+
+        final_audio = io.BytesIO(wav_data)
+        final_audio.name = "voice.wav"
+        log_success("VOICE_SYNTH", "音声ファイルの結合に成功しました。")
+        return clean_text, final_audio
+
+async def synthesize_speech_with_styles(raw_text: str) -> tuple[str, io.BytesIO | None]:
+    """応答全体をまとめて音声合成する"""
+    pipeline = VoicePipeline()
+    pipeline.feed(raw_text, final=True)
+    return await pipeline.finish()
@@ -0,0 +1,178 @@
+# wav_assembler.py
+#
+# VOICEVOX が返す WAV セグメントを1つの WAV に結合する。
+# ヘッダーは44バイト固定とみなさずに RIFF のチャンクを読み、フォーマットが異なる
+# セグメントは先頭のセグメントに合わせて変換する。出力は一度だけ確保したバッファに
+# memoryview 経由で書き込み、無音部分はゼロ初期化されたバッファをそのまま使う。
+# 必要であれば ffmpeg で Opus (OGG) に圧縮する。
+
+import sys
+import shutil
+import struct
+import asyncio
+from array import array
+import utils.config_manager as config
+from utils.console_display import log_info, log_error, log_warning
+
+WAVE_FORMAT_PCM = 1
+WAV_HEADER_SIZE = 44
+
+class WavSegment:
+    """WAV データのフォーマットと、PCM データ部分の位置"""
+    __slots__ = ("data", "sample_rate", "channels", "bits_per_sample", "data_offset", "data_length")
+
+    def __init__(self, data, sample_rate: int, channels: int, bits_per_sample: int, data_offset: int, data_length: int):
+        self.data = data
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.bits_per_sample = bits_per_sample
+        self.data_offset = data_offset
+        self.data_length = data_length
+
+    @property
+    def block_align(self) -> int:
+        return self.channels * self.bits_per_sample // 8
+
+    def pcm(self) -> memoryview:
+        """PCM データ部分 (コピーしない)"""
+        return memoryview(self.data)[self.data_offset:self.data_offset + self.data_length]
+
+    def same_format(self, other: "WavSegment") -> bool:
+        return (self.sample_rate, self.channels, self.bits_per_sample) == (other.sample_rate, other.channels, other.bits_per_sample)
+
+def parse_wav(data: bytes) -> WavSegment:
+    """RIFF のチャンクを順に読み、fmt と data チャンクを探す。不正な場合は ValueError"""
+    if len(data) < 12 or data[0:4] != b'RIFF' or data[8:12] != b'WAVE':
+        raise ValueError("RIFF/WAVE ヘッダーがありません。")
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(data):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', data, offset)
+        body = offset + 8
+        if chunk_id == b'fmt ':
+            if chunk_size < 16:
+                raise ValueError("fmt チャンクが短すぎます。")
+            audio_format, channels, sample_rate, _, _, bits_per_sample = struct.unpack_from('<HHIIHH', data, body)
+            if audio_format != WAVE_FORMAT_PCM or bits_per_sample != 16:
+                raise ValueError(f"未対応のフォーマットです。(format={audio_format}, bits={bits_per_sample})")
+            fmt = (sample_rate, channels, bits_per_sample)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise ValueError("fmt チャンクより前に data チャンクがあります。")
+            # 書き込み途中などでサイズが実データより大きい場合は、実データの長さに合わせる
+            data_length = min(chunk_size, len(data) - body)
+            data_length -= data_length % (fmt[1] * fmt[2] // 8)
+            return WavSegment(data, fmt[0], fmt[1], fmt[2], body, data_length)
+        offset = body + chunk_size + (chunk_size & 1) # チャンクは偶数バイト境界に揃えられている
+    raise ValueError("data チャンクがありません。")
+
+def convert_pcm16(segment: WavSegment, sample_rate: int, channels: int) -> memoryview:
+    """16bit PCM をチャンネル数とサンプリングレートを合わせて変換する (線形補間)"""
+    samples = array('h')
+    samples.frombytes(segment.pcm())
+    if sys.byteorder != 'little':
+        samples.byteswap()
+
+    # チャンネル数を合わせる (モノラル化、またはモノラルの複製)
+    if segment.channels != channels:
+        frame_count = len(samples) // segment.channels
+        mono = array('h', (
+            sum(samples[i * segment.channels:(i + 1) * segment.channels]) // segment.channels
+            for i in range(frame_count)
+        )) if segment.channels > 1 else samples
+        samples = array('h', (s for s in mono for _ in range(channels))) if channels > 1 else mono
+
+    if segment.sample_rate != sample_rate:
+        frame_count = len(samples) // channels
+        out_count = frame_count * sample_rate // segment.sample_rate
+        ratio = segment.sample_rate / sample_rate
+        resampled = array('h', bytes(out_count * channels * 2))
+        last = frame_count - 1
+        for i in range(out_count):
+            position = i * ratio
+            index = int(position)
+            frac = position - index
+            next_index = index + 1 if index < last else last
+            for ch in range(channels):
+                a = samples[index * channels + ch]
+                b = samples[next_index * channels + ch]
+                resampled[i * channels + ch] = int(a + (b - a) * frac)
+        samples = resampled
+
+    if sys.byteorder != 'little':
+        samples.byteswap()
+    return memoryview(samples).cast('B')
+
+def _write_header(buffer: bytearray, sample_rate: int, channels: int, bits_per_sample: int, data_size: int):
+    block_align = channels * bits_per_sample // 8
+    struct.pack_into('<4sI4s4sIHHIIHH4sI', buffer, 0,
+                     b'RIFF', 36 + data_size, b'WAVE', b'fmt ', 16, WAVE_FORMAT_PCM,
+                     channels, sample_rate, sample_rate * block_align, block_align,
+                     bits_per_sample, b'data', data_size)
+
+def assemble(segments: list[bytes], gap_ms: int, gap_before: list[bool] | None = None) -> bytearray | None:
+    """
+    WAV セグメントを gap_ms ミリ秒の無音を挟んで1つの WAV に結合する。
+    gap_before を指定した場合は、True のセグメントの前にだけ無音を入れる。
+    フォーマットは最初の有効なセグメントに合わせ、読めないセグメントは飛ばす。
+    """
+    parsed = []
+    gaps = []
+    for i, data in enumerate(segments):
+        try:
+            parsed.append(parse_wav(data))
+            gaps.append(bool(parsed[1:]) and (gap_before is None or gap_before[i]))
+        except (ValueError, struct.error) as e:
+            log_error("WAV_ASSEMBLE", f"{i + 1}番目の音声セグメントを読めないため飛ばします: {e}")
+    if not parsed:
+        return None
+
+    target = parsed[0]
+    pcm_views = []
+    for segment in parsed:
+        if segment.same_format(target):
+            pcm_views.append(segment.pcm())
+        else:
+            log_warning("WAV_ASSEMBLE", f"フォーマットが異なるセグメントを変換します。({segment.sample_rate}Hz/{segment.channels}ch -> {target.sample_rate}Hz/{target.channels}ch)")
+            pcm_views.append(convert_pcm16(segment, target.sample_rate, target.channels))
+
+    gap_bytes = int(target.sample_rate * gap_ms / 1000) * target.block_align
+    data_size = sum(len(v) for v in pcm_views) + gap_bytes * sum(gaps)
+
+    # 出力バッファは一度だけ確保する (ゼロ初期化されているため無音部分は書き込み不要)
+    buffer = bytearray(WAV_HEADER_SIZE + data_size)
+    _write_header(buffer, target.sample_rate, target.channels, target.bits_per_sample, data_size)
+    out = memoryview(buffer)
+    position = WAV_HEADER_SIZE
+    for pcm, gap in zip(pcm_views, gaps):
+        if gap:
+            position += gap_bytes
+        out[position:position + len(pcm)] = pcm
+        position += len(pcm)
+    return buffer
+
+def is_ffmpeg_available() -> bool:
+    return shutil.which(config.FFMPEG_PATH) is not None
+
+async def encode_opus(wav_data: bytes) -> bytes | None:
+    """ffmpeg で WAV を Opus (OGG) に変換する。失敗した場合は None"""
+    if not is_ffmpeg_available():
+        log_warning("WAV_ASSEMBLE", f"ffmpeg ('{config.FFMPEG_PATH}') が見つからないため、WAVのまま送信します。")
+        return None
+    try:
+        process = await asyncio.create_subprocess_exec(
+            config.FFMPEG_PATH, "-hide_banner", "-loglevel", "error",
+            "-f", "wav", "-i", "pipe:0",
+            "-c:a", "libopus", "-b:a", config.VOICE_OPUS_BITRATE,
+            "-f", "ogg", "pipe:1",
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        encoded, stderr = await process.communicate(wav_data)
+    except Exception as e:
+        log_error("WAV_ASSEMBLE", f"ffmpeg の実行中にエラー: {e}")
+        return None
+    if process.returncode != 0 or not encoded:
+        log_error("WAV_ASSEMBLE", f"Opus への変換に失敗しました: {stderr.decode('utf-8', 'replace').strip()}")
+        return None
+    log_info("WAV_ASSEMBLE", f"Opus に変換しました。({len(wav_data) / 1024:.0f}KB -> {len(encoded) / 1024:.0f}KB)")
+    return encoded